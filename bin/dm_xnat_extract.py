@@ -20,6 +20,21 @@ Options:
     -u --username USER       XNAT username. If specified then the credentials file is ignored and you are prompted for password.
     --dont-update-dashboard  Dont update the dashboard database
     -t --tag tag,...         List of scan tags to download
+    --xnat-stats FILE        Write a summary of the time spent on each kind of
+                             xnat request to FILE (as json)
+    --download-workers N     Number of series to download at once [default: 2]
+    --export-workers N       Number of series to convert at once [default: 2]
+    --temp-space GB          Stop downloading series while this much temp space
+                             is in use [default: 20]
+    --session-workers N      Number of sessions to process at once, each with
+                             its own download and export workers [default: 1]
+    --project-workers N      Process at most N sessions from the same XNAT
+                             project at once
+    --resume FILE            Record completed and failed sessions in FILE and
+                             skip the sessions it lists as completed. Delete
+                             FILE to start over
+    --report FILE            Write what was done with each scan during this
+                             run to FILE (as json)
 
 OUTPUT FOLDERS
     Each dicom series will be converted and placed into a subfolder of the
@@ -58,19 +73,38 @@ NON-DICOM DATA
 
         /path/to/resources/SPN01_CMH_0001_01_01/
 
+EXTRACTION MANIFESTS
+    A record of what was exported for each session is kept in
+    <metadata>/xnat_extract/<session>.json, including a checksum of each
+    scan's dicoms on XNAT, the exporter version used and the outputs made.
+    Scans that haven't changed on XNAT since they were exported are skipped
+    without checking the output folders, scans that changed are exported
+    again (replacing their old outputs) and formats that failed are retried.
+
+SERIES CACHE
+    If SERIES_CACHE is set in the config files downloaded series are kept in
+    that folder (up to SERIES_CACHE_SIZE GB, 50 by default) and reused while
+    their contents on XNAT are unchanged.
+
 DEPENDENCIES
     dcm2nii
 
 """
 from datetime import datetime
 from glob import glob
+import hashlib
+import json
 import logging
 import os
 import platform
 import shutil
 import sys
 import re
+import tempfile
+import threading
+import time
 import zipfile
+from multiprocessing.pool import ThreadPool
 
 from docopt import docopt
 import pydicom as dicom
@@ -79,6 +113,7 @@ import datman.dashboard as dashboard
 import datman.config
 import datman.xnat
 import datman.utils
+import datman.pipeline
 import datman.scan
 import datman.scanid
 import datman.exceptions
@@ -91,13 +126,38 @@ cfg = None
 DRYRUN = False
 db_ignore = False  # if True dont update the dashboard db
 wanted_tags = None
+download_workers = 2
+export_workers = 2
+temp_space = None  # a datman.pipeline.DiskBudget for downloaded series
+series_cache = None  # a datman.xnat.SeriesCache, if configured
+tag_matchers = {}  # each site's datman.config.TagMatcher
+exporter_versions = {}  # the version of each format's exporter
+session_reports = []  # what this run did with each session's scans
+
+EXTRACT_WORKERS = 2
+VALIDATE_WORKERS = 2
+# Threads used to read the dicom headers of a single series
+HEADER_WORKERS = 4
+# The only tags read from dicom headers, anything else is skipped
+HEADER_TAGS = ['EchoNumbers', 'SeriesInstanceUID', 'SeriesNumber']
+# The program behind each export format and the command that prints its
+# version, for the extraction manifests
+EXPORTER_PROGRAMS = {'nii': ('dcm2niix', 'dcm2niix --version'),
+                     'mnc': ('dcm2mnc', 'dcm2mnc -version'),
+                     'nrrd': ('DWIConvert', 'DWIConvert --version'),
+                     'dcm': ('copy', None)}
 
 
 def main():
     global xnat
     global cfg
     global DRYRUN
+    global db_ignore
     global wanted_tags
+    global download_workers
+    global export_workers
+    global temp_space
+    global series_cache
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -109,6 +169,15 @@ def main():
     server = arguments['--server']
     username = arguments['--username']
     db_ignore = arguments['--dont-update-dashboard']
+    stats_file = arguments['--xnat-stats']
+    report_file = arguments['--report']
+    session_workers = int(arguments['--session-workers'])
+    project_workers = arguments['--project-workers']
+    resume_file = arguments['--resume']
+    download_workers = int(arguments['--download-workers'])
+    export_workers = int(arguments['--export-workers'])
+    temp_space = datman.pipeline.DiskBudget(
+            float(arguments['--temp-space']) * 1024**3)
 
     if arguments['--dry-run']:
         DRYRUN = True
@@ -138,6 +207,7 @@ def main():
 
     logger.addHandler(ch)
     logging.getLogger('datman.utils').addHandler(ch)
+    logging.getLogger('datman.pipeline').addHandler(ch)
     logging.getLogger('datman.dashboard').addHandler(ch)
 
     # setup the config object
@@ -149,8 +219,14 @@ def main():
     server = datman.xnat.get_server(cfg, url=server)
     username, password = datman.xnat.get_auth(username)
 
-    # initialize requests module object for XNAT REST API
-    xnat = datman.xnat.xnat(server, username, password)
+    # initialize requests module object for XNAT REST API. It's shared by
+    # every session being processed, so it needs a connection for each of
+    # their downloads
+    pool_size = max(datman.xnat.POOL_SIZE,
+                    session_workers * (download_workers + 1))
+    xnat = datman.xnat.xnat(server, username, password, pool_size=pool_size,
+                            cache_dir=datman.xnat.get_cache_dir(cfg))
+    series_cache = datman.xnat.get_series_cache(cfg)
 
     # get the list of XNAT projects linked to the datman study
     xnat_projects = cfg.get_xnat_projects(study)
@@ -176,8 +252,35 @@ def main():
     logger.info("Found {} sessions for study: {}"
                 .format(len(sessions), study))
 
-    for session in sessions:
-        process_session(session)
+    progress = None
+    if resume_file:
+        progress = datman.pipeline.ProgressRecord(resume_file)
+        sessions = [session for session in sessions
+                    if not progress.is_completed(session[1])]
+        logger.info("{} sessions remain after skipping those already "
+                    "completed".format(len(sessions)))
+
+    if project_workers:
+        project_workers = int(project_workers)
+    scheduler = datman.pipeline.Scheduler(
+            datman.pipeline.Stage('session',
+                                  lambda session: run_session(session,
+                                                              progress),
+                                  workers=session_workers),
+            group=lambda session: session[0], group_limit=project_workers)
+    results = scheduler.run(sessions)
+
+    failed = [result.job[1] for result in results if not result.succeeded]
+    if failed:
+        logger.error("{} of {} sessions were not fully extracted: {}".format(
+                len(failed), len(results), ', '.join(sorted(failed))))
+
+    if report_file:
+        write_report(report_file, session_reports)
+
+    logger.info('XNAT request summary:\n{}'.format(xnat.stats.report()))
+    if stats_file:
+        xnat.save_stats(stats_file)
 
 
 def collect_sessions(xnat_projects, config):
@@ -207,7 +310,29 @@ def collect_sessions(xnat_projects, config):
     return sessions
 
 
+def run_session(session, progress=None):
+    """
+    Process a session and, if given a datman.pipeline.ProgressRecord, note
+    whether it succeeded. Returns True if the session was fully extracted.
+    """
+    try:
+        succeeded = process_session(session)
+    except Exception as e:
+        logger.error("Failed processing session: {}. Reason: {}".format(
+                session[1], e))
+        succeeded, reason = False, str(e)
+    else:
+        reason = None if succeeded else 'See the log for details'
+    if progress:
+        progress.add(session[1], succeeded, reason)
+    return succeeded
+
+
 def process_session(session):
+    """
+    Extract a session's resources and scans. Returns True if everything
+    was extracted, or False if any part of the session failed.
+    """
     xnat_project = session[0]
     session_label = session[1]
 
@@ -218,7 +343,7 @@ def process_session(session):
         ident = datman.scanid.parse(session_label)
     except datman.scanid.ParseException:
         logger.error("Invalid session: {}. Skipping".format(session_label))
-        return
+        return False
 
     # check that the session is valid on XNAT
     try:
@@ -226,7 +351,7 @@ def process_session(session):
     except Exception as e:
         logger.error("Error while getting session {} from XNAT. "
                      "Message: {}".format(session_label, e.message))
-        return
+        return False
 
     # look into XNAT project and get list of experiments
     try:
@@ -235,19 +360,19 @@ def process_session(session):
         logger.warning("Failed getting experiments for: {} in project: {} "
                        "with reason: {}"
                        .format(session_label, xnat_project, e))
-        return
+        return False
 
     # we expect exactly 1 experiment per session
     if len(experiments) > 1:
         logger.error("Found more than one experiment for session: {} "
                      "in study: {}. Skipping"
                      .format(session_label, xnat_project))
-        return
+        return False
 
     if not experiments:
         logger.error("Session: {} in study: {} has no experiments"
                      .format(session_label, xnat_project))
-        return
+        return False
 
     experiment_label = experiments[0]['label']
 
@@ -264,12 +389,12 @@ def process_session(session):
     except Exception as e:
         logger.error("Failed getting experiment for session: {} with reason"
                      .format(session_label, e))
-        return
+        return False
 
     if not experiment:
         logger.warning("No experiments found for session: {}"
                        .format(session_label))
-        return
+        return False
 
     if not db_ignore:
         logger.debug("Adding session {} to dashboard".format(session_label))
@@ -283,11 +408,13 @@ def process_session(session):
 
     # experiment['children'] is a list of top level folders in XNAT
     # project --> session --> experiments
+    succeeded = True
     for data in experiment['children']:
         if data['field'] == 'resources/resource':
             process_resources(xnat_project, session_label, experiment_label, data)
         elif data['field'] == 'scans/scan':
-            process_scans(ident, xnat_project, session_label, experiment_label, data)
+            succeeded = process_scans(ident, xnat_project, session_label,
+                                      experiment_label, data) and succeeded
         else:
             logger.warning("Unrecognised field type: {} for experiment: {} "
                            "in session: {} from study: {}"
@@ -295,6 +422,7 @@ def process_session(session):
                                    experiment_label,
                                    session_label,
                                    xnat_project))
+    return succeeded
 
 def set_date(session, experiment):
     try:
@@ -375,14 +503,17 @@ def process_resources(xnat_project, session_label, experiment_label, data):
                              experiment_label,
                              xnat_resource_id,
                              resource['URI'],
-                             resource_path)
+                             resource_path,
+                             digest=resource.get('digest'))
 
 
 def get_resource(xnat_project, xnat_session, xnat_experiment,
-                 xnat_resource_id, xnat_resource_uri, target_path):
+                 xnat_resource_id, xnat_resource_uri, target_path,
+                 digest=None):
     """
     Download a single resource file from XNAT. Target path should be
-    full path to store the file, including filename
+    full path to store the file, including filename. If the catalog
+    recorded an md5 digest for the file it's used to verify the download.
     """
 
     try:
@@ -391,7 +522,8 @@ def get_resource(xnat_project, xnat_session, xnat_experiment,
                                    xnat_experiment,
                                    xnat_resource_id,
                                    xnat_resource_uri,
-                                   zipped=False)
+                                   zipped=False,
+                                   digest=digest)
     except Exception as e:
         logger.error("Failed downloading resource archive from: {} with "
                      "reason: {}".format(xnat_session, e))
@@ -429,6 +561,7 @@ def process_scans(ident, xnat_project, session_label, experiment_label, scans):
     scanid is a valid datman.scanid object
     Scans is the json output from XNAT query representing scans
     in an experiment
+    Returns True if every scan was exported
     """
     logger.info("Processing scans in session: {}"
                 .format(session_label))
@@ -440,14 +573,30 @@ def process_scans(ident, xnat_project, session_label, experiment_label, scans):
     if not exportinfo:
         logger.error("Failed to get exportinfo for study: {} at site: {}"
                      .format(cfg.study_name, ident.site))
-        return
+        return False
+
+    matcher = get_tag_matcher(ident.site, exportinfo)
+
+    # The experiment json already holds each scan's full record, so the
+    # scans don't need to be queried individually
+    scans_info = xnat.get_scans_info(xnat_project, session_label,
+                                     experiment_label, scans=scans['items'])
+
+    # The checksums identify each series' contents for the manifest and the
+    # series cache
+    cache_keys = get_series_keys(xnat_project, session_label,
+                                 experiment_label, scans_info)
+
+    state = SessionState(ident, manifest=get_manifest(session_label))
 
+    jobs = []
     for scan in scans['items']:
         series_id = scan['data_fields']['ID']
-        scan_info = xnat.get_scan_info(xnat_project,
-                                       session_label,
-                                       experiment_label,
-                                       series_id)
+        scan_info = scans_info.get(series_id)
+        if scan_info is None:
+            logger.error("Info for series: {} in session: {} could not be "
+                         "found. Skipping".format(series_id, session_label))
+            continue
 
         valid_dicoms = check_valid_dicoms(scan_info, series_id, session_label)
         if not valid_dicoms:
@@ -457,34 +606,128 @@ def process_scans(ident, xnat_project, session_label, experiment_label, scans):
         if derived:
             continue
 
-        file_stem, tag, multiecho = create_scan_name(exportinfo,
+        file_stem, tag, multiecho = create_scan_name(matcher,
                                                      scan_info,
                                                      session_label)
         if not file_stem:
             continue
 
+        job = SeriesJob(ident, xnat_project, session_label, experiment_label,
+                        series_id)
+        job.cache_key = cache_keys.get(series_id)
+        job.manifest = state.manifest
         if multiecho:
+            # The series is downloaded once and split up by echo
             for stem, t in zip(file_stem, tag):
                 if wanted_tags and (t not in wanted_tags):
                     continue
-                export_formats = process_scan(ident, stem, tags, t)
+                export_formats = process_scan(state, stem, tags, t,
+                                              job.cache_key)
                 if export_formats:
-                    get_scans(ident, xnat_project, session_label, experiment_label,
-                              series_id, export_formats, file_stem, multiecho)
+                    job.add_export(stem, export_formats,
+                                   echo=get_echo_number(exportinfo, t))
+            job.multiecho_stems = file_stem
 
         else:
             file_stem = file_stem[0]
             tag = tag[0]
             if wanted_tags and (tag not in wanted_tags):
                 continue
-            export_formats = process_scan(ident, file_stem, tags, tag)
+            export_formats = process_scan(state, file_stem, tags, tag,
+                                          job.cache_key)
             if export_formats:
-                get_scans(ident, xnat_project, session_label, experiment_label,
-                          series_id, export_formats, file_stem, multiecho)
+                job.add_export(file_stem, export_formats)
+
+        if job.exports:
+            # Scans exported before are being redone because they changed
+            # or failed, so their old outputs should be replaced
+            job.replace = any(state.manifest and
+                              state.manifest.has_scan(stem)
+                              for stem, _, _ in job.exports)
+            jobs.append(job)
+
+    succeeded = get_scans(jobs)
+    if state.manifest:
+        session_reports.append(state.manifest.report())
+        if not DRYRUN:
+            state.manifest.save()
+    return succeeded
 
 
-def process_scan(ident, file_stem, tags, tag):
-    if not db_ignore:
+def get_manifest(session_label):
+    """Returns the ExtractionManifest for a session"""
+    try:
+        meta_dir = cfg.get_path('meta')
+    except datman.config.UndefinedSetting:
+        logger.warning("No metadata folder defined, not keeping a manifest "
+                       "for session: {}".format(session_label))
+        return None
+    return ExtractionManifest(os.path.join(meta_dir, 'xnat_extract',
+                                           session_label + '.json'),
+                              session_label)
+
+
+def write_report(path, reports):
+    """Write the manifest reports for every session processed to path"""
+    with open(path, 'w') as report:
+        json.dump(sorted(reports, key=lambda item: item['session']), report,
+                  indent=2, sort_keys=True)
+
+
+def get_series_keys(xnat_project, session_label, experiment_label,
+                    scans_info):
+    """
+    Returns a dictionary mapping each series ID to the key its contents are
+    stored under in the series cache. The dicom catalogs of every scan are
+    read with one query.
+    """
+    resource_ids = {}
+    for series_id, scan_info in scans_info.items():
+        for child in scan_info.get('children', []):
+            for item in child['items']:
+                fields = item['data_fields']
+                if fields.get('label') == 'DICOM' and \
+                        'xnat_abstractresource_id' in fields:
+                    resource_ids[str(fields['xnat_abstractresource_id'])] = \
+                            series_id
+
+    try:
+        files = xnat.get_resource_files(xnat_project, session_label,
+                                        experiment_label,
+                                        list(resource_ids))
+    except Exception as e:
+        logger.warning("Failed getting dicom checksums for session: {}, "
+                       "the series cache and manifest checksums will not be "
+                       "used. Reason: {}"
+                       .format(session_label, e))
+        return {}
+
+    series_files = {}
+    for item in files:
+        series_id = resource_ids.get(item['resource_id'])
+        series_files.setdefault(series_id, []).append(item)
+
+    keys = {}
+    for series_id, scan_info in scans_info.items():
+        uid = scan_info['data_fields'].get('UID')
+        keys[series_id] = datman.xnat.get_series_key(
+                uid, series_files.get(series_id))
+    return keys
+
+
+def process_scan(state, file_stem, tags, tag, checksum=None):
+    """
+    Returns the formats a scan still needs to be exported to, using the
+    SessionState of the session it belongs to. checksum identifies the
+    scan's current contents on XNAT (see datman.xnat.get_series_key).
+    """
+    try:
+        datman.scanid.parse_filename(file_stem)
+    except datman.scanid.ParseException:
+        logger.error("{} is not a datman ID. Skipping.".format(file_stem))
+        return
+
+    if not db_ignore and not state.in_dashboard(file_stem):
         logger.info("Adding scan {} to dashboard".format(file_stem))
         try:
             dashboard.get_scan(file_stem, create=True)
@@ -493,7 +736,7 @@ def process_scan(ident, file_stem, tags, tag):
                     "error: {}".format(file_stem, e))
 
     try:
-        blacklist_entry = datman.utils.read_blacklist(scan=file_stem, config=cfg)
+        blacklist_entry = state.blacklist_entry(file_stem)
     except datman.scanid.ParseException:
         logger.error("{} is not a datman ID. Skipping.".format(file_stem))
         return
@@ -501,6 +744,7 @@ def process_scan(ident, file_stem, tags, tag):
     if blacklist_entry:
         logger.warn("Skipping export of {} due to blacklist entry '{}'".format(
                 file_stem, blacklist_entry))
+        state.note_skipped(file_stem, 'blacklisted')
         return
 
     try:
@@ -510,16 +754,18 @@ def process_scan(ident, file_stem, tags, tag):
                      "study: {}".format(tag, cfg.study_name))
         return
 
-    export_formats = series_is_processed(ident, file_stem, export_formats)
+    export_formats = state.remaining_formats(file_stem, export_formats,
+                                             checksum)
     if not export_formats:
         logger.warn("Scan: {} has been processed. Skipping"
                     .format(file_stem))
+        state.note_skipped(file_stem, 'already exported')
         return
 
     return export_formats
 
 
-def create_scan_name(exportinfo, scan_info, session_label):
+def create_scan_name(matcher, scan_info, session_label):
     """Creates name suitable for a scan including the tags"""
     try:
         series_id = scan_info['data_fields']['ID']
@@ -542,7 +788,7 @@ def create_scan_name(exportinfo, scan_info, session_label):
 
     multiecho = is_multiecho(scan_info)
 
-    tag = guess_tag(exportinfo, scan_info, description, multiecho)
+    tag = guess_tag(matcher, scan_info, description, multiecho)
 
     if not tag:
         logger.warning("No matching export pattern for {}, "
@@ -581,14 +827,8 @@ def is_multiecho(scan_info):
     return multiecho
 
 
-def guess_tag(exportinfo, scan_info, description, multiecho):
-    matches = []
-    for tag, p in exportinfo.iteritems():
-        description_regex = p['SeriesDescription']
-        if isinstance(description_regex, list):
-            description_regex = '|'.join(description_regex)
-        if re.search(description_regex, description, re.IGNORECASE):
-            matches.append(tag)
+def guess_tag(matcher, scan_info, description, multiecho):
+    matches = matcher.search('SeriesDescription', description)
     if len(matches) == 1:
         return matches
     elif len(matches) == 2 and multiecho:
@@ -598,10 +838,7 @@ def guess_tag(exportinfo, scan_info, description, multiecho):
         # to distinguish between magnitude, phase and phasediff scans
         try:
             image_type = scan_info['data_fields']['parameters/imageType']
-            for tag, p in exportinfo.iteritems():
-                if tag in matches:
-                    if not re.search(p['ImageType'], image_type):
-                        matches.remove(tag)
+            matches = matcher.search('ImageType', image_type, tags=matches)
             if len(matches) == 1:
                 return matches
             elif len(matches) == 2 and multiecho:
@@ -612,6 +849,16 @@ def guess_tag(exportinfo, scan_info, description, multiecho):
             return None
 
 
+def get_tag_matcher(site, exportinfo):
+    """
+    Returns a datman.config.TagMatcher for a site's export patterns,
+    compiling them only the first time the site is seen.
+    """
+    if site not in tag_matchers:
+        tag_matchers[site] = datman.config.TagMatcher(exportinfo)
+    return tag_matchers[site]
+
+
 def check_valid_dicoms(scan_info, series_id, session_label):
     # check if the series contains valid dicom files
     # this is to exclude the secondary dicoms generated by some scanners
@@ -648,179 +895,653 @@ def is_derived(scan_info, series_id, session_label):
     return derived
 
 
-def series_is_processed(ident, file_stem, export_formats):
-    """Returns true if exported files exist for all specified formats"""
-    remaining_formats = []
-    for f in export_formats:
-        outdir = os.path.join(cfg.get_path(f),
-                              ident.get_full_subjectid_with_timepoint())
-        outfile = os.path.join(outdir, file_stem)
-        # need to use wildcards here as dont really know what the
-        # file extensions will be
-        exists = [os.path.isfile(p) for p in glob(outfile + '.*')]
-        if not exists:
-            remaining_formats.append(f)
-    return remaining_formats
+class SessionState(object):
+    """
+    What is already known about a session's scans: its blacklist entries,
+    the files already exported for it and the scans the dashboard has a
+    record of. Each is read once, when first needed, so that deciding what
+    to do with each scan is a dictionary lookup instead of another trip to
+    the disk or database.
+    """
+
+    def __init__(self, ident, manifest=None):
+        self.ident = ident
+        # The session's ExtractionManifest, if it has one
+        self.manifest = manifest
+        self._blacklist = None
+        self._dashboard_scans = None
+        # Maps each export format to the file names (minus any extensions)
+        # found in the session's output folder
+        self._outputs = {}
+
+    def blacklist_entry(self, file_stem):
+        """Returns the blacklist comment for a scan, or None"""
+        if self._blacklist is None:
+            subject = self.ident.get_full_subjectid_with_timepoint_session()
+            try:
+                self._blacklist = datman.utils.read_blacklist(
+                        subject=subject, config=cfg) or {}
+            except Exception as e:
+                logger.info("Failed reading blacklist for {}, checking each "
+                            "scan separately. Reason: {}".format(subject, e))
+                self._blacklist = False
+        if self._blacklist is False:
+            return datman.utils.read_blacklist(scan=file_stem, config=cfg)
+        return self._blacklist.get(file_stem)
+
+    def in_dashboard(self, file_stem):
+        """Returns True if the dashboard already has a record of a scan"""
+        if self._dashboard_scans is None:
+            self._dashboard_scans = set()
+            try:
+                db_session = dashboard.get_session(self.ident)
+                if db_session:
+                    self._dashboard_scans = set(str(scan)
+                                                for scan in db_session.scans)
+            except Exception as e:
+                logger.info("Failed reading dashboard scans for {}. "
+                            "Reason: {}".format(self.ident, e))
+        ident, tag, series, _ = datman.scanid.parse_filename(file_stem)
+        return '_'.join([str(ident), tag, str(series)]) in \
+            self._dashboard_scans
+
+    def remaining_formats(self, file_stem, export_formats, checksum=None):
+        """
+        Returns the formats in export_formats a scan still needs. If the
+        manifest has a record of the scan (and its checksum) that decides,
+        otherwise any format with a file named for the scan in its output
+        folder counts as done.
+        """
+        if self.manifest:
+            remaining = self.manifest.remaining_formats(file_stem, checksum,
+                                                        export_formats)
+            if remaining is not None:
+                return remaining
+        return [f for f in export_formats
+                if file_stem not in self._get_outputs(f)]
+
+    def note_skipped(self, file_stem, reason):
+        if self.manifest:
+            self.manifest.add_skipped(file_stem, reason)
+
+    def _get_outputs(self, export_format):
+        if export_format not in self._outputs:
+            outdir = os.path.join(cfg.get_path(export_format),
+                    self.ident.get_full_subjectid_with_timepoint())
+            self._outputs[export_format] = _list_stems(outdir)
+        return self._outputs[export_format]
+
+
+def _list_stems(path):
+    """
+    Returns every file stem a file in path could have been exported for,
+    i.e. the file name cut at each '.' in it
+    """
+    stems = set()
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return stems
+    for name in names:
+        if not os.path.isfile(os.path.join(path, name)):
+            continue
+        parts = name.split('.')
+        for num in range(1, len(parts)):
+            stems.add('.'.join(parts[:num]))
+    return stems
+
+
+class ExtractionManifest(object):
+    """
+    A json record of what has been exported for a session. For each scan
+    (by file stem) it holds the XNAT series ID, a checksum of the series'
+    dicoms on XNAT and, for each format, the exporter and version used, the
+    outputs made (with their md5 sums), how long the export took and
+    whether it succeeded. report() describes what this run did.
+    """
+
+    def __init__(self, path, session_label):
+        self.path = path
+        self.session_label = session_label
+        self.scans = {}
+        self.run = {'started': datetime.now().isoformat(), 'exported': [],
+                    'failed': [], 'skipped': []}
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as manifest:
+                self.scans = json.load(manifest).get('scans', {})
+        except (IOError, ValueError) as e:
+            logger.warning("Ignoring unreadable manifest {}. Reason: {}"
+                           .format(path, e))
+
+    def has_scan(self, file_stem):
+        return file_stem in self.scans
+
+    def remaining_formats(self, file_stem, checksum, export_formats):
+        """
+        Returns the formats in export_formats that need to be exported
+        (again) for a scan, or None if the manifest can't tell because it
+        has no checksum to compare for the scan.
+        """
+        entry = self.scans.get(file_stem)
+        if not entry or not checksum or not entry.get('checksum'):
+            return None
+        if entry['checksum'] != checksum:
+            logger.info("Scan {} has changed on XNAT since it was exported"
+                        .format(file_stem))
+            return list(export_formats)
+        exports = entry.get('exports', {})
+        return [f for f in export_formats
+                if not _export_done(exports.get(f, {}))]
+
+    def add_export(self, file_stem, series_id, checksum, export_format,
+                   outputs, seconds):
+        """Record an exporter run for a scan"""
+        exporter, version = get_exporter_version(export_format)
+        record = {'exporter': exporter,
+                  'version': version,
+                  'outputs': dict((path, get_md5(path)) for path in outputs),
+                  'seconds': round(seconds, 3),
+                  'succeeded': bool(outputs),
+                  'exported': datetime.now().isoformat()}
+        with self._lock:
+            entry = self.scans.setdefault(file_stem, {})
+            if entry.get('checksum') != checksum:
+                # Anything recorded was for the scan's old contents
+                entry['exports'] = {}
+            entry['series_id'] = series_id
+            entry['checksum'] = checksum
+            entry.setdefault('exports', {})[export_format] = record
+            action = 'exported' if outputs else 'failed'
+            self.run[action].append({'scan': file_stem,
+                                     'format': export_format})
+
+    def add_skipped(self, file_stem, reason):
+        with self._lock:
+            self.run['skipped'].append({'scan': file_stem, 'reason': reason})
+
+    def report(self):
+        report = dict(self.run)
+        report['session'] = self.session_label
+        report['finished'] = datetime.now().isoformat()
+        return report
+
+    def save(self):
+        with self._lock:
+            contents = json.dumps({'session': self.session_label,
+                                   'scans': self.scans,
+                                   'last_run': self.report()},
+                                  indent=2, sort_keys=True)
+        datman.utils.write_atomic(self.path, contents)
+
+
+def _export_done(record):
+    """
+    Returns True if a manifest export record succeeded and every output it
+    made is still on disk (outputs are deleted to force a re-export).
+    """
+    outputs = record.get('outputs')
+    if not record.get('succeeded') or not outputs:
+        return False
+    return all(os.path.exists(path) for path in outputs)
+
 
+def get_exporter_version(export_format):
+    """
+    Returns the name and version of the program behind an export format,
+    asking the program for its version only once per run.
+    """
+    program, version_cmd = EXPORTER_PROGRAMS.get(export_format,
+                                                 (export_format, None))
+    if export_format not in exporter_versions:
+        version = None
+        if version_cmd and not DRYRUN:
+            try:
+                _, output = datman.utils.run(version_cmd, verbose=False)
+                lines = [line.strip() for line in output.splitlines()
+                         if line.strip()]
+                version = lines[0] if lines else None
+            except Exception as e:
+                logger.debug("Failed getting version of {}. Reason: {}"
+                             .format(program, e))
+        exporter_versions[export_format] = version
+    return program, exporter_versions[export_format]
+
+
+def get_md5(path):
+    """Returns the md5 sum of a file, or None for a folder"""
+    if not os.path.isfile(path):
+        return None
+    md5 = hashlib.md5()
+    with open(path, 'rb') as output:
+        for chunk in iter(lambda: output.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class SeriesJob(object):
+    """
+    A series to download from XNAT and the exports wanted from it. Each
+    export is a (file_stem, export_formats, echo_number) tuple, echo_number
+    is None unless the series is multi-echo.
+    """
+
+    def __init__(self, ident, xnat_project, session_label, experiment_label,
+                 series_id):
+        self.ident = ident
+        self.xnat_project = xnat_project
+        self.session_label = session_label
+        self.experiment_label = experiment_label
+        self.series_id = series_id
+        self.exports = []
+        # For a multi-echo series, the file stem of every echo
+        self.multiecho_stems = None
+        self.temp_dir = None
+        self.src_dir = None
+        # Maps each echo number to a folder holding only that echo's dicoms
+        self.echo_dirs = {}
+        # Identifies the series' contents in the series cache
+        self.cache_key = None
+        self.cached = False
+        # Bytes of temp space currently used by this job
+        self.disk_used = 0
+        # An ExportResult for each exporter run
+        self.export_results = []
+        # The session's ExtractionManifest, if it has one
+        self.manifest = None
+        # True if existing outputs should be replaced by the new exports
+        self.replace = False
+
+    def add_export(self, file_stem, export_formats, echo=None):
+        self.exports.append((file_stem, export_formats, echo))
+
+    def use_disk(self, num_bytes):
+        self.disk_used += num_bytes
+        if temp_space:
+            temp_space.add(num_bytes)
+
+    def __str__(self):
+        return 'session: {}, series: {}'.format(self.session_label,
+                                               self.series_id)
+
+
+def get_scans(jobs):
+    """
+    Download and export a list of SeriesJobs. Each series goes through
+    download, extract, validate and export stages, each with its own
+    workers, so one series can be converting while the next downloads.
+    Returns True if every series was exported.
+    """
+    if not jobs:
+        return True
+
+    logger.info("Getting {} scans from XNAT".format(len(jobs)))
+    pipeline = datman.pipeline.Pipeline(
+            [datman.pipeline.Stage('download', download_series,
+                                   workers=download_workers),
+             datman.pipeline.Stage('extract', extract_series,
+                                   workers=EXTRACT_WORKERS),
+             datman.pipeline.Stage('validate', find_series_dir,
+                                   workers=VALIDATE_WORKERS),
+             datman.pipeline.Stage('export', export_series,
+                                   workers=export_workers)],
+            cleanup=remove_series_files, budget=temp_space)
+    for job in jobs:
+        pipeline.submit(job)
+    results = pipeline.wait()
+
+    failed = [result for result in results if not result.succeeded]
+    logger.info('Completed exports for {} of {} scans. Time spent: {}'
+                .format(len(results) - len(failed), len(results),
+                        pipeline.report()))
+    export_times = {}
+    for job in jobs:
+        for export in job.export_results:
+            export_times[export.export_format] = export_times.get(
+                    export.export_format, 0) + export.seconds
+    if export_times:
+        logger.info('Time spent by exporters: {}'.format(', '.join(
+                '{} {:.1f}s'.format(export_format, export_times[export_format])
+                for export_format in sorted(export_times))))
+    for result in failed:
+        logger.error("Failed getting series: {}, session: {} from XNAT at "
+                     "stage: {}".format(result.job.series_id,
+                                        result.job.session_label,
+                                        result.failed_stage))
+    return not failed
+
+
+def download_series(job):
+    """
+    Download a series' dicom archive from XNAT to a new temp folder, or
+    copy the series from the series cache if it's there.
+    """
+    job.temp_dir = tempfile.mkdtemp(prefix='dm_xnat_extract_')
+    dicom_dir = os.path.join(job.temp_dir, 'dicoms')
+    if series_cache and series_cache.get(job.cache_key, dicom_dir):
+        logger.info("Using cached dicoms for: {}, series: {}"
+                    .format(job.session_label, job.series_id))
+        job.cached = True
+        job.use_disk(datman.utils.get_folder_size(dicom_dir))
+        return job
+
+    logger.info("Downloading dicoms for: {}, series: {}"
+                .format(job.session_label, job.series_id))
+    archive = os.path.join(job.temp_dir, 'series.zip')
+    try:
+        xnat.get_dicom(job.xnat_project, job.session_label,
+                       job.experiment_label, job.series_id, archive)
+    except Exception as e:
+        logger.error("Failed to download dicom archive for: {}, series: {}"
+                     .format(job.session_label, job.series_id))
+        return None
+    job.use_disk(os.path.getsize(archive))
+    return job
+
+
+def extract_series(job):
+    """Unpack a downloaded series and delete the archive"""
+    if job.cached:
+        return job
+    logger.info("Unpacking archive for: {}, series: {}"
+                .format(job.session_label, job.series_id))
+    archive = os.path.join(job.temp_dir, 'series.zip')
+    extract_dir = os.path.join(job.temp_dir, 'dicoms')
+    try:
+        with zipfile.ZipFile(archive, 'r') as myzip:
+            myzip.extractall(extract_dir)
+            extracted = sum(item.file_size for item in myzip.infolist())
+    except:
+        logger.error("An error occurred unpacking dicom archive for: {}. "
+                     "Skipping".format(job.session_label))
+        return None
 
-def get_scans(ident, xnat_project, session_label, experiment_label, series_id,
-        export_formats, file_stem, multiecho):
-    logger.info("Getting scan from XNAT")
+    job.use_disk(extracted)
+    archive_size = os.path.getsize(archive)
+    os.remove(archive)
+    job.use_disk(-archive_size)
 
+    if series_cache:
+        series_cache.add(job.cache_key, extract_dir)
+    return job
+
+
+def find_series_dir(job):
+    """
+    Find the folder holding a series' extracted dicoms. A multi-echo series'
+    dicoms are also sorted into a folder for each echo.
+    """
+    filenames = []
+    for root, dirname, names in os.walk(job.temp_dir):
+        filenames.extend(os.path.join(root, name) for name in names)
+
+    start = time.time()
+    archive_files = []
+    echoes = {}
+    for f, header in read_dicom_headers(filenames):
+        archive_files.append(f)
+        if job.multiecho_stems:
+            echo = header.get('EchoNumbers')
+            if echo is not None:
+                echoes.setdefault(int(echo), []).append(f)
+    logger.info("Checked {} dicom headers for: {}, series: {} in {:.2f}s"
+                .format(len(filenames), job.session_label, job.series_id,
+                        time.time() - start))
+
+    try:
+        job.src_dir = os.path.dirname(archive_files[0])
+    except IndexError:
+        logger.warning("There were no valid dicom files in XNAT session: {}, "
+                       "series: {}".format(job.session_label, job.series_id))
+        return None
+
+    for echo, files in echoes.items():
+        # dcm2niix names its outputs after the folder, so every echo's
+        # folder must be called 'files' like the one xnat provides
+        echo_dir = os.path.join(job.temp_dir, 'echoes', str(echo), 'files')
+        os.makedirs(echo_dir)
+        for f in files:
+            os.rename(f, os.path.join(echo_dir, os.path.basename(f)))
+        job.echo_dirs[echo] = echo_dir
+    return job
+
+
+def export_series(job):
+    """Run the exporter for each format a series is needed in"""
     # setup the export functions for each format
     xporters = {'mnc': export_mnc_command,
                 'nii': export_nii_command,
                 'nrrd': export_nrrd_command,
                 'dcm': export_dcm_command}
 
-    # scan hasn't been completely processed, get it from XNAT
-    with datman.utils.make_temp_directory(prefix='dm_xnat_extract_') as temp_dir:
-        src_dir = get_dicom_archive_from_xnat(xnat_project, session_label,
-                                              experiment_label, series_id,
-                                              temp_dir)
-
-        if not src_dir:
-            logger.error("Failed getting series: {}, session: {} from XNAT"
-                         .format(series_id, session_label))
-            return
+    for file_stem, export_formats, echo in job.exports:
+        multiecho = False
+        src_dir = job.src_dir
+        if echo is not None and job.echo_dirs:
+            try:
+                src_dir = job.echo_dirs[echo]
+            except KeyError:
+                logger.error("No dicoms found for echo {} of series: {} in "
+                             "session: {}".format(echo, job.series_id,
+                                                  job.session_label))
+                continue
+        elif echo is not None:
+            # No echo numbers in the headers, let the exporters try to tell
+            # the echoes apart
+            multiecho = True
+            file_stem = job.multiecho_stems
 
         for export_format in export_formats:
             target_base_dir = cfg.get_path(export_format)
             target_dir = os.path.join(target_base_dir,
-                                      ident.get_full_subjectid_with_timepoint())
+                    job.ident.get_full_subjectid_with_timepoint())
             try:
                 target_dir = datman.utils.define_folder(target_dir)
             except OSError as e:
                 logger.error("Failed creating target folder: {}"
                              .format(target_dir))
-                return
+                return None
 
             try:
                 exporter = xporters[export_format]
             except KeyError:
-                logger.error("Export format {} not defined".format(export_format))
+                logger.error("Export format {} not defined".format(
+                        export_format))
+                continue
 
             logger.info('Exporting scan {} to format {}'.format(file_stem,
                                                                 export_format))
+            start = time.time()
             try:
-                exporter(src_dir, target_dir, file_stem, multiecho)
-            except:
-                # The conversion functions dont really ever raise exceptions
-                # even when they fail so this is a bit useless
+                outputs = run_exporter(exporter, src_dir, target_dir,
+                                       file_stem, multiecho,
+                                       replace=job.replace)
+            except Exception as e:
                 logger.error("An error happened exporting {} from scan: {} "
-                             "in session: {}".format(export_format, series_id,
-                                                     session_label))
-
-    logger.info('Completed exports')
+                             "in session: {}. Reason: {}".format(
+                                     export_format, job.series_id,
+                                     job.session_label, e))
+                outputs = []
+            result = ExportResult(file_stem, export_format, outputs,
+                                  time.time() - start)
+            logger.debug("Exported {} from scan: {} in session: {} in "
+                         "{:.1f}s".format(export_format, job.series_id,
+                                          job.session_label, result.seconds))
+            job.export_results.append(result)
+            if job.manifest:
+                record_export(job, result)
+    return job
+
+
+def record_export(job, result):
+    """Add an exporter run to the session's manifest"""
+    if isinstance(result.file_stem, list):
+        # A multi-echo series exported in one go, split up the outputs
+        for stem in result.file_stem:
+            outputs = [path for path in result.outputs
+                       if os.path.basename(path).startswith(stem + '.')]
+            job.manifest.add_export(stem, job.series_id, job.cache_key,
+                                    result.export_format, outputs,
+                                    result.seconds)
+        return
+    job.manifest.add_export(result.file_stem, job.series_id, job.cache_key,
+                            result.export_format, result.outputs,
+                            result.seconds)
 
 
-def get_dicom_archive_from_xnat(xnat_project, session_label, experiment_label,
-                                series, tempdir):
+class ExportResult(object):
     """
-    Downloads and extracts a dicom archive from XNAT to a local temp folder
-    Returns the path to the tempdir (for later cleanup) as well as the
-    path to the .dcm files inside the tempdir
+    Records one exporter run: the scan's file stem (a list of stems for a
+    multi-echo series exported in one go), the format, the output paths
+    published and the seconds it took.
     """
-    # make a copy of the dicom files in a local directory
-    logger.info("Downloading dicoms for: {}, series: {}"
-                .format(session_label, series))
-    try:
-        dicom_archive = xnat.get_dicom(xnat_project,
-                                       session_label,
-                                       experiment_label,
-                                       series)
-    except Exception as e:
-        logger.error("Failed to download dicom archive for: {}, series: {}"
-                     .format(session_label, series))
-        return None
 
-    logger.info("Unpacking archive")
+    def __init__(self, file_stem, export_format, outputs, seconds):
+        self.file_stem = file_stem
+        self.export_format = export_format
+        self.outputs = outputs
+        self.seconds = seconds
 
-    try:
-        with zipfile.ZipFile(dicom_archive, 'r') as myzip:
-            myzip.extractall(tempdir)
-    except:
-        logger.error("An error occurred unpacking dicom archive for: {}. Skipping"
-                     .format(session_label))
-        os.remove(dicom_archive)
-        return None
 
-    logger.info("Deleting archive file")
-    os.remove(dicom_archive)
+def run_exporter(exporter, src_dir, target_dir, file_stem, multiecho=False,
+                 replace=False):
+    """
+    Runs an exporter with a new staging folder inside target_dir as its
+    output folder and then publishes whatever it wrote there (see
+    publish_outputs). Returns the paths of the published outputs.
 
-    # get the root dir for the extracted files
-    archive_files = []
-    for root, dirname, filenames in os.walk(tempdir):
-        for filename in filenames:
-            f = os.path.join(root, filename)
-            if is_valid_dicom(f):
-                archive_files.append(f)
+    During a dry run nothing is exported and no staging folder is made.
+    """
+    if DRYRUN:
+        logger.info("DRYRUN: Would export {} to {}".format(src_dir,
+                                                           target_dir))
+        return []
 
+    staging_dir = tempfile.mkdtemp(prefix='.export_', dir=target_dir)
     try:
-        base_dir = os.path.dirname(archive_files[0])
-    except IndexError:
-        logger.warning("There were no valid dicom files in XNAT session: {}, series: {}"
-                       .format(session_label, series))
-        return None
-    return base_dir
+        exporter(src_dir, staging_dir, file_stem, multiecho)
+        return publish_outputs(staging_dir, target_dir, replace=replace)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def publish_outputs(staging_dir, target_dir, replace=False):
+    """
+    Renames everything in staging_dir into target_dir. Because each output
+    is renamed into place a partly written output never appears in
+    target_dir. Outputs that already exist are only replaced if 'replace'
+    is set.
+
+    Only outputs with the same name are replaced. If an earlier export of
+    the series wrote outputs under other names (e.g. dcm2niix split the
+    series differently) those are left in target_dir and must be removed
+    by hand.
+    """
+    published = []
+    for name in sorted(os.listdir(staging_dir)):
+        target = os.path.join(target_dir, name)
+        if os.path.isdir(target) and replace:
+            shutil.rmtree(target)
+        elif os.path.exists(target) and not replace:
+            logger.error("Output file {} already exists. Skipping"
+                         .format(target))
+            continue
+        os.rename(os.path.join(staging_dir, name), target)
+        published.append(target)
+    return published
+
+
+def remove_series_files(job):
+    if job.temp_dir:
+        shutil.rmtree(job.temp_dir, ignore_errors=True)
+    if temp_space:
+        temp_space.release(job.disk_used)
+    job.disk_used = 0
 
 
 def is_valid_dicom(filename):
+    return read_dicom_header(filename) is not None
+
+
+def read_dicom_header(filename):
+    """
+    Returns the file meta information and the tags in HEADER_TAGS from a
+    dicom's header, or None if the file isnt a valid dicom. The rest of the
+    file (pixel data included) is never read.
+    """
     try:
-        dicom.read_file(filename)
+        with open(filename, 'rb') as dcm:
+            # Anything without the preamble and 'DICM' prefix is rejected
+            # before pydicom gets involved
+            dcm.seek(128)
+            if dcm.read(4) != b'DICM':
+                return None
+            dcm.seek(0)
+            return dicom.read_file(dcm, stop_before_pixels=True,
+                                   specific_tags=HEADER_TAGS)
     except IOError:
         return
     except dicom.errors.InvalidDicomError:
         return
-    return True
-
 
-def export_mnc_command(seriesdir, outputdir, stem, multiecho=False):
-    """Converts a DICOM series to MINC format"""
-    outputfile = os.path.join(outputdir, stem) + '.mnc'
 
+def read_dicom_headers(filenames):
+    """
+    Reads the header of each file with a pool of HEADER_WORKERS threads.
+    Returns a list of (filename, header) tuples for the valid dicoms, in
+    the order given.
+    """
+    if not filenames:
+        return []
+    pool = ThreadPool(min(HEADER_WORKERS, len(filenames)))
     try:
-        check_create_dir(outputdir)
-    except:
-        return
+        headers = pool.map(read_dicom_header, filenames)
+    finally:
+        pool.close()
+        pool.join()
+    return [(f, header) for f, header in zip(filenames, headers)
+            if header is not None]
 
-    if os.path.exists(outputfile):
-        logger.warning("{}: output {} exists. Skipping"
-                       .format(seriesdir, outputfile))
-        return
 
+def export_mnc_command(seriesdir, outputdir, stem, multiecho=False):
+    """Converts a DICOM series to MINC format"""
     logger.debug("Exporting series {} to {}"
-                 .format(seriesdir, outputfile))
+                 .format(seriesdir, os.path.join(outputdir, stem) + '.mnc'))
     cmd = 'dcm2mnc -fname {} -dname "" {}/* {}'.format(stem,
                                                        seriesdir,
                                                        outputdir)
     datman.utils.run(cmd, DRYRUN)
 
 
+# dcm2niix names its outputs <folder>_<protocol>_<14 digit timestamp>_
+# <1-3 digit series number><suffix, e.g. _e2 for the second echo><extension>
+DCM2NIIX_OUTPUT = re.compile("files_(.*)_([0-9]{14})_([0-9]{1,3})(.*)?$")
+
+
 def export_nii_command(seriesdir, outputdir, stem, multiecho=False):
-    """Converts a DICOM series to NifTi format"""
-    try:
-        check_create_dir(outputdir)
-    except:
-        return
+    """
+    Converts a DICOM series to NifTi format. dcm2niix writes into a folder
+    of its own and its outputs (and accompanying BIDS files etc.) are then
+    renamed after stem.
+    """
     logger.info("Exporting series {}".format(seriesdir))
 
     if multiecho:
         echo_dict = get_echo_dict(stem)
 
-    # convert into tempdir
-    with datman.utils.make_temp_directory(prefix="dm_xnat_extract_") as tmpdir:
+    tmpdir = tempfile.mkdtemp(prefix='dcm2niix_', dir=outputdir)
+    try:
         datman.utils.run('dcm2niix -z y -b y -o {} {}'
                          .format(tmpdir, seriesdir), DRYRUN)
-        # move nii and accompanying files (BIDS, dirs, etc) from tmpdir/ to nii/
-        for f in glob('{}/*'.format(tmpdir)):
+        for f in sorted(glob('{}/*'.format(tmpdir))):
             bn = os.path.basename(f)
             ext = datman.utils.get_extension(f)
-            # regex is made up of 14 digit timestamp and 1-3 digit series number
-            regex = "files_(.*)_([0-9]{14})_([0-9]{1,3})(.*)?" + ext
-            m = re.search(regex, bn)
+            m = DCM2NIIX_OUTPUT.search(bn[:len(bn) - len(ext)])
             if not m:
-                logger.error("Unable to parse file {} using the regex".format(bn))
+                logger.error("Unable to parse file {} using the regex"
+                             .format(bn))
                 continue
 
             if multiecho:
@@ -828,37 +1549,19 @@ def export_nii_command(seriesdir, outputdir, stem, multiecho=False):
                     echo = int(m.group(4).split('e')[-1][0])
                     stem = echo_dict[echo]
                 except:
-                    logger.error("Unable to parse valid echo number from file {}"
-                                 .format(bn))
+                    logger.error("Unable to parse valid echo number from "
+                                 "file {}".format(bn))
                     return
 
-            outputfile = os.path.join(outputdir, stem) + ext
-            if os.path.exists(outputfile):
-                logger.error("Output file {} already exists. Skipping"
-                             .format(outputfile))
-                continue
-
-            return_code, _ = datman.utils.run("mv {} {}/{}{}"
-                                              .format(f, outputdir, stem, ext), DRYRUN)
-            if return_code:
-                logger.debug("Moving dcm2niix output {} to {} has failed"
-                             .format(f, outputdir))
-                continue
+            os.rename(f, os.path.join(outputdir, stem) + ext)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
 
 def export_nrrd_command(seriesdir, outputdir, stem, multiecho=False):
     """Converts a DICOM series to NRRD format"""
-    outputfile = os.path.join(outputdir, stem) + '.nrrd'
-    try:
-        check_create_dir(outputdir)
-    except:
-        return
-    if os.path.exists(outputfile):
-        logger.warning("{}: output {} exists. Skipping"
-                       .format(seriesdir, outputfile))
-        return
-
-    logger.debug("Exporting series {} to {}".format(seriesdir, outputfile))
+    logger.debug("Exporting series {} to {}".format(
+            seriesdir, os.path.join(outputdir, stem) + '.nrrd'))
 
     cmd = 'DWIConvert -i {} --conversionMode DicomToNrrd -o {}.nrrd' \
           ' --outputDirectory {}'.format(seriesdir, stem, outputdir)
@@ -868,92 +1571,64 @@ def export_nrrd_command(seriesdir, outputdir, stem, multiecho=False):
 
 def export_dcm_command(seriesdir, outputdir, stem, multiecho=False):
     """Copies a DICOM for each echo number in a scan series."""
-    try:
-        check_create_dir(outputdir)
-    except:
-        return
-
     logger.info("Exporting series {}".format(seriesdir))
 
+    dcmfile = None
     if multiecho:
         echo_dict = get_echo_dict(stem)
 
         dcm_dict = {}
         for path in glob(seriesdir + '/*'):
-            try:
-                dcm_echo_num = dicom.read_file(path).EchoNumbers
-                if dcm_echo_num not in dcm_dict.keys():
-                    dcm_dict[int(dcm_echo_num)] = path
-                if len(dcm_dict.keys()) == 2:
-                    break
-            except dicom.filereader.InvalidDicomError as e:
-                pass
+            header = read_dicom_header(path)
+            if header is None or 'EchoNumbers' not in header:
+                continue
+            dcm_echo_num = header.EchoNumbers
+            if dcm_echo_num not in dcm_dict.keys():
+                dcm_dict[int(dcm_echo_num)] = path
+            if len(dcm_dict.keys()) == 2:
+                break
 
     else:
         for path in glob(seriesdir + '/*'):
-            try:
-                dicom.read_file(path)
+            if is_valid_dicom(path):
                 dcmfile = path
                 break
-            except dicom.filereader.InvalidDicomError as e:
-                pass
 
     if multiecho:
         for echo_num, dcm_echo_num in zip(echo_dict.keys(), dcm_dict.keys()):
             outputfile = os.path.join(outputdir, echo_dict[echo_num]) + '.dcm'
-            if os.path.exists(outputfile):
-                logger.error("Output file {} already exists. Skipping"
-                             .format(outputfile))
-                continue
-            logger.debug("Exporting a dcm file from {} to {}"
-                         .format(seriesdir, outputfile))
-            cmd = 'cp {} {}'.format(dcm_dict[dcm_echo_num], outputfile)
-            datman.utils.run(cmd, DRYRUN)
+            copy_dicom(dcm_dict[dcm_echo_num], outputfile)
 
     elif dcmfile:
-        outputfile = os.path.join(outputdir, stem) + '.dcm'
-        if os.path.exists(outputfile):
-            logger.error("Output file {} already exists. Skipping"
-                         .format(outputfile))
-            return
-        logger.debug("Exporting a dcm file from {} to {}"
-                     .format(seriesdir, outputfile))
-        cmd = 'cp {} {}'.format(dcmfile, outputfile)
-        datman.utils.run(cmd, DRYRUN)
+        copy_dicom(dcmfile, os.path.join(outputdir, stem) + '.dcm')
 
     else:
         logger.error("No dicom files found in {}".format(seriesdir))
         return
 
 
-def check_create_dir(target):
-    """Checks to see if a directory exists, creates if not"""
-    if not os.path.isdir(target):
-        logger.info("Creating dir: {}".format(target))
-        try:
-            os.makedirs(target)
-        except OSError as e:
-            logger.error("Failed creating dir: {}".format(target))
-            raise e
+def copy_dicom(source, outputfile):
+    logger.debug("Exporting a dcm file from {} to {}"
+                 .format(source, outputfile))
+    if not DRYRUN:
+        shutil.copyfile(source, outputfile)
 
 
 def get_echo_dict(stem):
     echo_dict = {}
+    exportinfo = {}
     for s in stem:
         ident, tag = datman.scanid.parse_filename(s)[:2]
-        echo_num = get_echo_number(ident, tag)
+        if ident.site not in exportinfo:
+            exportinfo[ident.site] = cfg.get_tags(site=ident.site).series_map
+        echo_num = get_echo_number(exportinfo[ident.site], tag)
         if echo_num not in echo_dict.keys():
             echo_dict[echo_num] = s
     return echo_dict
 
 
-def get_echo_number(ident, tag):
-    tags = cfg.get_tags(site=ident.site)
-    exportinfo = tags.series_map
-    for t, p in exportinfo.iteritems():
-        if t == tag:
-            echo_number = p['EchoNumber']
-    return echo_number
+def get_echo_number(exportinfo, tag):
+    return exportinfo[tag]['EchoNumber']
 
 
 if __name__ == '__main__':
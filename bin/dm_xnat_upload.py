@@ -16,6 +16,19 @@ Options:
     -v --verbose          Be chatty
     -d --debug            Be very chatty
     -q --quiet            Be quiet
+    --xnat-stats FILE     Write a summary of the time spent on each kind of
+                          xnat request to FILE (as json)
+    --upload-workers N    Number of archives to upload at once [default: 1]
+    --project-workers N   Upload at most N archives to the same XNAT project
+                          at once
+    --scan-workers N      Number of archives to read the headers of at once.
+                          Archives are read in the order they'll be uploaded,
+                          ahead of the uploads [default: 2]
+    --resume FILE         Keep the queue of archives to upload in FILE, noting
+                          which completed and which failed. Archives that
+                          completed are skipped (unless they've changed since)
+                          and those left pending by an interrupted run go
+                          first. Delete FILE to start over
 """
 
 import logging
@@ -23,11 +36,16 @@ import sys
 import os
 import zipfile
 import urllib
+import functools
+import threading
+from multiprocessing.pool import ThreadPool
 
 from docopt import docopt
 
 import datman.config
 import datman.utils
+import datman.fingerprint
+import datman.pipeline
 import datman.scanid
 import datman.xnat
 import datman.exceptions
@@ -39,6 +57,7 @@ password = None
 server = None
 XNAT = None
 CFG = None
+scanner = None
 
 
 def main():
@@ -47,6 +66,7 @@ def main():
     global password
     global XNAT
     global CFG
+    global scanner
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -56,6 +76,11 @@ def main():
     server = arguments['--server']
     username = arguments['--username']
     archive = arguments['<archive>']
+    stats_file = arguments['--xnat-stats']
+    upload_workers = int(arguments['--upload-workers'])
+    project_workers = arguments['--project-workers']
+    scan_workers = int(arguments['--scan-workers'])
+    resume_file = arguments['--resume']
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -85,7 +110,10 @@ def main():
 
     server = datman.xnat.get_server(CFG, url=server)
     username, password = datman.xnat.get_auth(username)
-    XNAT = datman.xnat.xnat(server, username, password)
+    XNAT = datman.xnat.xnat(server, username, password,
+                            pool_size=max(datman.xnat.POOL_SIZE,
+                                          upload_workers),
+                            cache_dir=datman.xnat.get_cache_dir(CFG))
 
     dicom_dir = CFG.get_path('dicom', study)
     # deal with a single archive specified on the command line,
@@ -102,13 +130,46 @@ def main():
             logger.error('Cant find archive:{}'.format(archive))
             return
     else:
-        archives = os.listdir(dicom_dir)
+        # Skip hidden files, e.g. cached archive fingerprints
+        archives = [name for name in sorted(os.listdir(dicom_dir))
+                    if not name.startswith('.')]
 
     logger.debug('Processing files in:{}'.format(dicom_dir))
     logger.info('Processing {} files'.format(len(archives)))
 
-    for archivefile in archives:
-        process_archive(os.path.join(dicom_dir, archivefile))
+    archives = [os.path.join(dicom_dir, name) for name in archives]
+
+    progress = None
+    if resume_file:
+        progress = datman.pipeline.ProgressRecord(resume_file)
+        archives = get_queue(archives, progress)
+        logger.info("{} archives remain after skipping those already "
+                    "completed".format(len(archives)))
+
+    jobs = [(get_project(archive), archive) for archive in archives]
+    if project_workers:
+        project_workers = int(project_workers)
+    scheduler = datman.pipeline.Scheduler(
+            datman.pipeline.Stage('upload',
+                                  lambda job: run_archive(job, progress),
+                                  workers=upload_workers),
+            group=lambda job: job[0], group_limit=project_workers)
+
+    scanner = ArchiveScanner(archives, scan_workers)
+    try:
+        results = scheduler.run(jobs)
+    finally:
+        scanner.close()
+
+    failed = [result.job[1] for result in results if not result.succeeded]
+    if failed:
+        logger.error("{} of {} archives were not fully uploaded: {}".format(
+                len(failed), len(results),
+                ', '.join(sorted(os.path.basename(f) for f in failed))))
+
+    logger.info('XNAT request summary:\n{}'.format(XNAT.stats.report()))
+    if stats_file:
+        XNAT.save_stats(stats_file)
 
 
 def is_datman_id(archive):
@@ -118,23 +179,161 @@ def is_datman_id(archive):
             datman.scanid.is_phantom(archive))
 
 
+class ArchiveScanner(object):
+    """
+    Reads the fingerprints (see datman.fingerprint) of a list of archives
+    with a pool of threads, in the order given, so that the headers of the
+    archives waiting to be uploaded are read while earlier ones upload. Only
+    'lookahead' archives past the furthest one asked for so far are read
+    ahead (by default twice the number of workers).
+    """
+
+    def __init__(self, archives, workers, lookahead=None):
+        workers = max(1, workers)
+        self.archives = list(archives)
+        self.lookahead = lookahead or 2 * workers
+        self._positions = dict((archive, num)
+                               for num, archive in enumerate(self.archives))
+        self._pool = ThreadPool(workers)
+        self._results = {}
+        # The number of archives (from the start of the list) being read
+        self._scheduled = 0
+        self._lock = threading.Lock()
+        self._schedule(0)
+
+    def get(self, archive):
+        """
+        Returns the archive's fingerprint, waiting for it to be read if
+        needed. Raises any exception reading it raised.
+        """
+        position = self._positions.get(archive)
+        if position is None:
+            return datman.fingerprint.get_archive_fingerprint(archive)
+        self._schedule(position)
+        result = self._results[archive]
+        while not result.ready():
+            # A timeout keeps the wait interruptible with ctrl-c
+            result.wait(1)
+        return result.get()
+
+    def _schedule(self, position):
+        """Start reading every archive up to lookahead past position"""
+        with self._lock:
+            end = min(position + self.lookahead + 1, len(self.archives))
+            for archive in self.archives[self._scheduled:end]:
+                self._results[archive] = self._pool.apply_async(
+                        datman.fingerprint.get_archive_fingerprint,
+                        (archive,))
+            self._scheduled = max(self._scheduled, end)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def get_fingerprint(archive):
+    """Returns an archive's fingerprint, from the scanner if one is running"""
+    if scanner:
+        return scanner.get(archive)
+    return datman.fingerprint.get_archive_fingerprint(archive)
+
+
+def get_queue(archives, progress):
+    """
+    Returns the archives that the datman.pipeline.ProgressRecord doesnt list
+    as completed, those left pending by an interrupted run first, and queues
+    them in the record. Pending entries for archives that have since changed
+    or been removed are dropped from the record.
+    """
+    names = dict((get_job_name(archive), archive) for archive in archives)
+    if archives:
+        folder = os.path.dirname(archives[0])
+        progress.unqueue([name for name in progress.pending
+                          if name not in names and
+                          is_stale_job(name, folder)])
+    queue = [name for name in progress.pending if name in names]
+    queue.extend(name for name in sorted(names, key=lambda n: names[n])
+                 if name not in queue and not progress.is_completed(name))
+    progress.queue(queue)
+    return [names[name] for name in queue]
+
+
+def get_job_name(archive):
+    """
+    Names an archive in the resume file. The name includes the archive's size
+    and modification time so that a changed archive is uploaded again.
+    """
+    try:
+        stat = os.stat(archive)
+    except OSError:
+        return os.path.basename(archive)
+    return '{}:{}:{}'.format(os.path.basename(archive), stat.st_size,
+                             int(stat.st_mtime))
+
+
+def is_stale_job(job_name, folder):
+    """
+    Returns True if the archive in folder that a job (see get_job_name) was
+    named for has changed or been removed since.
+    """
+    archive = os.path.join(folder, job_name.rsplit(':', 2)[0])
+    return get_job_name(archive) != job_name
+
+
+def get_project(archivefile):
+    """
+    Returns the XNAT project an archive will be uploaded to, or None if it
+    can't be found (process_archive will log why)
+    """
+    archivefile = os.path.basename(archivefile)
+    scanid = archivefile[:-len(datman.utils.get_extension(archivefile))]
+    try:
+        ident = datman.scanid.parse(scanid)
+        return CFG.get_key('XNAT_Archive', site=ident.site)
+    except Exception:
+        return None
+
+
+def run_archive(job, progress=None):
+    """
+    Upload an archive and, if given a datman.pipeline.ProgressRecord, note
+    whether it succeeded. Returns True if everything was uploaded.
+    """
+    archivefile = job[1]
+    try:
+        succeeded = process_archive(archivefile)
+    except Exception as e:
+        logger.error('Failed processing archive: {}. Reason: {}'.format(
+                archivefile, e))
+        succeeded, reason = False, str(e)
+    else:
+        reason = None if succeeded else 'See the log for details'
+    if progress:
+        progress.add(get_job_name(archivefile), succeeded, reason)
+    return succeeded
+
+
 def process_archive(archivefile):
-    """Upload data from a zip archive to the xnat server"""
+    """
+    Upload data from a zip archive to the xnat server. Returns True if
+    xnat holds all of its data afterwards.
+    """
     scanid = get_scanid(os.path.basename(archivefile))
     if not scanid:
-        return
+        return False
 
     xnat_session = get_xnat_session(scanid)
     if not xnat_session:
         # failed to get xnat info
-        return
+        return False
 
     try:
         data_exists, resource_exists = check_files_exist(archivefile, xnat_session)
     except Exception as e:
         logger.error('Failed checking xnat for session: {}'.format(scanid))
-        return
+        return False
 
+    succeeded = True
     if not data_exists:
         logger.info('Uploading dicoms from: {}'.format(archivefile))
         try:
@@ -144,14 +343,21 @@ def process_archive(archivefile):
                          ' for subject: {}. Check Prearchive.'
                          .format(xnat_session.project, str(scanid)))
             logger.info('Upload failed with reason: {}'.format(str(e)))
+            succeeded = False
 
     if not resource_exists:
         logger.debug('Uploading resource from: {}'.format(archivefile))
         try:
-            upload_non_dicom_data(archivefile, xnat_session.project, str(scanid))
+            uploaded = upload_non_dicom_data(archivefile, xnat_session.project,
+                                             str(scanid))
         except Exception as e:
             logger.debug('An exception occurred: {}'.format(e))
-            pass
+            succeeded = False
+        else:
+            resources = get_fingerprint(archivefile)['resources']
+            succeeded = succeeded and len(uploaded) == len(resources)
+
+    return succeeded
 
 
 def get_xnat_session(ident):
@@ -205,14 +411,15 @@ def get_scanid(archivefile):
     return(ident)
 
 
-def resource_data_exists(xnat_session, archive):
+def resource_data_exists(xnat_session, fingerprint):
     xnat_resources = xnat_session.get_resources(XNAT)
-    with zipfile.ZipFile(archive) as zf:
-        local_resources = datman.utils.get_resources(zf)
-        local_resources_mod = [item for item in local_resources if zf.read(item)]
-    empty_files = list(set(local_resources) - set(local_resources_mod))
+    local_resources = fingerprint['resources']
+    empty_files = [item for item in local_resources
+                   if not local_resources[item]['size']]
     if empty_files:
         logger.warn("Cannot upload empty resource files {}, omitting.".format(', '.join(empty_files)))
+    local_resources_mod = [item for item in local_resources
+                           if local_resources[item]['size']]
     # paths in xnat are url encoded. Need to fix local paths to match
     local_resources_mod = [urllib.pathname2url(p) for p in local_resources_mod]
     if not set(local_resources_mod).issubset(set(xnat_resources)):
@@ -221,8 +428,10 @@ def resource_data_exists(xnat_session, archive):
 
 
 def scan_data_exists(xnat_session, local_headers):
-    local_scan_uids = [scan.SeriesInstanceUID for scan in local_headers.values()]
-    local_experiment_ids = [v.StudyInstanceUID for v in local_headers.values()]
+    local_scan_uids = [scan['SeriesInstanceUID']
+                       for scan in local_headers.values()]
+    local_experiment_ids = [v['StudyInstanceUID']
+                            for v in local_headers.values()]
 
     if len(set(local_experiment_ids)) > 1:
         raise ValueError('More than one experiment UID found - '
@@ -247,36 +456,41 @@ def check_files_exist(archive, xnat_session):
     If the session UIDs don't match raises a warning"""
     logger.info('Checking {} contents on xnat'.format(xnat_session.name))
     try:
-        local_headers = datman.utils.get_archive_headers(archive)
-    except:
-        logger.error('Failed getting zip file headers for: {}'.format(archive))
+        fingerprint = get_fingerprint(archive)
+    except Exception as e:
+        logger.error('Failed getting zip file headers for: {}. Reason: '
+                     '{}'.format(archive, e))
         return False, False
 
     if not xnat_session.scans:
         return False, False
 
     try:
-        scans_exist = scan_data_exists(xnat_session, local_headers)
+        scans_exist = scan_data_exists(xnat_session, fingerprint['series'])
     except ValueError as e:
         logger.error("Please check {}: {}".format(archive, e.message))
         # Return true for both to prevent XNAT being modified
         return True, True
 
-    resources_exist = resource_data_exists(xnat_session, archive)
+    resources_exist = resource_data_exists(xnat_session, fingerprint)
 
     return scans_exist, resources_exist
 
 
 def upload_non_dicom_data(archive, xnat_project, scanid):
-    with zipfile.ZipFile(archive) as zf:
-        resource_files = datman.utils.get_resources(zf)
+    # The fingerprint was cached by check_files_exist, so this avoids reading
+    # the archive again to find the resources
+    resource_files = sorted(get_fingerprint(archive)['resources'])
+    with zipfile.ZipFile(archive) as zf, XNAT.upload_batch():
         logger.info("Uploading {} files of non-dicom data..."
                     .format(len(resource_files)))
         uploaded_files = []
         for item in resource_files:
             # convert to HTTP language
             try:
-                contents = zf.read(item)
+                # Stream the file straight out of the zip rather than reading
+                # it all into memory first
+                contents = functools.partial(zf.open, item)
                 # By default files are placed in a MISC subfolder
                 # if this is changed it may require changes to
                 # check_duplicate_resources()
@@ -285,7 +499,8 @@ def upload_non_dicom_data(archive, xnat_project, scanid):
                                   scanid,
                                   item,
                                   contents,
-                                  'MISC')
+                                  'MISC',
+                                  size=zf.getinfo(item).file_size)
                 uploaded_files.append(item)
             except Exception as e:
                 logger.error("Failed uploading file {} with error:{}"
@@ -322,32 +537,27 @@ def contains_niftis(archive):
 
 def strip_niftis(archive, temp):
     """
-    Extract the everything except niftis to temp folder, rezip, and then return the
-    path to this temporary zip for upload
+    Copy everything except niftis to a new zip in the temp folder and return
+    the path to this temporary zip for upload. The members kept are copied
+    without being unzipped and zipped again.
     """
-    unzip_dest = datman.utils.define_folder(os.path.join(temp, 'extracted'))
     with zipfile.ZipFile(archive) as zf:
         archive_files = zf.namelist()
-        niftis = find_niftis(archive_files)
-        # Find and purge associated files too (e.g. .bvec and .bval), so they
-        # only appear in resources alongside their niftis
-        nifti_names = [datman.utils.splitext(os.path.basename(nii))[0] for nii in
-                       niftis]
-        deletable_files = filter(lambda x: datman.utils.splitext(
-                os.path.basename(x))[0] in nifti_names, archive_files)
-        non_niftis = filter(lambda x: x not in deletable_files, archive_files)
-
-        #Check if any dicoms exist at all
-        non_niftis_or_paths = [i for i in non_niftis if not os.path.basename(i) == '']
-
-        if not non_niftis_or_paths:
-            return []
-        else:
-            for item in non_niftis:
-                zf.extract(item, unzip_dest)
+    niftis = find_niftis(archive_files)
+    # Find and purge associated files too (e.g. .bvec and .bval), so they
+    # only appear in resources alongside their niftis
+    nifti_names = set(datman.utils.splitext(os.path.basename(nii))[0]
+                      for nii in niftis)
+    keep = set(item for item in archive_files
+               if not item.endswith('/') and datman.utils.splitext(
+                       os.path.basename(item))[0] not in nifti_names)
+
+    #Check if any dicoms exist at all
+    if not keep:
+        return []
 
     temp_zip = os.path.join(temp, os.path.basename(archive))
-    datman.utils.make_zip(unzip_dest, temp_zip)
+    datman.utils.filter_zip(archive, temp_zip, lambda item: item in keep)
     return temp_zip
 
 
@@ -16,6 +16,13 @@ will be searched for the following configuration:
 These variables can be added at the project level or the site level (or both if
 a site overrides some project default).
 
+Each session's zip is restructured (if needed) into a hidden partial file in
+the destination while it downloads and renamed into place once complete. A
+hidden state file beside it (.<zip name>.state.json) records the experiment
+UID, scan UIDs and resource files (with XNAT's size and checksum for each) it
+was made from, so later runs can tell whether the session changed on XNAT
+without opening the zip.
+
 Usage:
     xnat_fetch_sessions.py [options] <project> <server> <username> <password> <destination>
     xnat_fetch_sessions.py [options] <study>
@@ -37,6 +44,8 @@ Options:
                             given site. Only relevant if <study> is given.
     -l, --log-to-server     Set whether to log to the logging server.
                             Only used if <study> is given.
+    -w, --session-workers N Number of sessions to download at once
+                            [default: 1]
     -n, --dry-run           Do nothing
     -v, --verbose
     -d, --debug
@@ -45,20 +54,33 @@ Options:
 """
 import os
 import sys
-import glob
+import json
 import shutil
 import logging
 import logging.handlers
+import tempfile
+import threading
+import contextlib
 from zipfile import ZipFile
 
 from docopt import docopt
 
 import datman.config
+import datman.fingerprint
+import datman.pipeline
 import datman.xnat
 import datman.utils
 
 DRYRUN = False
 
+# Bump this whenever the contents of a state file change so that old ones
+# are ignored
+STATE_VERSION = 1
+
+# Resources downloaded from another XNAT server can end up nested in this
+# unneeded folder. Only one found so far
+BAD_PREFIX = 'resources/MISC/'
+
 logging.basicConfig(level=logging.WARN,
         format="[%(name)s] %(levelname)s: %(message)s")
 logger = logging.getLogger(os.path.basename(__file__))
@@ -75,6 +97,7 @@ def main():
     given_site = arguments['--site']
     use_server = arguments['--log-to-server']
     DRYRUN = arguments['--dry-run']
+    workers = int(arguments['--session-workers'])
 
     if arguments['--debug']:
         logger.setLevel(logging.DEBUG)
@@ -84,8 +107,9 @@ def main():
         logger.setLevel(logging.ERROR)
 
     if not study:
-        with datman.xnat.xnat(xnat_server, username, password) as xnat:
-            get_sessions(xnat, xnat_project, destination)
+        with datman.xnat.xnat(xnat_server, username, password,
+                pool_size=max(datman.xnat.POOL_SIZE, workers)) as xnat:
+            get_sessions(xnat, xnat_project, destination, workers)
         return
 
     config = datman.config.config(study=study)
@@ -103,57 +127,254 @@ def main():
             logger.error("{}".format(e.message))
             continue
         username, password = get_credentials(credentials_file)
-        with datman.xnat.xnat(server, username, password) as xnat:
-            get_sessions(xnat, project, destination)
+        with datman.xnat.xnat(server, username, password,
+                pool_size=max(datman.xnat.POOL_SIZE, workers),
+                cache_dir=datman.xnat.get_cache_dir(config)) as xnat:
+            get_sessions(xnat, project, destination, workers)
 
-def get_sessions(xnat, xnat_project, destination):
+def get_sessions(xnat, xnat_project, destination, workers=1):
+    """
+    Download every session in the project that's missing or out of date in
+    destination, 'workers' sessions at a time.
+    """
     current_zips = os.listdir(destination)
 
     sessions_list = xnat.get_sessions(xnat_project)
-    for session_metadata in sessions_list:
-        session_name = session_metadata['label']
+    session_names = [item['label'] for item in sessions_list]
+    # Fetch the session metadata concurrently, ahead of the downloads
+    pending = [xnat.submit(xnat.get_session, xnat_project, name)
+               for name in session_names]
+
+    scheduler = datman.pipeline.Scheduler(datman.pipeline.Stage(
+            'download',
+            lambda job: fetch_session(xnat, xnat_project, destination,
+                                      current_zips, job[0], job[1]),
+            workers=workers))
+    results = scheduler.run(zip(session_names, pending))
+
+    failed = [result.job[0] for result in results if not result.succeeded]
+    if failed:
+        logger.error("Failed to fetch {} of {} sessions: {}".format(
+                len(failed), len(results), ', '.join(sorted(failed))))
+
+def fetch_session(xnat, xnat_project, destination, current_zips, session_name,
+        result):
+    """
+    Download a session if its zip is missing or out of date. 'result' holds
+    the session's metadata once it has been retrieved from XNAT. Returns True
+    unless something went wrong.
+    """
+    try:
+        session = result.get()
+    except Exception as e:
+        logger.error("Failed to get session {} from xnat. "
+                "Reason: {}".format(session_name, e.message))
+        return False
+
+    zip_name = session_name.upper() + ".zip"
+    zip_path = os.path.join(destination, zip_name)
+    if zip_name in current_zips and not update_needed(zip_path, session,
+            xnat):
+        logger.debug("All data downloaded for {}. Passing.".format(
+                session_name))
+        return True
+
+    if DRYRUN:
+        logger.info("Would have downloaded session {} from project {} to {}"
+                "".format(session_name, xnat_project, zip_path))
+        return True
+
+    with datman.utils.make_temp_directory() as temp:
         try:
-            session = xnat.get_session(xnat_project, session_name)
+            download_session(session, xnat, temp, zip_name, zip_path)
         except Exception as e:
-            logger.error("Failed to get session {} from xnat. "
-                    "Reason: {}".format(session_name, e.message))
-            continue
+            logger.error("Cant download session {}. Reason: {}".format(
+                    session_name, e))
+            return False
 
-        zip_name = session_name.upper() + ".zip"
-        zip_path = os.path.join(destination, zip_name)
-        if zip_name in current_zips and not update_needed(zip_path, session,
-                xnat):
-            logger.debug("All data downloaded for {}. Passing.".format(
-                    session_name))
-            continue
+    write_state(zip_path, session, xnat)
+    return True
 
-        if DRYRUN:
-            logger.info("Would have downloaded session {} from project {} to {}"
-                    "".format(session_name, xnat_project, zip_path))
-            return
+def download_session(session, xnat, temp, zip_name, zip_path):
+    """
+    Downloads a session's zip into temp and, while it downloads, restructures
+    it (see restructure_zip) into a hidden partial file beside zip_path. Once
+    the download is complete and matches the partial file it's renamed to
+    zip_path. Nothing is rewritten until a member under BAD_PREFIX arrives,
+    a zip without one is moved into place untouched once downloaded. If the
+    download can't be restructured as it arrives the finished download is
+    restructured instead.
+    """
+    temp_zip = os.path.join(temp, zip_name)
+    download = datman.utils.GrowingFile(temp_zip)
+    errors = []
+
+    def get_zip():
+        try:
+            session.download(xnat, temp, zip_name=zip_name)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            download.finish()
 
-        with datman.utils.make_temp_directory() as temp:
-            try:
-                temp_zip = session.download(xnat, temp, zip_name=zip_name)
-            except Exception as e:
-                logger.error("Cant download session {}. Reason: {}".format(
-                        session_name, e.message))
-                continue
-            restructure_zip(temp_zip, zip_path)
+    thread = threading.Thread(target=get_zip)
+    thread.daemon = True
+    thread.start()
 
-def update_needed(zip_file, session, xnat):
+    with partial_file(zip_path) as partial:
+        try:
+            copied = datman.utils.rewrite_zip_stream(download, partial,
+                    restructured_name,
+                    needed=lambda name: name.startswith(BAD_PREFIX),
+                    source=temp_zip)
+            streamed = copied is not None
+        except Exception as e:
+            logger.info("Cant restructure {} while it downloads, waiting for "
+                    "the download to finish. Reason: {}".format(zip_name, e))
+            streamed = False
+        while thread.is_alive():
+            # A timeout keeps the wait interruptible with ctrl-c
+            thread.join(1)
+        download.close()
+        if errors:
+            raise errors[0]
+        if (not streamed or not needs_restructure(temp_zip) or
+                not matches_download(temp_zip, partial)):
+            restructure_zip(temp_zip, partial)
+
+@contextlib.contextmanager
+def partial_file(path):
+    """
+    Gives a hidden temporary path beside 'path' to write to. It's renamed to
+    'path' if the block completes and deleted if it raises an exception, so
+    a file found at 'path' is always complete.
+    """
+    folder, name = os.path.split(path)
+    handle, partial = tempfile.mkstemp(prefix='.{}.'.format(name),
+            suffix='.part', dir=folder)
+    os.close(handle)
+    try:
+        yield partial
+        os.rename(partial, path)
+    except:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+def matches_download(temp_zip, output_zip):
+    """
+    Checks that the zip restructured as it downloaded holds everything the
+    finished download does (e.g. in case the download restarted part way).
+    """
+    with ZipFile(temp_zip) as source, ZipFile(output_zip) as output:
+        expected = sorted((restructured_name(item.filename), item.CRC,
+                           item.compress_size)
+                          for item in source.infolist()
+                          if restructured_name(item.filename))
+        found = sorted((item.filename, item.CRC, item.compress_size)
+                       for item in output.infolist())
+    return expected == found
+
+def get_state_file(zip_file):
+    folder, name = os.path.split(zip_file)
+    return os.path.join(folder, '.{}.state.json'.format(name))
+
+def read_state(zip_file):
+    """
+    Returns the state saved for a zip file, or None if there isn't one or
+    the zip has changed since it was saved.
     """
-    This checks if an update is needed the same way dm_xnat_upload does. The
-    logic is not great. A single file being deleted / truncated / corrupted
-    does not get noticed. Both of them need an update at some later date,
-    preferably to use XNAT's metadata on num of files and file size or something.
+    try:
+        with open(get_state_file(zip_file), 'r') as state_file:
+            state = json.load(state_file)
+        stat = os.stat(zip_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if (state.get('version') != STATE_VERSION or
+            state.get('size') != stat.st_size or
+            state.get('mtime') != stat.st_mtime):
+        return None
+    return state
+
+def write_state(zip_file, session, xnat):
+    """
+    Record the XNAT contents a zip file holds. Failures are only logged,
+    without a state file the next run checks the zip's contents instead.
     """
-    zip_headers = datman.utils.get_archive_headers(zip_file)
+    state_file = get_state_file(zip_file)
+    try:
+        resources = dict((item['URI'], {'size': item['size'],
+                                        'digest': item['digest']})
+                         for item in session.get_resource_files(xnat))
+        stat = os.stat(zip_file)
+        state = {'version': STATE_VERSION,
+                 'size': stat.st_size,
+                 'mtime': stat.st_mtime,
+                 'experiment_UID': session.experiment_UID,
+                 'scan_UIDs': sorted(session.scan_UIDs),
+                 'resources': resources}
+        datman.utils.write_atomic(state_file, json.dumps(
+                state, indent=2, sort_keys=True))
+    except Exception as e:
+        logger.warning("Cant save state for {}. Reason: {}".format(zip_file,
+                e))
 
+def update_needed(zip_file, session, xnat):
+    """
+    Checks if the zip is missing anything XNAT holds for the session. If the
+    zip's state file is current only XNAT's metadata needs to be compared
+    with it, otherwise the zip's contents are checked (the same way
+    dm_xnat_upload does) and, if nothing is missing, the state is saved for
+    next time.
+    """
     if not session.experiment:
         logger.error("{} does not have any experiments.".format(session.name))
         return False
 
+    state = read_state(zip_file)
+    if state is not None:
+        return state_out_of_date(zip_file, state, session, xnat)
+    return contents_out_of_date(zip_file, session, xnat)
+
+def state_out_of_date(zip_file, state, session, xnat):
+    """
+    Compares a zip's saved state with the session on XNAT. A resource file
+    counts as missing if its size or checksum on XNAT has changed.
+    """
+    if session.experiment_UID != state['experiment_UID']:
+        logger.error("Zip file experiment ID does not match xnat session of "
+                "the same name: {}".format(zip_file))
+        return False
+
+    missing = set(session.scan_UIDs) - set(state['scan_UIDs'])
+    for item in session.get_resource_files(xnat):
+        saved = state['resources'].get(item['URI'])
+        if (saved is None or
+                changed(saved['size'], item['size']) or
+                changed(saved['digest'], item['digest'])):
+            missing.add(item['URI'])
+
+    if missing:
+        logger.error("Some of XNAT contents for {} is missing from file system. "
+                "Zip file will be deleted and recreated".format(session.name))
+        return True
+    return False
+
+def changed(saved, current):
+    """Values XNAT didnt record (None) are never counted as changes"""
+    return saved is not None and current is not None and saved != current
+
+def contents_out_of_date(zip_file, session, xnat):
+    """
+    The check used for zips without a state file. The logic is not great. A
+    single file being deleted / truncated / corrupted does not get noticed.
+    If nothing is missing the zip's state is saved, so the next check only
+    needs XNAT's metadata. Nothing is saved during a dry run.
+    """
+    fingerprint = datman.fingerprint.get_archive_fingerprint(
+            zip_file, update_cache=not DRYRUN)
+    zip_headers = fingerprint['series']
+
     zip_experiment_ids = get_experiment_ids(zip_headers)
     if len(set(zip_experiment_ids)) > 1:
         logger.error("Zip file contains more than one experiment: "
@@ -166,7 +387,7 @@ def update_needed(zip_file, session, xnat):
         return False
 
     zip_scan_uids = get_scan_uids(zip_headers)
-    zip_resources = get_resources(zip_file)
+    zip_resources = list(fingerprint['resources'])
     xnat_resources = session.get_resources(xnat)
 
     if not files_downloaded(zip_resources, xnat_resources) or not files_downloaded(
@@ -175,18 +396,19 @@ def update_needed(zip_file, session, xnat):
                 "Zip file will be deleted and recreated".format(session.name))
         return True
 
+    if not DRYRUN:
+        write_state(zip_file, session, xnat)
     return False
 
 def get_experiment_ids(zip_file_headers):
-    return [scan.StudyInstanceUID for scan in zip_file_headers.values()]
+    return [scan['StudyInstanceUID'] for scan in zip_file_headers.values()]
 
 def get_scan_uids(zip_file_headers):
-    return [scan.SeriesInstanceUID for scan in zip_file_headers.values()]
+    return [scan['SeriesInstanceUID'] for scan in zip_file_headers.values()]
 
 def get_resources(zip_file):
-    with ZipFile(zip_file) as zf:
-        zip_resources = datman.utils.get_resources(zf)
-    return zip_resources
+    return list(datman.fingerprint.get_archive_fingerprint(
+            zip_file, update_cache=not DRYRUN)['resources'])
 
 def files_downloaded(local_list, remote_list):
     # If given paths, need to strip them
@@ -254,55 +476,40 @@ def restructure_zip(temp_zip, output_zip):
     """
     Folder structure is apparently meaningful for the resources of some studies,
     but download from another XNAT server can leave the resources nested inside
-    unneeded folders.
+    unneeded folders. Members are renamed (see restructured_name) while their
+    compressed data is copied, so the zip is never unpacked.
     """
-    # Only one found so far
-    bad_prefix = 'resources/MISC/'
-
-    temp_path, _ = os.path.split(temp_zip)
-    extract_dir = datman.utils.define_folder(os.path.join(temp_path, "extracted"))
-
-    with ZipFile(temp_zip, 'r') as zip_handle:
-        if not bad_folders_exist(zip_handle, bad_prefix):
-            # No work to do, move downloaded zip and return
-            move(temp_zip, output_zip)
-            return
-        zip_handle.extractall(extract_dir)
-
-    for item in glob.glob(os.path.join(extract_dir, bad_prefix, "*")):
-        move(item, extract_dir)
-
-    remove_snapshots(extract_dir)
-    remove_empty_dirs(extract_dir)
-    datman.utils.make_zip(extract_dir, output_zip)
-
-def bad_folders_exist(zip_handle, prefix):
-    for item in zip_handle.namelist():
-        if item.startswith(prefix):
-            return True
-    return False
+    if not needs_restructure(temp_zip):
+        # No work to do, move downloaded zip and return
+        shutil.move(temp_zip, output_zip)
+        return
+
+    datman.utils.rewrite_zip(temp_zip, output_zip, restructured_name)
 
-def remove_snapshots(base_dir):
+def needs_restructure(zip_file):
     """
-    Snapshots arent needed for anything but get pulled down for every series
-    when they exist.
+    Returns True if a zip has resources nested in BAD_PREFIX. Only these zips
+    are restructured, any other zip (snapshots included) is kept as is.
     """
-    for cur_path, folders, files in os.walk(base_dir):
-        if folders and 'SNAPSHOTS' in folders:
-            shutil.rmtree(os.path.join(cur_path, 'SNAPSHOTS'))
-
-def remove_empty_dirs(base_dir):
-    empty_dir = os.path.join(base_dir, 'resources')
-    try:
-        shutil.rmtree(empty_dir)
-    except OSError as e:
-        logger.info("Cant delete {}. Reason: {}".format(empty_dir, e.message))
+    with ZipFile(zip_file, 'r') as zip_handle:
+        return any(name.startswith(BAD_PREFIX)
+                   for name in zip_handle.namelist())
 
-def move(source, dest):
-    try:
-        shutil.move(source, dest)
-    except Exception as e:
-        logger.error("Couldnt move {} to destination {}".format(source, dest))
+def restructured_name(name):
+    """
+    Returns the name a member of a zip that needs restructuring (see
+    needs_restructure) gets in the restructured zip, or None if it's left
+    out. Resources are moved out of BAD_PREFIX, snapshots are dropped (they
+    arent needed for anything but get pulled down for every series when they
+    exist) and so are folder entries.
+    """
+    if name.endswith('/'):
+        return None
+    if name.startswith(BAD_PREFIX):
+        name = name[len(BAD_PREFIX):]
+    if 'SNAPSHOTS' in name.split('/')[:-1]:
+        return None
+    return name
 
 if __name__ == "__main__":
     main()
@@ -11,6 +11,7 @@ These can both be overridden at __init__
 from future.utils import iteritems
 import logging
 import os
+import re
 import wrapt
 import inspect
 
@@ -51,6 +52,8 @@ class config(object):
     install_config = None
     study_name = None
     study_config_file = None
+    study_config_path = None
+    _site_tag_map = None
 
     def __init__(self, filename=None, system=None, study=None):
         """
@@ -199,44 +202,64 @@ class config(object):
             self.set_study(tag)
             return tag
 
-        for project in projects.keys():
-            # search each project for a match to the study tag,
-            # this loop exits as soon as a match is found.
-            logger.debug('Searching project: {}'.format(project))
-
+        project = self._get_site_tag_map().get(tag.lower())
+        if project:
+            # Hack to deal with DTI not being a unique tag :(
+            if project.upper() == 'DTI15T' or project.upper() == 'DTI3T':
+                if parts.site == 'TGH':
+                    project = 'DTI15T'
+                else:
+                    project = 'DTI3T'
             self.set_study(project)
-            site_tags = []
-
-            if 'Sites' not in self.study_config.keys():
-                logger.debug("No sites defined for {}".format(project))
-                continue
-
-            for key, site_config in self.get_key('Sites').iteritems():
-                try:
-                    add_tags = [t.lower() for t in site_config['SITE_TAGS']]
-                except KeyError:
-                    add_tags = []
-                site_tags.extend(add_tags)
-
-            site_tags.append(self.study_config['STUDY_TAG'].lower())
-
-            if tag.lower() in site_tags:
-                # Hack to deal with DTI not being a unique tag :(
-                if project.upper() == 'DTI15T' or project.upper() == 'DTI3T':
-                    if parts.site == 'TGH':
-                        project = 'DTI15T'
-                    else:
-                        project = 'DTI3T'
-                # Needs to be set here in addition to at the top of the loop in
-                # case the wrong DTI study settings were encountered
-                # for the last set_study call. Ugh.
-                self.set_study(project)
-                return project
+            return project
         # didn't find a match throw a warning
         logger.warn('Failed to find a valid project for xnat id: {}'
                     .format(tag))
         raise ValueError
 
+    def _get_site_tag_map(self):
+        """
+        Returns a dictionary mapping every (lower case) study and site tag to
+        the first project that uses it. Reading every study's config file is
+        slow, so this is only done once per config object.
+        """
+        if self._site_tag_map is not None:
+            return self._site_tag_map
+
+        # Searching changes the current study, so restore it afterwards
+        current_study = (self.study_name, self.study_config,
+                         self.study_config_path)
+
+        tag_map = {}
+        try:
+            for project in self.get_key('Projects').keys():
+                logger.debug('Searching project: {}'.format(project))
+
+                self.set_study(project)
+                site_tags = []
+
+                if 'Sites' not in self.study_config.keys():
+                    logger.debug("No sites defined for {}".format(project))
+                    continue
+
+                for key, site_config in self.get_key('Sites').iteritems():
+                    try:
+                        add_tags = [t.lower()
+                                    for t in site_config['SITE_TAGS']]
+                    except KeyError:
+                        add_tags = []
+                    site_tags.extend(add_tags)
+
+                site_tags.append(self.study_config['STUDY_TAG'].lower())
+
+                for site_tag in site_tags:
+                    tag_map.setdefault(site_tag, project)
+        finally:
+            (self.study_name, self.study_config,
+             self.study_config_path) = current_study
+        self._site_tag_map = tag_map
+        return tag_map
+
     def _search_site_conf(self, site, key):
         """
         Search a specific study's site for 'key'.
@@ -544,3 +567,62 @@ class TagInfo(object):
 
     def __repr__(self):
         return str(self.tags)
+
+
+class TagMatcher(object):
+    """
+    Matches scan details against the patterns of every tag in a
+    TagInfo.series_map. Each pattern is compiled once, when the matcher is
+    made, so one matcher can be reused for every scan from a site.
+
+    A tag's pattern is either a dictionary mapping header fields (e.g.
+    'SeriesDescription', 'ImageType') to regexes, or a regex (or list of
+    regexes) for the SeriesDescription alone. SeriesDescription patterns
+    ignore case.
+    """
+
+    def __init__(self, series_map):
+        # Maps each field to a list of (tag, compiled regex) tuples
+        self.patterns = {}
+        for tag in sorted(series_map):
+            pattern = series_map[tag]
+            if not isinstance(pattern, dict):
+                pattern = {'SeriesDescription': pattern}
+            for field, regex in iteritems(pattern):
+                if isinstance(regex, list):
+                    regex = '|'.join(regex)
+                if not isinstance(regex, (type(''), type(u''))):
+                    # Not a pattern (e.g. EchoNumber)
+                    continue
+                flags = re.IGNORECASE if field == 'SeriesDescription' else 0
+                self.patterns.setdefault(field, []).append(
+                        (tag, re.compile(regex, flags)))
+
+    def match(self, **fields):
+        """
+        Returns a (tag, field) tuple for each tag with a pattern matching
+        one of the given field values. e.g.
+
+            matcher.match(SeriesDescription='Resting State')
+        """
+        matches = []
+        for field, value in iteritems(fields):
+            for tag, regex in self.patterns.get(field, []):
+                if regex.search(value):
+                    matches.append((tag, field))
+        return matches
+
+    def search(self, field, value, tags=None):
+        """
+        Returns the tags whose pattern for field matches value, optionally
+        only checking the given tags. Raises KeyError if one of 'tags' has
+        no pattern for field.
+        """
+        if tags is not None:
+            known = set(tag for tag, _ in self.patterns.get(field, []))
+            for tag in tags:
+                if tag not in known:
+                    raise KeyError("Tag {} does not define {}".format(tag,
+                                                                      field))
+        return [tag for tag, regex in self.patterns.get(field, [])
+                if (tags is None or tag in tags) and regex.search(value)]
@@ -0,0 +1,196 @@
+"""
+Summarizes what a scan archive (zip file) contains without unpacking it.
+
+A fingerprint records the key dicom tags from one file in each series folder
+and the size and md5 sum of each resource (non-dicom) file. Only the first
+HEADER_PREFIX bytes of a dicom are read to get its tags and resource files are
+hashed a chunk at a time, so large archives never have to be held in memory.
+
+Fingerprints are cached in a hidden json file beside the archive and reused
+for as long as the archive's size and modification time are unchanged, so
+checking an archive that hasn't changed since the last run is nearly free.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import zipfile
+
+import pydicom as dcm
+
+import datman.utils
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the contents of a fingerprint change so that old cache
+# files are ignored
+VERSION = 1
+
+# The dicom tags kept for each series
+HEADER_TAGS = ['SeriesInstanceUID', 'StudyInstanceUID', 'SeriesNumber',
+               'SeriesDescription', 'PatientName']
+
+# Tags that must be found in a header before it's accepted. If a file's
+# header is bigger than HEADER_PREFIX the whole file is read instead.
+REQUIRED_TAGS = ['SeriesInstanceUID', 'StudyInstanceUID']
+
+# Elements are stored in tag order and SeriesNumber comes right after the
+# UIDs, so finding it in a prefix shows the UIDs weren't cut short.
+PREFIX_SENTINEL = 'SeriesNumber'
+
+HEADER_PREFIX = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_archive_fingerprint(archive, use_cache=True, update_cache=True):
+    """
+    Returns the fingerprint of a zip archive as a dictionary with the keys:
+
+        'series': maps each folder holding dicoms to a dictionary of the
+            HEADER_TAGS read from one of its files
+        'resources': maps the name of each non-dicom file to a dictionary
+            with its 'size' and 'md5'
+
+    The cached fingerprint is returned if the archive hasn't changed since it
+    was made. A new fingerprint is only cached if update_cache is set. May
+    raise IOError or zipfile.BadZipfile if the archive can't be read.
+    """
+    stat = os.stat(archive)
+    cache_file = get_cache_file(archive)
+
+    if use_cache:
+        fingerprint = read_cache(cache_file, stat)
+        if fingerprint:
+            logger.debug('Using cached fingerprint for {}'.format(archive))
+            return fingerprint
+
+    fingerprint = make_fingerprint(archive)
+    fingerprint.update({'version': VERSION,
+                        'size': stat.st_size,
+                        'mtime': stat.st_mtime})
+
+    if use_cache and update_cache:
+        write_cache(cache_file, fingerprint)
+    return fingerprint
+
+
+def get_cache_file(archive):
+    folder, name = os.path.split(archive)
+    return os.path.join(folder, '.{}.fingerprint.json'.format(name))
+
+
+def read_cache(cache_file, stat):
+    """
+    Returns the fingerprint saved in cache_file, or None if there isn't one
+    or it was made from a different version of the archive.
+    """
+    try:
+        with open(cache_file, 'r') as cache:
+            fingerprint = json.load(cache)
+    except (IOError, ValueError):
+        return None
+    if (fingerprint.get('version') != VERSION or
+            fingerprint.get('size') != stat.st_size or
+            fingerprint.get('mtime') != stat.st_mtime):
+        return None
+    return fingerprint
+
+
+def write_cache(cache_file, fingerprint):
+    """
+    Writes the fingerprint to a temp file and renames it into place, so a
+    reader never sees a partial cache. Failures are logged and ignored since
+    the archive folder may not be writable.
+    """
+    try:
+        datman.utils.write_atomic(cache_file, json.dumps(
+                fingerprint, indent=2, sort_keys=True))
+    except (IOError, OSError) as e:
+        logger.debug('Cant cache fingerprint at {}. Reason: {}'.format(
+                cache_file, e))
+
+
+def make_fingerprint(archive):
+    """
+    Reads the fingerprint of a zip archive. The archive is never unpacked,
+    each member is opened and read only as far as needed.
+    """
+    series = {}
+    resources = {}
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            name = info.filename
+            if name.endswith('/'):
+                continue
+            folder = os.path.dirname(name)
+            named_like_dicom = datman.utils.is_named_like_a_dicom(name)
+            if named_like_dicom and folder in series:
+                # Already have this series' header and files named like
+                # dicoms are never counted as resources
+                continue
+
+            with zf.open(info) as member:
+                prefix = member.read(132)
+                if is_dicom_prefix(prefix):
+                    if folder not in series:
+                        header = read_header(zf, info, prefix + member.read(
+                                HEADER_PREFIX - len(prefix)))
+                        if header:
+                            series[folder] = header
+                    continue
+                if named_like_dicom:
+                    continue
+                resources[name] = {'size': info.file_size,
+                                   'md5': get_md5(prefix, member)}
+    return {'series': series, 'resources': resources}
+
+
+def is_dicom_prefix(prefix):
+    """Checks for the 128 byte preamble and 'DICM' prefix of a dicom file"""
+    return len(prefix) == 132 and prefix[128:132] == b'DICM'
+
+
+def read_header(zf, info, prefix):
+    """
+    Returns a dictionary of the HEADER_TAGS found in a dicom's header, or None
+    if it can't be parsed. The header is read from prefix unless it's missing
+    any of the REQUIRED_TAGS or may have cut them short, then the whole member
+    is read instead.
+    """
+    header = parse_header(prefix)
+    if len(prefix) < info.file_size and (
+            header is None or PREFIX_SENTINEL not in header or
+            any(tag not in header for tag in REQUIRED_TAGS)):
+        header = parse_header(zf.read(info))
+    if header is None or any(tag not in header for tag in REQUIRED_TAGS):
+        logger.debug('Cant read header of {}'.format(info.filename))
+        return None
+    return header
+
+
+def parse_header(contents):
+    try:
+        dataset = dcm.read_file(io.BytesIO(contents), stop_before_pixels=True,
+                                specific_tags=HEADER_TAGS)
+    except (dcm.errors.InvalidDicomError, EOFError, ValueError, KeyError,
+            IOError, OverflowError):
+        return None
+    header = {}
+    for tag in HEADER_TAGS:
+        value = getattr(dataset, tag, None)
+        if value is None or value == '':
+            continue
+        header[tag] = int(value) if isinstance(value, int) else str(value)
+    return header
+
+
+def get_md5(prefix, member):
+    """
+    Returns the md5 sum of an open zip member, prefix is the part of it that
+    has already been read.
+    """
+    md5 = hashlib.md5(prefix)
+    for chunk in iter(lambda: member.read(CHUNK_SIZE), b''):
+        md5.update(chunk)
+    return md5.hexdigest()
@@ -0,0 +1,326 @@
+"""
+Runs a batch of jobs through a series of stages (e.g. download, extract,
+convert), each with its own pool of worker threads, so that one job's slow
+network transfer can overlap with another job's CPU heavy conversion.
+
+Example:
+
+    pipeline = datman.pipeline.Pipeline(
+            [datman.pipeline.Stage('download', download, workers=2),
+             datman.pipeline.Stage('convert', convert, workers=4)],
+            cleanup=remove_temp_files,
+            budget=datman.pipeline.DiskBudget(20 * 1024**3))
+    for job in jobs:
+        pipeline.submit(job)
+    results = pipeline.wait()
+
+The first stage is called with the submitted job and every later stage with
+whatever the stage before it returned. A stage that returns None (or raises
+an exception) ends the job early.
+
+For independent units of work that each run to completion in one call (e.g.
+whole sessions) a Scheduler runs several at once while limiting how many
+from the same group (e.g. XNAT project) run together, and a ProgressRecord
+remembers which ones finished so an interrupted run can pick up where it
+left off.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import datman.utils
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+
+class JobResult(object):
+    """
+    The outcome of a job. 'result' is the value the last stage returned, or
+    None if the job stopped early in 'failed_stage', in which case 'error'
+    holds the exception raised (if any). 'seconds' maps each stage the job
+    went through to the time it took.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.result = None
+        self.failed_stage = None
+        self.error = None
+        self.seconds = {}
+
+    @property
+    def succeeded(self):
+        return self.failed_stage is None
+
+
+class DiskBudget(object):
+    """
+    Limits the temporary disk space a pipeline's jobs use at once. Stages
+    report the space they use with add() and the pipeline's cleanup function
+    returns it with release(). While more than 'limit' bytes are in use new
+    jobs wait before starting their first stage (one job is always allowed
+    to run so that a job larger than the limit can't block forever).
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def wait(self):
+        with self._condition:
+            while self.used > 0 and self.used >= self.limit:
+                self._condition.wait(1)
+
+    def add(self, num_bytes):
+        with self._condition:
+            self.used += num_bytes
+            self.peak = max(self.peak, self.used)
+
+    def release(self, num_bytes):
+        with self._condition:
+            self.used = max(0, self.used - num_bytes)
+            self._condition.notify_all()
+
+
+class Pipeline(object):
+    """
+    See the module docstring. cleanup, if given, is called with each job
+    once it has finished, whether or not it succeeded. timings holds the
+    total seconds spent in each stage.
+    """
+
+    def __init__(self, stages, cleanup=None, budget=None):
+        self.stages = stages
+        self.cleanup = cleanup
+        self.budget = budget
+        self.results = []
+        self.timings = dict((stage.name, 0.0) for stage in stages)
+        self._pools = [ThreadPool(stage.workers) for stage in stages]
+        self._pending = 0
+        self._condition = threading.Condition()
+
+    def submit(self, job):
+        with self._condition:
+            self._pending += 1
+        self._schedule(0, JobResult(job), job)
+
+    def wait(self):
+        """Wait for every submitted job to finish and return their results"""
+        with self._condition:
+            while self._pending:
+                # A timeout keeps the wait interruptible with ctrl-c
+                self._condition.wait(1)
+        for pool in self._pools:
+            pool.close()
+            pool.join()
+        return self.results
+
+    def report(self):
+        return ', '.join('{} {:.1f}s'.format(stage.name,
+                                            self.timings[stage.name])
+                         for stage in self.stages)
+
+    def _schedule(self, num, job_result, value):
+        self._pools[num].apply_async(self._run_stage,
+                                     (num, job_result, value))
+
+    def _run_stage(self, num, job_result, value):
+        # Runs in a pool thread, where an uncaught exception would be lost
+        # and the job never finished, leaving wait() blocked forever
+        try:
+            self._advance(num, job_result, value)
+        except Exception as e:
+            stage = self.stages[num]
+            logger.error('Pipeline failed at stage {} for {}. Reason: {}'
+                         .format(stage.name, job_result.job, e))
+            job_result.error = e
+            job_result.failed_stage = stage.name
+            self._finish(job_result)
+
+    def _advance(self, num, job_result, value):
+        stage = self.stages[num]
+        if num == 0 and self.budget:
+            self.budget.wait()
+        start = time.time()
+        try:
+            result = stage.func(value)
+        except Exception as e:
+            logger.error('Stage {} failed for {}. Reason: {}'.format(
+                    stage.name, job_result.job, e))
+            job_result.error = e
+            result = None
+        elapsed = time.time() - start
+        job_result.seconds[stage.name] = elapsed
+        with self._condition:
+            self.timings[stage.name] += elapsed
+
+        if result is None:
+            job_result.failed_stage = stage.name
+            self._finish(job_result)
+        elif num == len(self.stages) - 1:
+            job_result.result = result
+            self._finish(job_result)
+        else:
+            self._schedule(num + 1, job_result, result)
+
+    def _finish(self, job_result):
+        if self.cleanup:
+            try:
+                self.cleanup(job_result.job)
+            except Exception as e:
+                logger.error('Failed cleaning up after {}. Reason: {}'.format(
+                        job_result.job, e))
+        with self._condition:
+            self.results.append(job_result)
+            self._pending -= 1
+            self._condition.notify_all()
+
+
+class Scheduler(object):
+    """
+    Runs a single stage for each of a list of jobs, up to stage.workers at
+    once. If 'group' is given (a function returning a job's group, e.g. its
+    project) no more than 'group_limit' jobs from the same group run at once,
+    jobs from other groups are started instead of waiting. A job fails if
+    the stage raises an exception or returns a false value.
+    """
+
+    def __init__(self, stage, group=None, group_limit=None):
+        self.stage = stage
+        self.group = group or (lambda job: None)
+        self.group_limit = group_limit
+        self.running = {}
+        self._condition = threading.Condition()
+
+    def run(self, jobs):
+        """Run every job and return a list of their JobResults"""
+        pending = list(jobs)
+        results = []
+        pool = ThreadPool(self.stage.workers)
+        try:
+            with self._condition:
+                while pending or any(self.running.values()):
+                    job = self._next_job(pending)
+                    if job is None:
+                        # A timeout keeps the wait interruptible with ctrl-c
+                        self._condition.wait(1)
+                        continue
+                    group = self.group(job)
+                    self.running[group] = self.running.get(group, 0) + 1
+                    pool.apply_async(self._run_job, (job, group, results))
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def _next_job(self, pending):
+        if sum(self.running.values()) >= self.stage.workers:
+            return None
+        for num, job in enumerate(pending):
+            if (self.group_limit is None or
+                    self.running.get(self.group(job), 0) < self.group_limit):
+                return pending.pop(num)
+        return None
+
+    def _run_job(self, job, group, results):
+        job_result = JobResult(job)
+        start = time.time()
+        try:
+            result = self.stage.func(job)
+        except Exception as e:
+            logger.error('Stage {} failed for {}. Reason: {}'.format(
+                    self.stage.name, job, e))
+            job_result.error = e
+            result = None
+        job_result.seconds[self.stage.name] = time.time() - start
+        if result:
+            job_result.result = result
+        else:
+            job_result.failed_stage = self.stage.name
+        with self._condition:
+            results.append(job_result)
+            self.running[group] -= 1
+            self._condition.notify_all()
+
+
+class ProgressRecord(object):
+    """
+    A json file listing the jobs that completed and the ones that failed
+    (with the reason, if known). It's rewritten after every change so that
+    if a run is interrupted the next one can skip the completed jobs. Jobs
+    are identified by name, which must be a string.
+
+    Jobs can also be queued, they stay pending (in the order queued) until
+    they're added, so a run interrupted part way through a batch can start
+    again with the jobs it hadn't finished.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self.failed = {}
+        self.pending = []
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as record:
+                contents = json.load(record)
+        except (IOError, ValueError) as e:
+            logger.warning('Ignoring unreadable progress record {}. '
+                           'Reason: {}'.format(path, e))
+            return
+        self.completed = set(contents.get('completed', []))
+        self.failed = contents.get('failed', {})
+        self.pending = contents.get('pending', [])
+
+    def is_completed(self, name):
+        return name in self.completed
+
+    def queue(self, names):
+        """Mark jobs as pending, after any that are pending already"""
+        with self._lock:
+            self.pending.extend(name for name in names
+                                if name not in self.pending)
+            self._save()
+
+    def unqueue(self, names):
+        """Stop listing jobs as pending, e.g. ones that can no longer run"""
+        with self._lock:
+            remaining = [name for name in self.pending if name not in names]
+            if remaining == self.pending:
+                return
+            self.pending = remaining
+            self._save()
+
+    def add(self, name, succeeded, reason=None):
+        with self._lock:
+            if name in self.pending:
+                self.pending.remove(name)
+            if succeeded:
+                self.completed.add(name)
+                self.failed.pop(name, None)
+            else:
+                self.completed.discard(name)
+                self.failed[name] = reason
+            self._save()
+
+    def _save(self):
+        contents = json.dumps({'completed': sorted(self.completed),
+                               'failed': self.failed,
+                               'pending': self.pending},
+                              indent=2, sort_keys=True)
+        datman.utils.write_atomic(self.path, contents)
@@ -13,6 +13,9 @@ import random
 import time
 import tempfile
 import shutil
+import struct
+import threading
+import zlib
 import contextlib
 import subprocess as proc
 
@@ -882,6 +885,35 @@ def make_temp_directory(suffix='', prefix='tmp', path=None):
         shutil.rmtree(temp_dir)
 
 
+def write_atomic(path, data):
+    """
+    Write data (text or bytes) to path so that other processes only ever see
+    the old or the new file and never a partial one. Missing parent folders
+    are made.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    handle, temp_path = tempfile.mkstemp(dir=folder or None, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as temp_file:
+        temp_file.write(data)
+    os.rename(temp_path, path)
+
+
+def get_folder_size(path):
+    """Returns the total size in bytes of the files under path"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
 def remove_empty_files(path):
     for root, dirs, files in os.walk(path):
         for f in files:
@@ -1171,4 +1203,412 @@ def make_zip(source_dir, dest_zip):
                 archive_path = item_path.replace(source_dir + "/", "")
                 zip_handle.write(item_path, archive_path)
 
+
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+
+def filter_zip(source_zip, dest_zip, keep):
+    """
+    Writes the members of source_zip for which keep(name) is True to
+    dest_zip. Each member's compressed data is copied as is, so nothing is
+    decompressed, written to disk unzipped or compressed again. Returns the
+    names of the members copied.
+    """
+    return rewrite_zip(source_zip, dest_zip,
+                       lambda name: name if keep(name) else None)
+
+
+def rewrite_zip(source_zip, dest_zip, rename):
+    """
+    Copies the members of source_zip to dest_zip without decompressing them.
+    rename(name) returns the name each member is given in dest_zip, or None
+    to leave it out. Returns the new names of the members copied.
+    """
+    copied = []
+    with zipfile.ZipFile(source_zip) as source, \
+            zipfile.ZipFile(dest_zip, 'w', allowZip64=True) as dest:
+        for info in source.infolist():
+            name = rename(info.filename)
+            if name is None:
+                continue
+            copy_zip_member(source, dest, info, name=name)
+            copied.append(name)
+    return copied
+
+
+def rewrite_zip_stream(stream, dest_zip, rename, needed=None, source=None):
+    """
+    Like rewrite_zip, but the source zip is read front to back from a file
+    object (e.g. a download that's still in progress, see GrowingFile) using
+    the header in front of each member instead of the central directory at
+    the end. Raises zipfile.BadZipfile if the stream can't be followed, which
+    is the case for members stored uncompressed without their sizes.
+
+    If needed(name) is given nothing is written until a member it's True for
+    is found. The members before it are then copied from 'source', the path
+    of the file the stream reads. Returns None, without writing dest_zip, if
+    no member was needed.
+    """
+    copied = []
+    skipped = []
+    dest = None
+    if not needed:
+        dest = zipfile.ZipFile(dest_zip, 'w', allowZip64=True)
+    try:
+        for info, chunks in iter_zip_stream(stream):
+            if dest is None:
+                if not needed(info.filename):
+                    skipped.append(info)
+                    continue
+                dest = zipfile.ZipFile(dest_zip, 'w', allowZip64=True)
+                if skipped:
+                    copied.extend(_copy_skipped_members(source, dest, skipped,
+                                                        rename))
+            name = rename(info.filename)
+            if name is None:
+                continue
+            zip64 = None
+            if info.flag_bits & 0x08:
+                # The sizes aren't known until the data has been read, so the
+                # header is rewritten after and mustn't change length
+                zip64 = _has_zip64_extra(info.extra)
+            _write_zip_member(dest, info, chunks, name=name, zip64=zip64)
+            copied.append(name)
+    finally:
+        if dest is not None:
+            dest.close()
+    if dest is None:
+        return None
+    return copied
+
+
+def _copy_skipped_members(source_path, dest, members, rename):
+    copied = []
+    with open(source_path, 'rb') as source:
+        for info in members:
+            name = rename(info.filename)
+            if name is None:
+                continue
+            _copy_local_member(source, dest, info, name, source_path)
+            copied.append(name)
+    return copied
+
+
+def copy_zip_member(source, dest, info, name=None):
+    """
+    Copies the member described by the ZipInfo 'info' from the open zipfile
+    'source' to the end of 'dest' (a zipfile open for writing) without
+    decompressing it. The copy can be given a new name.
+    """
+    _copy_local_member(source.fp, dest, info, name, source.filename)
+
+
+def _copy_local_member(source_file, dest, info, name, source_name):
+    """
+    Copies a member from the open file source_file, starting at the local
+    header at info.header_offset. info must hold the member's real sizes.
+    """
+    source_file.seek(info.header_offset)
+    header = source_file.read(zipfile.sizeFileHeader)
+    if (len(header) != zipfile.sizeFileHeader or
+            header[0:4] != zipfile.stringFileHeader):
+        raise zipfile.BadZipfile('Bad local file header for {} in {}'.format(
+                info.filename, source_name))
+    header = struct.unpack(zipfile.structFileHeader, header)
+    # Skip the local header's name and extra field to reach the data
+    source_file.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                     header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    _write_zip_member(dest, info, _read_zip_data(source_file, info),
+                      name=name)
+
+
+def iter_zip_stream(stream):
+    """
+    Reads the members of a zip file front to back from a file object that
+    can't seek. Yields a (ZipInfo, chunks) pair for each member, where chunks
+    iterates over its compressed data. Unused chunks are skipped before the
+    next member is read.
+
+    Members written with a data descriptor (flag bit 3) don't record their
+    sizes up front. For these the end of the data is found by inflating it
+    (in memory only) and the ZipInfo's CRC and sizes are filled in once its
+    chunks have all been read. Uncompressed members with a data descriptor
+    can't be followed unless they're empty, zipfile.BadZipfile is raised for
+    the rest.
+    """
+    reader = _StreamReader(stream)
+    while True:
+        header_offset = reader.position
+        signature = reader.read_exact(4, allow_eof=True)
+        if signature != zipfile.stringFileHeader:
+            if signature and signature[:2] != b'PK':
+                raise zipfile.BadZipfile('Not a zip member header')
+            # The central directory (or the end of the stream) follows the
+            # last member
+            return
+        header = struct.unpack(zipfile.structFileHeader, signature +
+                               reader.read_exact(zipfile.sizeFileHeader - 4))
+        info = _read_local_header(reader, header)
+        info.header_offset = header_offset
+        if not info.flag_bits & 0x08:
+            chunks = _read_zip_data(reader, info)
+        elif info.compress_type == zipfile.ZIP_DEFLATED:
+            chunks = _read_deflated_zip_data(reader, info)
+        else:
+            chunks = _read_empty_zip_data(reader, info)
+        yield info, chunks
+        for _ in chunks:
+            pass
+
+
+class GrowingFile(object):
+    """
+    A read only file object for a file that's still being written, e.g. a
+    download in progress. read() waits for more data to arrive until finish()
+    is called, after which the end of the file is the end of the data.
+    Raises IOError if the file gets shorter (e.g. a download restarted).
+    """
+
+    def __init__(self, path, poll_interval=0.1):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._finished = threading.Event()
+        self._file = None
+        self._position = 0
+
+    def finish(self):
+        self._finished.set()
+
+    def read(self, size=ZIP_CHUNK_SIZE):
+        while True:
+            # Checked before reading, so nothing written after the last check
+            # is missed
+            finished = self._finished.is_set()
+            if self._file is None and os.path.exists(self.path):
+                # Not the builtin open(), in python 2 its files stop reading
+                # once they've reached the end, even if the file grows
+                self._file = io.open(self.path, 'rb', buffering=0)
+            if self._file is not None:
+                if os.path.getsize(self.path) < self._position:
+                    raise IOError('{} was truncated while being '
+                                  'read'.format(self.path))
+                data = self._file.read(size)
+                if data:
+                    self._position += len(data)
+                    return data
+            if finished:
+                return b''
+            self._finished.wait(self.poll_interval)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _StreamReader(object):
+    """Reads exact amounts from a stream, with a buffer for unread data"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        # Bytes used from the stream so far
+        self.position = 0
+        self._buffer = b''
+
+    def read(self, size):
+        if self._buffer:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        else:
+            data = self.stream.read(size)
+        self.position += len(data)
+        return data
+
+    def read_exact(self, size, allow_eof=False):
+        data = b''
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                if allow_eof and not data:
+                    return data
+                raise zipfile.BadZipfile('Zip stream ended unexpectedly')
+            data += chunk
+        return data
+
+    def unread(self, data):
+        self._buffer = data + self._buffer
+        self.position -= len(data)
+
+
+def _read_local_header(reader, header):
+    name = reader.read_exact(header[zipfile._FH_FILENAME_LENGTH])
+    extra = reader.read_exact(header[zipfile._FH_EXTRA_FIELD_LENGTH])
+    flag_bits = header[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS]
+    if flag_bits & 0x800:
+        name = name.decode('utf-8')
+    date = header[zipfile._FH_LAST_MOD_DATE]
+    mod_time = header[zipfile._FH_LAST_MOD_TIME]
+    info = zipfile.ZipInfo(name, ((date >> 9) + 1980, (date >> 5) & 0xF,
+                                  date & 0x1F, mod_time >> 11,
+                                  (mod_time >> 5) & 0x3F,
+                                  (mod_time & 0x1F) * 2))
+    info.flag_bits = flag_bits
+    info.compress_type = header[zipfile._FH_COMPRESSION_METHOD]
+    info.extract_version = header[zipfile._FH_EXTRACT_VERSION]
+    info.CRC = header[zipfile._FH_CRC]
+    info.compress_size = header[zipfile._FH_COMPRESSED_SIZE]
+    info.file_size = header[zipfile._FH_UNCOMPRESSED_SIZE]
+    info.extra = extra
+    if not flag_bits & 0x08 and 0xFFFFFFFF in (info.file_size,
+                                               info.compress_size):
+        # The real sizes are in the zip64 record, uncompressed size first
+        record = _get_zip64_extra(extra)
+        if len(record) < 16:
+            raise zipfile.BadZipfile('Missing zip64 sizes for {}'.format(
+                    name))
+        info.file_size, info.compress_size = struct.unpack('<QQ', record[:16])
+    return info
+
+
+def _read_zip_data(stream, info):
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = stream.read(min(remaining, ZIP_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipfile('{} is truncated'.format(info.filename))
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _read_deflated_zip_data(reader, info):
+    """
+    Yields the compressed data of a member followed by a data descriptor,
+    finding its end by inflating it. The inflated data is only used to check
+    the CRC.
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    file_size = 0
+    compress_size = 0
+    while not decompressor.unused_data:
+        chunk = reader.read(64 * 1024)
+        if not chunk:
+            raise zipfile.BadZipfile('{} is truncated'.format(info.filename))
+        data = chunk
+        while data:
+            # Inflate a bit at a time, a small chunk of compressed data can
+            # hold a lot of uncompressed data
+            output = decompressor.decompress(data, ZIP_CHUNK_SIZE)
+            crc = zlib.crc32(output, crc)
+            file_size += len(output)
+            data = decompressor.unconsumed_tail
+        used = len(chunk) - len(decompressor.unused_data)
+        compress_size += used
+        if used:
+            yield chunk[:used]
+    output = decompressor.flush()
+    crc = zlib.crc32(output, crc)
+    file_size += len(output)
+    reader.unread(decompressor.unused_data)
+    _read_zip_descriptor(reader, info, crc, compress_size, file_size)
+
+
+def _read_empty_zip_data(reader, info):
+    """
+    Checks that an uncompressed member with a data descriptor is empty,
+    there's no way to find the end of its data otherwise.
+    """
+    _read_zip_descriptor(reader, info, 0, 0, 0)
+    # Makes this a generator, like the other readers
+    return
+    yield
+
+
+def _read_zip_descriptor(reader, info, crc, compress_size, file_size):
+    """
+    Reads the data descriptor after a member's data into its ZipInfo and
+    checks it matches the CRC and sizes found while reading the data.
+    """
+    # The descriptor's signature is optional
+    descriptor = reader.read_exact(4)
+    if descriptor == b'PK\x07\x08':
+        descriptor = reader.read_exact(4)
+    if _has_zip64_extra(info.extra):
+        sizes = struct.unpack('<QQ', reader.read_exact(16))
+    else:
+        sizes = struct.unpack('<LL', reader.read_exact(8))
+    info.CRC = struct.unpack('<L', descriptor)[0]
+    info.compress_size, info.file_size = sizes
+    if (info.CRC != crc & 0xFFFFFFFF or info.compress_size != compress_size or
+            info.file_size != file_size):
+        raise zipfile.BadZipfile("Can't find the end of {} or its data "
+                                 "descriptor doesnt match".format(
+                                         info.filename))
+
+
+def _write_zip_member(dest, info, chunks, name=None, zip64=None):
+    """
+    Writes a member's compressed data, from the iterator 'chunks', to the
+    end of 'dest' (a zipfile open for writing). If the ZipInfo's sizes and
+    CRC aren't known until its chunks are used up (see iter_zip_stream)
+    'zip64' must say whether the member needs zip64 extensions.
+    """
+    copy = zipfile.ZipInfo(name or info.filename, info.date_time)
+    for attr in ['compress_type', 'comment', 'create_system',
+                 'create_version', 'extract_version', 'internal_attr',
+                 'external_attr']:
+        setattr(copy, attr, getattr(info, attr))
+    _copy_zip_sizes(info, copy)
+    # The sizes and CRC go in the header instead of a data descriptor after
+    # the data
+    copy.flag_bits = info.flag_bits & ~0x08
+    # zipfile adds its own zip64 record when needed
+    copy.extra = _strip_zip64_extra(info.extra)
+    copy.header_offset = dest.fp.tell()
+    dest._writecheck(copy)
+    dest._didModify = True
+
+    dest.fp.write(copy.FileHeader(zip64))
+    for chunk in chunks:
+        dest.fp.write(chunk)
+    if info.flag_bits & 0x08:
+        _copy_zip_sizes(info, copy)
+        end = dest.fp.tell()
+        dest.fp.seek(copy.header_offset)
+        dest.fp.write(copy.FileHeader(zip64))
+        dest.fp.seek(end)
+
+    dest.filelist.append(copy)
+    dest.NameToInfo[copy.filename] = copy
+
+
+def _copy_zip_sizes(source, dest):
+    for attr in ['CRC', 'compress_size', 'file_size']:
+        setattr(dest, attr, getattr(source, attr))
+
+
+def _zip_extra_records(extra):
+    """Yields the (id, bytes) of each record in a zip member's extra field"""
+    while len(extra) >= 4:
+        record_id, size = struct.unpack('<HH', extra[:4])
+        yield record_id, extra[:4 + size]
+        extra = extra[4 + size:]
+
+
+def _get_zip64_extra(extra):
+    """Returns the data of the zip64 record in an extra field, if any"""
+    for record_id, record in _zip_extra_records(extra):
+        if record_id == 1:
+            return record[4:]
+    return b''
+
+
+def _has_zip64_extra(extra):
+    return any(record_id == 1 for record_id, _ in _zip_extra_records(extra))
+
+
+def _strip_zip64_extra(extra):
+    """Removes any zip64 records from a zip member's extra field"""
+    return b''.join(record for record_id, record in _zip_extra_records(extra)
+                    if record_id != 1)
+
 # vim: ts=4 sw=4 sts=4:
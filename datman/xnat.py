@@ -6,12 +6,33 @@ import time
 import tempfile
 import os
 import urllib
+import urlparse
 import getpass
+import hashlib
+import json
+import random
+import re
+import contextlib
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+import datman.utils
 from datman.exceptions import XnatException
+from datman.config import UndefinedSetting
 from xml.etree import ElementTree
 
 logger = logging.getLogger(__name__)
 
+# Number of worker threads used by xnat.submit() and the number of connections
+# kept open to the server. The pool should be at least as large as the number
+# of workers or requests will queue up waiting for a free connection.
+MAX_WORKERS = 8
+POOL_SIZE = 16
+# Bytes read from the socket at a time when downloading files
+CHUNK_SIZE = 1024 * 1024
+# Server responses that mean a request may succeed if tried again later
+RETRY_STATUS_CODES = [502, 503, 504]
+
 def get_server(config, url=None, port=None):
     if url and not port:
         # Dont accidentally mangle user's url by appending a port from the config
@@ -59,6 +80,36 @@ def get_port_str(config, port):
 
     return port
 
+def get_cache_dir(config):
+    """
+    Returns the folder to cache xnat query results in, as set by 'XNAT_CACHE'
+    in the config files, or None if caching isn't configured.
+    """
+    try:
+        return config.get_key('XNAT_CACHE')
+    except (KeyError, UndefinedSetting):
+        logger.debug("'XNAT_CACHE' undefined in config. Xnat query results "
+                     "will not be cached.")
+        return None
+
+def get_series_cache(config):
+    """
+    Returns a SeriesCache in the folder set by 'SERIES_CACHE' in the config
+    files (limited to 'SERIES_CACHE_SIZE' GB, 50 by default), or None if it
+    isn't configured.
+    """
+    try:
+        path = config.get_key('SERIES_CACHE')
+    except (KeyError, UndefinedSetting):
+        logger.debug("'SERIES_CACHE' undefined in config. Downloaded series "
+                     "will not be cached.")
+        return None
+    try:
+        max_size = float(config.get_key('SERIES_CACHE_SIZE'))
+    except (KeyError, UndefinedSetting):
+        max_size = 50
+    return SeriesCache(path, max_size * 1024**3)
+
 def get_auth(username=None):
     if username:
         return (username, getpass.getpass())
@@ -74,17 +125,773 @@ def get_auth(username=None):
 
     return (username, password)
 
+class CacheEntry(object):
+    """A cached query result and the headers needed to revalidate it"""
+
+    def __init__(self, content, etag=None, last_modified=None, timestamp=None):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.timestamp = timestamp or time.time()
+
+    def validators(self):
+        """Headers that make a GET conditional on this entry being stale"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def is_fresh(self, max_age):
+        return time.time() - self.timestamp < max_age
+
+
+class MetadataCache(object):
+    """
+    An on-disk cache of xnat query results that can be shared by several
+    processes.
+
+    Each result is stored with the time it was retrieved and the ETag and
+    Last-Modified headers the server sent with it. Entries younger than
+    max_age seconds are used without contacting the server, older ones are
+    revalidated with a conditional request. Entries are grouped into folders
+    by server, project and session so everything known about a session can be
+    dropped with invalidate() once it's modified.
+    """
+
+    def __init__(self, path, max_age=0):
+        self.path = path
+        self.max_age = max_age
+
+    def get(self, url):
+        try:
+            with open(self._entry_path(url), 'rb') as entry_file:
+                header = json.loads(entry_file.readline())
+                content = entry_file.read()
+        except (IOError, ValueError):
+            return None
+        if header.get('url') != url:
+            return None
+        return CacheEntry(content, header.get('etag'),
+                          header.get('last_modified'), header.get('timestamp'))
+
+    def put(self, url, content, headers=None):
+        headers = headers or {}
+        entry = CacheEntry(content, headers.get('ETag'),
+                           headers.get('Last-Modified'))
+        self._write(url, entry)
+
+    def touch(self, url, entry):
+        """Record that entry was just confirmed to be up to date"""
+        entry.timestamp = time.time()
+        self._write(url, entry)
+
+    def remove(self, url):
+        self._remove_file(self._entry_path(url))
+
+    def invalidate(self, project=None, session=None):
+        """
+        Drop cached results for a session, or all results for a project if no
+        session is given, or everything if neither is given. Listings of a
+        project's contents are always dropped along with its sessions.
+        """
+        if not project:
+            self._remove_folder(self.path)
+            return
+        for server_dir in self._list_dirs(self.path):
+            project_dir = os.path.join(server_dir, _cache_name(project))
+            if not session:
+                self._remove_folder(project_dir)
+                continue
+            self._remove_folder(os.path.join(project_dir,
+                                             _cache_name(session)))
+            if not os.path.isdir(project_dir):
+                continue
+            for item in os.listdir(project_dir):
+                if item.endswith('.entry'):
+                    self._remove_file(os.path.join(project_dir, item))
+
+    def _write(self, url, entry):
+        path = self._entry_path(url)
+        header = {'url': url,
+                  'etag': entry.etag,
+                  'last_modified': entry.last_modified,
+                  'timestamp': entry.timestamp}
+        try:
+            datman.utils.write_atomic(
+                    path, json.dumps(header).encode('utf-8') + b'\n' +
+                    entry.content)
+        except (IOError, OSError) as e:
+            # The cache is only an optimization, don't fail the query over it
+            logger.debug('Failed caching result for {}. Reason: {}'.format(
+                    url, e))
+
+    def _entry_path(self, url):
+        parsed = urlparse.urlparse(url)
+        folders = [self.path, _cache_name(parsed.netloc)]
+        match = re.search(r'/projects/([^/?]+)(?:/subjects/([^/?]+))?',
+                          parsed.path)
+        if match:
+            folders.extend(_cache_name(item) for item in match.groups()
+                           if item)
+        name = hashlib.md5(url.encode('utf-8')).hexdigest() + '.entry'
+        return os.path.join(*(folders + [name]))
+
+    def _list_dirs(self, path):
+        if not os.path.isdir(path):
+            return []
+        return [os.path.join(path, item) for item in os.listdir(path)
+                if os.path.isdir(os.path.join(path, item))]
+
+    def _remove_folder(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _cache_name(name):
+    """Make a url component safe to use as a folder name"""
+    return re.sub(r'[^a-zA-Z0-9._-]', '_', name)
+
+
+class SeriesCache(object):
+    """
+    A size limited on-disk cache of downloaded (and unpacked) dicom series.
+
+    Entries are keyed by a fingerprint of the series' contents on xnat (see
+    get_series_key) so a series that changes on the server is never
+    mistaken for the cached copy. The least recently used entries are
+    removed once the cache holds more than max_size bytes. Entries are
+    hard linked out of the cache when possible, so reading one costs no
+    copying.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._sizes = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for key in os.listdir(path):
+            entry = os.path.join(path, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            self._sizes[key] = datman.utils.get_folder_size(entry)
+
+    def get(self, key, dest):
+        """
+        Copy the series stored under key into the folder dest. Returns False
+        if it isnt cached.
+        """
+        if not key or not os.path.isdir(os.path.join(self.path, key)):
+            return False
+        entry = os.path.join(self.path, key)
+        try:
+            _link_tree(entry, dest)
+            os.utime(entry, None)
+        except (IOError, OSError) as e:
+            # Possibly removed by another process part way through
+            logger.info('Failed reading cached series {}. Reason: {}'.format(
+                    key, e))
+            shutil.rmtree(dest, ignore_errors=True)
+            return False
+        logger.debug('Using cached copy of series {}'.format(key))
+        return True
+
+    def add(self, key, source):
+        """Store the contents of the folder source under key"""
+        if not key or os.path.isdir(os.path.join(self.path, key)):
+            return
+        entry = os.path.join(self.path, key)
+        temp_entry = tempfile.mkdtemp(prefix='.', dir=self.path)
+        try:
+            _link_tree(source, temp_entry)
+            os.rename(temp_entry, entry)
+        except (IOError, OSError) as e:
+            logger.info('Failed caching series {}. Reason: {}'.format(key, e))
+            shutil.rmtree(temp_entry, ignore_errors=True)
+            return
+        with self._lock:
+            self._sizes[key] = datman.utils.get_folder_size(entry)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            total = sum(self._sizes.values())
+            if total <= self.max_size:
+                return
+            entries = []
+            for key in self._sizes:
+                try:
+                    used = os.path.getmtime(os.path.join(self.path, key))
+                except OSError:
+                    used = 0
+                entries.append((used, key))
+            for _, key in sorted(entries):
+                if total <= self.max_size:
+                    break
+                logger.debug('Removing series {} from cache'.format(key))
+                shutil.rmtree(os.path.join(self.path, key),
+                              ignore_errors=True)
+                total -= self._sizes.pop(key)
+
+
+def get_series_key(uid, files):
+    """
+    Returns a cache key for a scan from its series UID and the catalog
+    entries (see xnat.get_resource_files) for its dicom files. Returns None
+    if xnat didnt record a checksum for every file.
+    """
+    if not uid or not files or not all(item['digest'] for item in files):
+        return None
+    fingerprint = hashlib.md5(uid.encode('utf-8'))
+    for item in sorted(files, key=lambda item: item['URI']):
+        fingerprint.update('{} {} {}\n'.format(item['URI'], item['size'],
+                                                item['digest'])
+                           .encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def _link_tree(source, dest):
+    """
+    Recreate the folder source at dest, hard linking the files if possible
+    and copying them if not.
+    """
+    for root, dirs, files in os.walk(source):
+        target = os.path.join(dest, os.path.relpath(root, source))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(target, name))
+            except OSError:
+                shutil.copy2(os.path.join(root, name),
+                             os.path.join(target, name))
+
+
+class SessionIndex(object):
+    """
+    Maps session labels to the xnat projects that contain them, so a session
+    can be found without listing the contents of every project.
+
+    The index is filled the first time it's needed and, if given a path,
+    saved to disk to be reused by later runs. When a lookup misses, the
+    projects being searched are re-listed (at most once every
+    refresh_interval seconds) in case the session was added since.
+    """
+
+    def __init__(self, xnat_connection, path=None, refresh_interval=60):
+        self.xnat = xnat_connection
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._projects = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def find(self, session, projects=None):
+        """
+        Returns the first project (in the order given, if projects is set)
+        that contains session, or None if it can't be found.
+        """
+        with self._lock:
+            found = self._lookup(session, projects)
+            if found:
+                return found
+            stale = self._get_stale(projects)
+            if not stale:
+                return None
+            self._refresh(None if stale == 'all' else stale)
+            return self._lookup(session, projects)
+
+    def add(self, session, project):
+        """Record a session that was just created on the server"""
+        with self._lock:
+            entry = self._projects.setdefault(project, {'updated': 0,
+                                                        'sessions': []})
+            if session not in entry['sessions']:
+                entry['sessions'].append(session)
+                self._labels.setdefault(session, []).append(project)
+                self._save()
+
+    def refresh(self, projects=None):
+        with self._lock:
+            self._refresh(projects)
+
+    def _lookup(self, session, projects):
+        found = self._labels.get(session, [])
+        if not projects:
+            return found[0] if found else None
+        for project in projects:
+            if project in found:
+                return project
+        return None
+
+    def _get_stale(self, projects):
+        """
+        Returns the projects that haven't been listed recently. If no
+        projects were given returns 'all' when the whole index is out of date.
+        """
+        now = time.time()
+        if not projects:
+            updated = [entry['updated'] for entry in self._projects.values()]
+            if not updated or now - min(updated) > self.refresh_interval:
+                return 'all'
+            return []
+        return [project for project in projects
+                if now - self._projects.get(project, {}).get('updated', 0) >
+                self.refresh_interval]
+
+    def _refresh(self, projects=None):
+        if not projects:
+            projects = [p['ID'] for p in self.xnat.get_projects()]
+            self._projects = {}
+        logger.debug('Updating session index for projects: {}'.format(
+                ', '.join(projects)))
+        listings = self.xnat.map_queries(self._list_sessions,
+                                         [(project,) for project in projects])
+        now = time.time()
+        for project, sessions in zip(projects, listings):
+            self._projects[project] = {
+                    'updated': now,
+                    'sessions': [item['label'] for item in sessions]}
+        self._build_labels()
+        self._save()
+
+    def _list_sessions(self, project):
+        try:
+            return self.xnat.get_sessions(project)
+        except XnatException as e:
+            logger.info('Cant list sessions for project {}. Reason: {}'
+                        .format(project, e))
+            return []
+
+    def _build_labels(self):
+        self._labels = {}
+        for project in sorted(self._projects):
+            for session in self._projects[project]['sessions']:
+                self._labels.setdefault(session, []).append(project)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as index_file:
+                self._projects = json.load(index_file)
+        except (IOError, ValueError) as e:
+            logger.info('Ignoring unreadable session index {}. Reason: {}'
+                        .format(self.path, e))
+            self._projects = {}
+        self._build_labels()
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            datman.utils.write_atomic(self.path,
+                                      json.dumps(self._projects))
+        except (IOError, OSError) as e:
+            logger.debug('Failed saving session index {}. Reason: {}'.format(
+                    self.path, e))
+
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed xnat request should be retried and how long to
+    wait first. One policy is shared by all of an xnat object's workers.
+
+    - Retries back off exponentially, with random jitter so that workers
+      that failed together don't all retry at the same moment.
+    - Each endpoint category (see _endpoint_category) has a retry budget.
+      Every request adds budget_ratio of a retry to it, up to a maximum
+      (budgets[category], or default_budget), and every retry spends one.
+      A category that is failing constantly therefore stops retrying
+      instead of multiplying the load on the server.
+    - After failure_threshold consecutive failures (from any worker) the
+      circuit opens and every request waits for cooldown seconds, giving
+      an overloaded server time to recover.
+    - counts records attempts, retries, failures (by reason) and budget
+      exhaustion for each category.
+    """
+
+    def __init__(self, max_retries=3, base_delay=2, max_delay=60,
+                 budgets=None, default_budget=10, budget_ratio=0.2,
+                 failure_threshold=5, cooldown=60):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.budget_ratio = budget_ratio
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.counts = {}
+        self.circuit_opened = 0
+        self._tokens = {}
+        self._consecutive_failures = 0
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+    def retry(self, category, attempt, max_retries, reason):
+        """
+        Record a failed attempt and decide whether to try again. If so,
+        sleeps for the backoff delay before returning True.
+        """
+        with self._lock:
+            counts = self._get_counts(category)
+            counts['attempts'] += 1
+            counts['failures'][str(reason)] = \
+                    counts['failures'].get(str(reason), 0) + 1
+            self._trip_breaker()
+            if attempt >= max_retries:
+                return False
+            if self._get_tokens(category) < 1:
+                counts['budget_exhausted'] += 1
+                logger.warning('Retry budget for {} requests exhausted'
+                               .format(category))
+                return False
+            self._tokens[category] -= 1
+            counts['retries'] += 1
+
+        delay = self.get_delay(attempt)
+        logger.info('xnat {} request failed ({}), retrying in {:.1f}s'
+                    .format(category, reason, delay))
+        self.sleep(delay)
+        return True
+
+    def record_success(self, category):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._get_counts(category)['attempts'] += 1
+            self._add_tokens(category)
+
+    def wait_if_open(self):
+        """Blocks while the circuit breaker is open"""
+        while True:
+            with self._lock:
+                remaining = self._open_until - time.time()
+            if remaining <= 0:
+                return
+            self.sleep(min(remaining, 5))
+
+    def get_delay(self, attempt):
+        limit = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(limit / 2.0, limit)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def summary(self):
+        """Returns a copy of the counters, safe to serialize"""
+        with self._lock:
+            summary = {'circuit_opened': self.circuit_opened,
+                       'categories': {}}
+            for category, counts in self.counts.items():
+                summary['categories'][category] = dict(
+                        counts, failures=dict(counts['failures']))
+            return summary
+
+    def _trip_breaker(self):
+        self._consecutive_failures += 1
+        if self._consecutive_failures < self.failure_threshold:
+            return
+        self._consecutive_failures = 0
+        self._open_until = time.time() + self.cooldown
+        self.circuit_opened += 1
+        logger.warning('xnat server appears to be overloaded, pausing all '
+                       'requests for {}s'.format(self.cooldown))
+
+    def _get_counts(self, category):
+        return self.counts.setdefault(category, {'attempts': 0,
+                                                 'retries': 0,
+                                                 'budget_exhausted': 0,
+                                                 'failures': {}})
+
+    def _get_tokens(self, category):
+        self._add_tokens(category)
+        return self._tokens[category]
+
+    def _add_tokens(self, category):
+        budget = self.budgets.get(category, self.default_budget)
+        if category not in self._tokens:
+            self._tokens[category] = budget
+            return
+        self._tokens[category] = min(budget,
+                                     self._tokens[category] +
+                                     self.budget_ratio)
+
+
+def _endpoint_category(method, url):
+    """Groups xnat requests by the kind of data they deal with"""
+    path = urlparse.urlparse(url).path
+    if path.endswith('/JSESSION'):
+        return 'session'
+    if '/services/import' in path:
+        return 'dicom_upload'
+    if '/files' in path:
+        if method == 'post':
+            return 'resource_upload'
+        if '/resources/DICOM/files' in path:
+            return 'dicom_download'
+        return 'file_download'
+    for category in ['resources', 'scans', 'experiments', 'subjects',
+                     'projects']:
+        if '/{}'.format(category) in path:
+            return category
+    return 'other'
+
+
+class RequestStats(object):
+    """
+    Collects timing information about every request an xnat object makes.
+
+    Requests are grouped by endpoint category (see _endpoint_category). For
+    each category the number of requests, their status codes, the retries
+    they needed, the bytes sent and received and a histogram of their
+    latency (the seconds from sending a request until the response headers
+    arrive, including any retries) are kept. File downloads also record the
+    time spent streaming the body.
+    """
+
+    # Upper bounds, in seconds, of the latency histogram's buckets. The last
+    # bucket holds everything slower.
+    buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+    def __init__(self):
+        self.started = time.time()
+        self.categories = {}
+        self._lock = threading.Lock()
+
+    def record(self, category, status, seconds, num_bytes=0, retries=0):
+        """Record a finished request. status is None if no response came."""
+        with self._lock:
+            stats = self._get_stats(category)
+            stats['requests'] += 1
+            stats['retries'] += retries
+            stats['bytes'] += num_bytes
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            status = str(status) if status else 'no response'
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            stats['histogram'][self._find_bucket(seconds)] += 1
+
+    def add_transfer(self, category, num_bytes, seconds):
+        """Record the time spent streaming a download's body"""
+        with self._lock:
+            stats = self._get_stats(category)
+            stats['bytes'] += num_bytes
+            stats['transfer_seconds'] += seconds
+
+    def summary(self):
+        """Returns the collected statistics as a json serializable dict"""
+        with self._lock:
+            categories = {}
+            for category, stats in self.categories.items():
+                summary = dict(stats, status=dict(stats['status']))
+                summary['histogram'] = self._label_histogram(
+                        stats['histogram'])
+                summary['mean_seconds'] = stats['seconds'] / stats['requests'] \
+                        if stats['requests'] else 0
+                for percent in [50, 90, 99]:
+                    summary['p{}_seconds'.format(percent)] = \
+                            self._percentile(stats['histogram'], percent)
+                categories[category] = summary
+        return {'started': self.started,
+                'elapsed': time.time() - self.started,
+                'categories': categories}
+
+    def report(self):
+        """Returns a table of the statistics, slowest category first"""
+        categories = self.summary()['categories']
+        lines = ['{:<16} {:>8} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+                'category', 'requests', 'retries', 'errors', 'total(s)',
+                'mean(s)', 'p90(s)', 'MB')]
+        for category, stats in sorted(categories.items(),
+                key=lambda item: -(item[1]['seconds'] +
+                                   item[1]['transfer_seconds'])):
+            errors = sum(count for status, count in stats['status'].items()
+                         if not status.startswith('2'))
+            lines.append('{:<16} {:>8} {:>8} {:>7} {:>10.2f} {:>10.3f} '
+                         '{:>10} {:>10.1f}'.format(category,
+                                stats['requests'], stats['retries'], errors,
+                                stats['seconds'] + stats['transfer_seconds'],
+                                stats['mean_seconds'], stats['p90_seconds'],
+                                stats['bytes'] / (1024.0 * 1024.0)))
+        return '\n'.join(lines)
+
+    def write(self, path, **extra):
+        """Write the summary (and any extra fields given) to path as json"""
+        summary = self.summary()
+        summary.update(extra)
+        datman.utils.write_atomic(path, json.dumps(summary, indent=2,
+                                                   sort_keys=True))
+
+    def _get_stats(self, category):
+        if category not in self.categories:
+            self.categories[category] = {'requests': 0,
+                                         'retries': 0,
+                                         'bytes': 0,
+                                         'seconds': 0.0,
+                                         'max_seconds': 0.0,
+                                         'transfer_seconds': 0.0,
+                                         'status': {},
+                                         'histogram': [0] * (
+                                                len(self.buckets) + 1)}
+        return self.categories[category]
+
+    def _find_bucket(self, seconds):
+        for num, limit in enumerate(self.buckets):
+            if seconds <= limit:
+                return num
+        return len(self.buckets)
+
+    def _label_histogram(self, counts):
+        labels = ['<={}s'.format(limit) for limit in self.buckets]
+        labels.append('>{}s'.format(self.buckets[-1]))
+        return [[label, count] for label, count in zip(labels, counts)]
+
+    def _percentile(self, counts, percent):
+        """
+        The upper bound of the bucket the percentile falls in (or None if
+        it's past the last bucket)
+        """
+        wanted = sum(counts) * percent / 100.0
+        seen = 0
+        for num, count in enumerate(counts):
+            seen += count
+            if count and seen >= wanted:
+                return self.buckets[num] if num < len(self.buckets) else None
+        return 0
+
+
+def _request_size(kwargs, response):
+    """The bytes sent and (unless it's streamed) received by a request"""
+    num_bytes = 0
+    data = kwargs.get('data')
+    if data is not None:
+        num_bytes += len(data)
+    if response is not None and not kwargs.get('stream'):
+        num_bytes += len(response.content)
+    return num_bytes
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_stream_length(response):
+    """
+    Returns the full size of the file being streamed by response, or None if
+    the server didn't say.
+    """
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    if length and response.headers.get('Content-Encoding') is None:
+        return int(length)
+    return None
+
+
+def _log_throughput(action, name, num_bytes, seconds):
+    megabytes = num_bytes / (1024.0 * 1024.0)
+    rate = megabytes / seconds if seconds else 0
+    logger.info('{} {:.1f} MB in {:.1f}s ({:.2f} MB/s): {}'
+                .format(action, megabytes, seconds, rate, name))
+
+
+class UploadStream(object):
+    """
+    A file-like object that feeds an upload from a file a block at a time,
+    so memory use doesn't grow with the size of the upload, and logs its
+    progress and transfer rate.
+
+    opener must be a function that returns a new file object positioned at
+    the start of the data. It's called again by rewind() so a failed upload
+    can be retried from the beginning.
+    """
+
+    def __init__(self, opener, size, name=''):
+        self.opener = opener
+        self.size = size
+        self.name = name
+        self.sent = 0
+        self._file = None
+        self._start = None
+        self._next_report = 0
+
+    def rewind(self):
+        self.close()
+        self._file = self.opener()
+        self.sent = 0
+        self._start = time.time()
+        self._next_report = self.size / 10
+
+    def read(self, size=-1):
+        if self._file is None:
+            self.rewind()
+        block = self._file.read(size)
+        self.sent += len(block)
+        if self.size and self.sent >= self._next_report:
+            self._report()
+        return block
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return self.size
+
+    def _report(self):
+        elapsed = time.time() - self._start
+        if self.sent >= self.size:
+            _log_throughput('Uploaded', self.name, self.sent, elapsed)
+            self._next_report = float('inf')
+            return
+        logger.debug('Uploaded {}% of {} ({:.2f} MB/s)'.format(
+                100 * self.sent // self.size, self.name,
+                self.sent / (1024.0 * 1024.0) / elapsed if elapsed else 0))
+        self._next_report += self.size / 10
+
+
 class xnat(object):
     server = None
     auth = None
     headers = None
     session = None
 
-    def __init__(self, server, username, password):
+    def __init__(self, server, username, password, max_workers=MAX_WORKERS,
+                 pool_size=POOL_SIZE, chunk_size=CHUNK_SIZE, cache_dir=None,
+                 cache_max_age=0, retry_policy=None):
         if server.endswith('/'):
             server = server[:-1]
         self.server = server
         self.auth = (username, password)
+        self.max_workers = max_workers
+        self.pool_size = pool_size
+        self.chunk_size = chunk_size
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.stats = RequestStats()
+        self.cache = None
+        self._session_index = None
+        # Each thread has its own upload_batch, see _get_upload_folder
+        self._uploads = threading.local()
+        if cache_dir:
+            self.cache = MetadataCache(cache_dir, max_age=cache_max_age)
+        self._pool = None
+        self._session_lock = threading.Lock()
         try:
             self.get_xnat_session()
         except Exception as e:
@@ -95,17 +902,76 @@ class xnat(object):
         return self
 
     def __exit__(self, type, value, traceback):
+        self.close()
         # Ends the session on the server side
         url = '{}/data/JSESSION'.format(self.server)
-        self.session.delete(url)
+        self._request('delete', url)
+
+    def close(self):
+        """Shut down the worker pool, waiting for queued queries to finish"""
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) on the worker pool and return immediately.
+
+        func is usually one of this object's query methods (e.g.
+        xnat.submit(xnat.get_scan_info, study, session, experiment, scan)).
+        Returns an AsyncResult, whose get() method blocks until the query
+        finishes and then returns its result or re-raises its exception.
+
+        All workers share this object's requests session (and so its
+        JSESSION cookie). Do not submit functions that themselves wait on
+        other submitted queries, they can deadlock the pool.
+        """
+        return self._get_pool().apply_async(func, args, kwargs)
+
+    def map_queries(self, func, arg_list):
+        """
+        Run func once for each tuple of arguments in arg_list, concurrently,
+        and return the results in the same order as arg_list.
+
+        The first exception raised by any query is re-raised here.
+        """
+        pending = [self.submit(func, *args) for args in arg_list]
+        return [result.get() for result in pending]
+
+    def invalidate_cache(self, project=None, session=None):
+        """
+        Forget cached query results for a session (or a whole project, or
+        everything). This is done automatically for changes made through this
+        class, but must be called if a session is modified some other way.
+        """
+        if self.cache:
+            self.cache.invalidate(project, session)
+
+    def save_stats(self, path):
+        """
+        Write a json summary of the requests made so far (see RequestStats)
+        and of the retries they needed to path.
+        """
+        self.stats.write(path, server=self.server,
+                         retries=self.retry_policy.summary())
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_workers)
+        return self._pool
 
     def get_xnat_session(self):
         """Setup a session with xnat"""
         url = '{}/data/JSESSION'.format(self.server)
 
         s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
 
-        response = s.post(url, auth=self.auth)
+        response = self._request('post', url, session=s, auth=self.auth)
 
         if not response.status_code == requests.codes.ok:
             logger.warn('Failed connecting to xnat server:{}'
@@ -118,6 +984,16 @@ class xnat(object):
                                                         response.content})
         self.session = s
 
+    def _refresh_session(self, stale_session):
+        """
+        Replace an expired xnat session. If several workers get a 401 at once
+        only the first one re-authenticates, the rest reuse its new session.
+        """
+        with self._session_lock:
+            if self.session is stale_session:
+                logger.info('Session may have expired, resetting')
+                self.get_xnat_session()
+
     def get_projects(self):
         """Queries the xnat server for a list of projects"""
         logger.debug('Querying xnat server for projects')
@@ -218,6 +1094,10 @@ class xnat(object):
         except requests.exceptions.RequestException as e:
             logger.warn('Failed to create xnat subject:{}'.format(session))
             raise e
+        finally:
+            self.invalidate_cache(study, session)
+        if self._session_index is not None:
+            self._session_index.add(session, study)
 
     def get_experiments(self, study, session):
         logger.debug('Getting experiments for session:{} in study:{}'
@@ -275,7 +1155,10 @@ class xnat(object):
                         subject=session,
                         experiment=experiment)
 
-        self._make_xnat_put(url)
+        try:
+            self._make_xnat_put(url)
+        finally:
+            self.invalidate_cache(project, session)
 
     def get_scan_list(self, study, session, experiment):
         """The list of dicom scans in an experiment"""
@@ -288,8 +1171,8 @@ class xnat(object):
         try:
             result = self._make_xnat_query(url)
         except:
-            return XnatException('Failed getting scans with url:{}'
-                                 .format(url))
+            raise XnatException('Failed getting scans with url:{}'
+                                .format(url))
 
         if result is None:
             e = XnatException('Scan not found for experiment:{}'
@@ -312,8 +1195,8 @@ class xnat(object):
         try:
             result = self._make_xnat_query(url)
         except:
-            return XnatException('Failed getting scan with url:{}'
-                                 .format(url))
+            raise XnatException('Failed getting scan with url:{}'
+                                .format(url))
 
         if result is None:
             e = XnatException('Scan:{} not found for experiment:{}'
@@ -324,6 +1207,49 @@ class xnat(object):
 
         return(result['items'][0])
 
+    def get_scans_info(self, study, session, experiment, scans=None):
+        """
+        Returns info about every scan in an experiment as a dictionary mapping
+        scan ID to the same json get_scan_info returns.
+
+        The experiment json already holds the full record for each of its
+        scans, so this takes one query instead of one per scan. If the
+        experiment has already been retrieved its 'scans/scan' items can be
+        given as 'scans' to avoid querying again. Any scan whose record is
+        incomplete is looked up individually, and left out if that fails.
+        """
+        if scans is None:
+            experiment_json = self.get_experiment(study, session, experiment)
+            scans = []
+            for child in experiment_json.get('children', []):
+                if child['field'] == 'scans/scan':
+                    scans.extend(child['items'])
+
+        scan_info = {}
+        incomplete = []
+        for scan in scans:
+            scan_id = scan['data_fields']['ID']
+            if 'children' in scan:
+                scan_info[scan_id] = scan
+            else:
+                incomplete.append(scan_id)
+
+        if incomplete:
+            logger.debug('Retrieving full record for scans {} in experiment:{}'
+                         .format(', '.join(incomplete), experiment))
+            pending = [self.submit(self.get_scan_info, study, session,
+                                   experiment, scan_id)
+                       for scan_id in incomplete]
+            for scan_id, result in zip(incomplete, pending):
+                try:
+                    scan_info[scan_id] = result.get()
+                except XnatException as e:
+                    logger.error('Failed getting info for scan:{} in '
+                                 'experiment:{}. Reason: {}'.format(
+                                         scan_id, experiment, e))
+
+        return scan_info
+
     def get_resource_ids(self, study, session, experiment, folderName=None, create=True):
         """
         Return a list of resource id's (subfolders) from an experiment
@@ -391,7 +1317,10 @@ class xnat(object):
                                         session,
                                         experiment,
                                         label)
-        self._make_xnat_put(url)
+        try:
+            self._make_xnat_put(url)
+        finally:
+            self.invalidate_cache(study, session)
         return self.get_resource_ids(study, session, experiment, label)
 
     def get_resource_list(self, study, session, experiment, resource_id):
@@ -409,8 +1338,8 @@ class xnat(object):
         try:
             result = self._make_xnat_xml_query(url)
         except:
-            return XnatException("Failed getting resources with url:"
-                                 .format(url))
+            raise XnatException("Failed getting resources with url:{}"
+                                .format(url))
         if result is None:
             raise XnatException('Experiment:{} not found for session:{}'
                                 ' in study:{}'
@@ -428,21 +1357,81 @@ class xnat(object):
 
         return(items)
 
+    def get_resource_files(self, study, session, experiment, resource_ids):
+        """
+        Returns every file held in the given resource folders of an
+        experiment using a single query. Each file is described by a dict
+        with the keys 'resource_id', 'URI' (the file's path inside its
+        folder), 'name', 'size' and 'digest' (size and digest are None if
+        xnat didnt record them).
+
+        If the server can't answer the combined query each folder's catalog
+        is read separately instead.
+        """
+        if not resource_ids:
+            return []
+        url = '{}/data/archive/projects/{}' \
+              '/subjects/{}/experiments/{}' \
+              '/resources/{}/files?format=json'.format(self.server,
+                                                      study,
+                                                      session,
+                                                      experiment,
+                                                      ','.join(resource_ids))
+        try:
+            result = self._make_xnat_query(url)
+            entries = result['ResultSet']['Result']
+        except Exception as e:
+            logger.info('Failed listing all resources for experiment:{} at '
+                        'once ({}), reading each catalog instead'.format(
+                                experiment, e))
+            return self._get_resource_files_separately(study, session,
+                    experiment, resource_ids)
+
+        files = []
+        for entry in entries:
+            files.append({'resource_id': str(entry.get('cat_ID', '')),
+                          'URI': entry['URI'].split('/files/', 1)[-1],
+                          'name': entry.get('Name'),
+                          'size': _to_int(entry.get('Size')),
+                          'digest': entry.get('digest') or None})
+        return files
+
+    def _get_resource_files_separately(self, study, session, experiment,
+                                       resource_ids):
+        catalogs = self.map_queries(self.get_resource_list,
+                [(study, session, experiment, r_id) for r_id in resource_ids])
+        files = []
+        for r_id, entries in zip(resource_ids, catalogs):
+            for entry in entries:
+                files.append({'resource_id': str(r_id),
+                              'URI': entry['URI'],
+                              'name': entry.get('name'),
+                              'size': _to_int(entry.get('size')),
+                              'digest': entry.get('digest') or None})
+        return files
+
     def find_session(self, session, projects=None):
         """Find a session label in the xnat archive
         searches all xnat projects unless study is specified
         in which case the search is limited to projects in the list"""
-        if not projects:
-            projects = self.get_projects()
-            projects = [p['ID'] for p in projects]
-
-        for project in projects:
-            sessions = self.get_sessions(project)
-            session_labels = [s['label'] for s in sessions]
-            if session in session_labels:
-                logger.debug('Found session:{} in project:{}'
-                             .format(session, project))
-                return(project)
+        project = self.session_index.find(session, projects)
+        if project:
+            logger.debug('Found session:{} in project:{}'
+                         .format(session, project))
+        return(project)
+
+    @property
+    def session_index(self):
+        """A SessionIndex for this server, stored in the cache folder if
+        there is one"""
+        if self._session_index is None:
+            path = None
+            if self.cache:
+                path = os.path.join(self.cache.path, _cache_name(
+                        urlparse.urlparse(self.server).netloc),
+                        'session_index.json')
+            self._session_index = SessionIndex(self, path)
+        return self._session_index
 
     def put_dicoms(self, project, session, experiment, filename, retries=3):
         """Upload an archive of dicoms to XNAT
@@ -458,26 +1447,33 @@ class xnat(object):
                                        subject=session,
                                        session=experiment)
         try:
-            with open(filename) as data:
+            data = UploadStream(lambda: open(filename, 'rb'),
+                                os.path.getsize(filename), filename)
+            try:
                 self._make_xnat_post(upload_url, data, retries, headers)
+            finally:
+                data.close()
         except XnatException as e:
             e.study = project
             e.session = session
             raise e
-        except IOError as e:
-            logger.error('Failed to open file:{} with excuse:'
-                         .format(filename, e.strerror))
-            err = XnatException("Error in file:{}".
-                                format(filename))
-            err.study = project
-            err.session = session
-            raise err
         except requests.exceptions.RequestException as e:
+            # This must come before IOError, which it subclasses
             err = XnatException("Error uploading data with url:{}"
                                 .format(upload_url))
             err.study = project
             err.session = session
             raise err
+        except (IOError, OSError) as e:
+            logger.error('Failed to open file:{} with excuse:{}'
+                         .format(filename, e.strerror))
+            err = XnatException("Error in file:{}".
+                                format(filename))
+            err.study = project
+            err.session = session
+            raise err
+        finally:
+            self.invalidate_cache(project, session)
 
     def get_dicom(self, project, session, experiment, scan,
                   filename=None, retries=3):
@@ -511,23 +1507,17 @@ class xnat(object):
             raise err
 
     def put_resource(self, project, session, experiment, filename, data, folder,
-                     retries=3):
+                     retries=3, size=None):
         """POST a resource file to the xnat server
         filename: string to store filename as
         data: string containing data
-            (such as produced by zipfile.ZipFile.read())"""
-
-        try:
-            self.get_experiment(project,session,experiment)
-        except XnatException:
-            logger.warning('Experiment {} in session {} does not exist! Making new experiment')
-            self.make_experiment(project,session,experiment)
+            (such as produced by zipfile.ZipFile.read()) or a function that
+            opens a file object to stream the data from (such as
+            functools.partial(zipfile.ZipFile.open, member)), in which case
+            size must give the number of bytes it will provide"""
 
-
-        resource_id = self.get_resource_ids(project,
-                                            session,
-                                             experiment,
-                                             folderName=folder)
+        resource_id = self._get_upload_folder(project, session, experiment,
+                                              folder)
 
         attach_url = "{server}/data/archive/projects/{project}/" \
                      "subjects/{subject}/experiments/{experiment}/" \
@@ -543,8 +1533,11 @@ class xnat(object):
                                 resource_id=resource_id,
                                 filename=uploadname)
 
+        if callable(data):
+            data = UploadStream(data, size, filename)
+
         try:
-            self._make_xnat_post(url, data)
+            self._make_xnat_post(url, data, retries)
         except XnatException as err:
             err.study = project
             err.session = session
@@ -555,14 +1548,63 @@ class xnat(object):
             err = XnatException("Failed adding resource to xnat")
             err.study = project
             err.session = session
+            raise err
+        finally:
+            if isinstance(data, UploadStream):
+                data.close()
+            self.invalidate_cache(project, session)
+
+    @contextlib.contextmanager
+    def upload_batch(self):
+        """
+        Use while uploading a group of files to remember which experiments
+        and resource folders exist, instead of checking again before every
+        file. Batches are kept per thread, so several threads can each
+        upload their own batch at once.
+        """
+        previous = getattr(self._uploads, 'folders', None)
+        self._uploads.folders = {}
+        try:
+            yield self
+        finally:
+            self._uploads.folders = previous
+
+    def _get_upload_folder(self, project, session, experiment, folder):
+        """
+        Returns the ID of a resource folder to upload to, creating the
+        experiment and folder if needed.
+        """
+        key = (project, session, experiment, folder)
+        upload_folders = getattr(self._uploads, 'folders', None)
+        if upload_folders and key in upload_folders:
+            return upload_folders[key]
+
+        try:
+            self.get_experiment(project,session,experiment)
+        except XnatException:
+            logger.warning('Experiment {} in session {} does not exist! Making new experiment')
+            self.make_experiment(project,session,experiment)
+
+        resource_id = self.get_resource_ids(project,
+                                            session,
+                                            experiment,
+                                            folderName=folder)
+
+        if upload_folders is not None:
+            upload_folders[key] = resource_id
+        return resource_id
 
     def get_resource(self, project, session, experiment,
                      resource_group_id, resource_id,
-                     filename=None, retries=3, zipped=True):
+                     filename=None, retries=3, zipped=True,
+                     size=None, digest=None):
         """Download a single resource from xnat to filename
         If filename is not specified creates a temporary file and
         retrns the path to that, user needs to be responsible for
-        cleaning up any created tempfiles"""
+        cleaning up any created tempfiles
+
+        size and digest can be taken from the resource's catalog entry
+        (see get_resource_list) to verify an unzipped download"""
 
 
         url = '{}/data/archive/projects/{}/' \
@@ -583,7 +1625,8 @@ class xnat(object):
             os.close(filename[0])
             filename = filename[1]
         try:
-            self._get_xnat_stream(url, filename, retries)
+            self._get_xnat_stream(url, filename, retries, size=size,
+                                  digest=digest)
             return(filename)
         except:
             try:
@@ -642,100 +1685,220 @@ class xnat(object):
         except:
             raise XnatException('Failed deleting resource with url:{}'
                                 .format(url))
+        finally:
+            self.invalidate_cache(project, session)
+
+    def _request(self, method, url, retries=None, rewind=None, session=None,
+                 **kwargs):
+        """
+        Make a request through the retry policy and return the response.
+
+        Timeouts, dropped connections and 502/503/504 responses are retried
+        (up to 'retries' times, if the policy's budget allows it) with
+        exponential backoff. If the session has expired it is renewed and
+        the request repeated once. Any other response is returned as is, so
+        it's up to the caller to handle error codes. rewind, if given, is
+        called before each attempt (e.g. to restart an upload stream).
+        session, if given, is used instead of this object's session and is
+        never renewed (e.g. while logging in).
+        """
+        category = _endpoint_category(method, url)
+        if retries is None:
+            retries = self.retry_policy.max_retries
+        attempt = 0
+        reauthenticated = session is not None
+        fixed_session = session
+        response = None
+        start = time.time()
 
-    def _get_xnat_stream(self, url, filename, retries=3, timeout=120):
-        logger.debug('Getting {} from XNAT'.format(url))
         try:
-            response = self.session.get(url, stream=True, timeout=timeout)
-        except requests.exceptions.Timeout as e:
-            if retries > 0:
-                return(self._get_xnat_stream(url, filename, retries=retries-1,
-                                             timeout=timeout*2))
-            else:
-                raise e
+            while True:
+                self.retry_policy.wait_if_open()
+                if rewind:
+                    rewind()
+                session = fixed_session if fixed_session is not None \
+                        else self.session
+                response = None
+                try:
+                    response = getattr(session, method)(url, **kwargs)
+                except (requests.exceptions.Timeout,
+                        requests.exceptions.ConnectionError) as e:
+                    if not self.retry_policy.retry(category, attempt,
+                                                   retries,
+                                                   e.__class__.__name__):
+                        logger.error('Giving up on {} {}. Reason: {}'
+                                     .format(method.upper(), url, e))
+                        raise e
+                    if isinstance(e, requests.exceptions.Timeout) and \
+                            kwargs.get('timeout'):
+                        kwargs['timeout'] *= 2
+                    attempt += 1
+                    continue
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, stream=True, timeout=timeout)
+                if response.status_code == 401 and not reauthenticated:
+                    # possibly the session has timed out. Closing a discarded
+                    # response returns a streamed one's connection to the pool
+                    response.close()
+                    self._refresh_session(session)
+                    reauthenticated = True
+                    continue
 
-        if response.status_code == 404:
-            logger.info("No records returned from xnat server to query:{}"
-                         .format(url))
-            return
-        elif response.status_code is 504:
-            if retries:
-                logger.warning('xnat server timed out, retrying')
-                time.sleep(30)
-                self._get_xnat_stream(url, filename, retries=retries - 1,
-                                      timeout=timeout * 2)
-            else:
-                logger.error('xnat server timed out, giving up')
+                if response.status_code in RETRY_STATUS_CODES:
+                    if self.retry_policy.retry(category, attempt, retries,
+                                               response.status_code):
+                        response.close()
+                        attempt += 1
+                        continue
+                    logger.error('xnat server error {} for {}, giving up'
+                                 .format(response.status_code, url))
+                    return response
+
+                self.retry_policy.record_success(category)
+                return response
+        finally:
+            # A failed response is falsey, so check for None explicitly
+            self.stats.record(category,
+                              response.status_code if response is not None
+                              else None,
+                              time.time() - start,
+                              _request_size(kwargs, response), attempt)
+
+    def _get_xnat_stream(self, url, filename, retries=3, timeout=120,
+                         size=None, digest=None):
+        """
+        Stream the contents of url into filename.
+
+        If the connection drops or times out part way through, the transfer
+        is resumed from the end of the partial file with an HTTP Range
+        request instead of starting over. If the server ignores the range the
+        file is downloaded again from the start.
+
+        size and digest (an md5 hex string, as recorded in the xnat resource
+        catalog) are optional. When given the finished file is checked
+        against them. The file size is also checked against the length the
+        server reported, when it reports one. Raises XnatException if any
+        check fails.
+        """
+        logger.debug('Getting {} from XNAT'.format(url))
+        category = _endpoint_category('get', url)
+        received = 0
+        transferred = 0
+        interruptions = 0
+        total = None
+        md5 = hashlib.md5()
+        start = time.time()
+
+        while True:
+            headers = {'Range': 'bytes={}-'.format(received)} if received \
+                    else None
+            response = self._request('get', url, retries, stream=True,
+                                     timeout=timeout, headers=headers)
+
+            if response.status_code == 404:
+                logger.info("No records returned from xnat server to query:{}"
+                             .format(url))
+                return
+            elif response.status_code == 416 and received:
+                # Range starts at the end of the file, nothing was left to get
+                break
+            elif response.status_code not in [200, 206]:
+                logger.error('xnat error:{} at data download'
+                             .format(response.status_code))
                 response.raise_for_status()
-        elif response.status_code is not 200:
-            logger.error('xnat error:{} at data upload'
-                         .format(response.status_code))
-            response.raise_for_status()
 
-        with open(filename, 'wb') as f:
+            if response.status_code == 200 and received:
+                logger.info('Server doesnt support resuming downloads, '
+                            'restarting {}'.format(url))
+                received = 0
+                md5 = hashlib.md5()
+
+            if total is None:
+                total = _get_stream_length(response)
+
             try:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
+                with open(filename, 'ab' if received else 'wb') as f:
+                    for chunk in response.iter_content(self.chunk_size):
+                        f.write(chunk)
+                        md5.update(chunk)
+                        received += len(chunk)
+                        transferred += len(chunk)
             except requests.exceptions.RequestException as e:
-                logger.error('Failed reading from xnat')
-                raise(e)
+                # This must come before IOError, which it subclasses
+                if not self.retry_policy.retry(category, interruptions,
+                                               retries, e.__class__.__name__):
+                    logger.error('Failed reading from xnat')
+                    raise(e)
+                logger.warning('Download of {} interrupted after {} bytes, '
+                               'resuming'.format(url, received))
+                interruptions += 1
+                continue
             except IOError as e:
                 logger.error('Failed writing to file')
                 raise(e)
+            if total is not None and received < total:
+                # The connection closed early without an error being raised
+                if not self.retry_policy.retry(category, interruptions,
+                                               retries, 'IncompleteRead'):
+                    break
+                logger.warning('Download of {} ended after {} of {} bytes, '
+                               'resuming'.format(url, received, total))
+                interruptions += 1
+                continue
+            break
+
+        elapsed = time.time() - start
+        _log_throughput('Downloaded', url, received, elapsed)
+        self.stats.add_transfer(category, transferred, elapsed)
+
+        if total is not None and received != total:
+            raise XnatException('Incomplete download of {}. Expected {} bytes '
+                                'but received {}'.format(url, total, received))
+        if size is not None and received != int(size):
+            raise XnatException('Size of {} ({} bytes) doesnt match catalog '
+                                '({} bytes)'.format(url, received, size))
+        if digest and md5.hexdigest() != digest.lower():
+            raise XnatException('Checksum of {} doesnt match catalog'
+                                .format(url))
 
     def _make_xnat_query(self, url, retries=3):
-        try:
-            response = self.session.get(url, timeout=30)
-        except requests.exceptions.Timeout as e:
-            if retries > 0:
-                return(self._make_xnat_query(url, retries=retries-1))
-            else:
-                logger.error('Xnat server timed out getting url:{}'
-                             .format(url))
-                raise e
-
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, timeout=30)
-
-        if response.status_code == 404:
-            logger.info("No records returned from xnat server to query:{}"
-                         .format(url))
+        content = self._get_content(url, retries)
+        if content is None:
             return
-        elif not response.status_code == requests.codes.ok:
-            logger.error('Failed connecting to xnat server:{}'
-                         ' with response code:{}'
-                         .format(self.server, response.status_code))
-            logger.debug('Username: {}')
-            response.raise_for_status()
-        return(response.json())
+        return(json.loads(content))
 
     def _make_xnat_xml_query(self, url, retries=3):
-        try:
-            response = self.session.get(url, timeout=30)
-        except requests.exceptions.Timeout as e:
-            if retries > 0:
-                return(self._make_xnat_xml_query(url, retries=retries-1))
-            else:
-                raise e
+        content = self._get_content(url, retries)
+        if content is None:
+            return
+        root = ElementTree.fromstring(content)
+        return(root)
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.get(url, timeout=30)
+    def _get_content(self, url, retries=3):
+        """
+        GET the body of a query. Returns None if the server has no records
+        for it.
 
-        if response.status_code == 404:
+        When a metadata cache is in use the request is made conditional on
+        the cached copy, which is returned if the server reports it's
+        unchanged.
+        """
+        cached = self.cache.get(url) if self.cache else None
+        if cached and cached.is_fresh(self.cache.max_age):
+            return cached.content
+        headers = cached.validators() if cached else None
+
+        response = self._request('get', url, retries, timeout=30,
+                                 headers=headers)
+
+        if response.status_code == 304 and cached:
+            logger.debug('Using cached result for {}'.format(url))
+            self.cache.touch(url, cached)
+            return cached.content
+        elif response.status_code == 404:
             logger.info("No records returned from xnat server to query:{}"
                          .format(url))
+            if self.cache:
+                self.cache.remove(url)
             return
         elif not response.status_code == requests.codes.ok:
             logger.error('Failed connecting to xnat server:{}'
@@ -743,24 +1906,13 @@ class xnat(object):
                          .format(self.server, response.status_code))
             logger.debug('Username: {}')
             response.raise_for_status()
-        root = ElementTree.fromstring(response.content)
-        return(root)
 
-    def _make_xnat_put(self, url, retries=3):
-        if retries == 0:
-            logger.info('Timed out making xnat put:{}'.format(url))
-            requests.exceptions.HTTPError()
-
-        try:
-            response = self.session.put(url, timeout=30)
-        except requests.exceptions.Timeout:
-            return(self._make_xnat_put(url, retries=retries-1))
+        if self.cache:
+            self.cache.put(url, response.content, response.headers)
+        return response.content
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.put(url, timeout=30)
+    def _make_xnat_put(self, url, retries=3):
+        response = self._request('put', url, retries, timeout=30)
 
         if not response.status_code in [200, 201]:
             logger.warn("http client error at folder creation: {}"
@@ -768,30 +1920,17 @@ class xnat(object):
             response.raise_for_status()
 
     def _make_xnat_post(self, url, data, retries=3, headers=None):
-        logger.debug('POSTing data to xnat, {} retries left'.format(retries))
-        response = self.session.post(url,
-                                     headers=headers,
-                                     data=data,
-                                     timeout=60*60)
-
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.post(url,
-                                         headers=headers,
-                                         data=data)
-
-        if response.status_code is 504:
-            if retries:
-                logger.warning('xnat server timed out, retrying')
-                time.sleep(30)
-                self._make_xnat_post(url, data, retries=retries - 1)
-            else:
-                logger.warn('xnat server timed out, giving up')
-                response.raise_for_status()
-
-        elif response.status_code is not 200:
+        logger.debug('POSTing data to xnat, {} retries allowed'.format(
+                retries))
+        # Every attempt must send the data from the start
+        rewind = data.rewind if isinstance(data, UploadStream) else None
+        response = self._request('post', url, retries, rewind=rewind,
+                                 headers=headers, data=data, timeout=60*60)
+
+        if response.status_code in RETRY_STATUS_CODES:
+            logger.warn('xnat server timed out, giving up')
+            response.raise_for_status()
+        elif response.status_code != 200:
             if 'multiple imaging sessions.' in response.content:
                 raise XnatException('Multiple imaging sessions in archive,'
                                     ' check prearchive')
@@ -806,16 +1945,7 @@ class xnat(object):
                                             response.content))
 
     def _make_xnat_delete(self, url, retries=3):
-        try:
-            response = self.session.delete(url, timeout=30)
-        except requests.exceptions.Timeout:
-            return(self._make_xnat_delete(url, retries=retries-1))
-
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info('Session may have expired, resetting')
-            self.get_xnat_session()
-            response = self.session.delete(url, timeout=30)
+        response = self._request('delete', url, retries, timeout=30)
 
         if not response.status_code in [200, 201]:
             logger.warn("http client error deleting resource: {}"
@@ -826,6 +1956,7 @@ class xnat(object):
 class Session(object):
 
     raw_json = None
+    _resource_files = None
 
     def __init__(self, session_json):
         # Session attributes
@@ -985,14 +2116,22 @@ class Session(object):
         """
         Returns a list of all resource URIs from this session.
         """
-        resources = []
-        resource_ids = self.resource_IDs.values()
-        resource_ids.extend(self.misc_resource_IDs)
-        for r_id in resource_ids:
-            resource_list = xnat_connection.get_resource_list(self.project,
-                    self.name, self.experiment_label, r_id)
-            resources.extend([item['URI'] for item in resource_list])
-        return resources
+        return [item['URI'] for item
+                in self.get_resource_files(xnat_connection)]
+
+    def get_resource_files(self, xnat_connection):
+        """
+        Returns a description of every resource file in this session (see
+        xnat.get_resource_files). The catalog is only retrieved once per
+        Session object.
+        """
+        if self._resource_files is None:
+            resource_ids = self.resource_IDs.values()
+            resource_ids.extend(self.misc_resource_IDs)
+            self._resource_files = xnat_connection.get_resource_files(
+                    self.project, self.name, self.experiment_label,
+                    resource_ids)
+        return self._resource_files
 
     def download(self, xnat, dest_folder, zip_name=None):
         """
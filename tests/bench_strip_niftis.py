@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Times dm_xnat_upload.strip_niftis, which copies the non-nifti members of an
+archive into a new zip without decompressing them, against the old approach
+of extracting the archive to a temp folder and zipping it up again with
+datman.utils.make_zip, on a generated archive of dicoms and niftis.
+
+Reports the seconds each approach took, its throughput in MB of archive per
+second and the most temp disk space it used.
+
+Usage:
+    bench_strip_niftis.py [options]
+
+Options:
+    --size MB           Roughly how much (uncompressed) data the generated
+                        archive holds [default: 500]
+    --file-size KB      The size of each generated dicom [default: 512]
+    --series N          The number of series folders [default: 20]
+    --niftis N          The number of niftis (each with a bval and bvec)
+                        added to the archive [default: 5]
+    --tmp DIR           Where to write the archive and temp files
+    --seed N            Seed for the random file contents [default: 0]
+
+Example:
+    python tests/bench_strip_niftis.py --size 4000 --tmp /scratch
+"""
+from __future__ import division, print_function
+
+import importlib
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+
+from docopt import docopt
+
+import datman.utils
+
+upload = importlib.import_module('bin.dm_xnat_upload')
+
+SESSION = 'STUDY_CMH_0001_01_01'
+
+
+def make_contents(size, rng):
+    """Half random (like pixel data) and half zeros, so it compresses a bit"""
+    noise = bytes(bytearray(rng.getrandbits(8) for _ in range(size // 2)))
+    return noise + b'\0' * (size - len(noise))
+
+
+def make_archive(path, total_size, file_size, num_series, num_niftis, rng):
+    # A few distinct blocks are reused, generating gigabytes of random bytes
+    # would take longer than the benchmark itself
+    blocks = [make_contents(file_size, rng) for _ in range(8)]
+    num_files = max(1, total_size // file_size)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        for num in range(num_files):
+            name = '{}/{}/{}.MR.{}.dcm'.format(SESSION, num % num_series + 1,
+                                               SESSION, num)
+            archive.writestr(name, rng.choice(blocks))
+        for num in range(num_niftis):
+            stem = '{}/{}_DTI_{}'.format(SESSION, SESSION, num)
+            archive.writestr(stem + '.nii.gz', rng.choice(blocks))
+            archive.writestr(stem + '.bval', '0 1000 1000\n')
+            archive.writestr(stem + '.bvec', '0 1 0\n0 0 1\n0 0 0\n')
+        archive.writestr('{}/notes.txt'.format(SESSION), 'Scan notes\n')
+
+
+def extract_and_rezip(archive, temp):
+    """strip_niftis as it was before it copied compressed data directly"""
+    unzip_dest = datman.utils.define_folder(os.path.join(temp, 'extracted'))
+    with zipfile.ZipFile(archive) as zf:
+        archive_files = zf.namelist()
+        niftis = upload.find_niftis(archive_files)
+        nifti_names = [datman.utils.splitext(os.path.basename(nii))[0]
+                       for nii in niftis]
+        deletable_files = filter(lambda x: datman.utils.splitext(
+                os.path.basename(x))[0] in nifti_names, archive_files)
+        non_niftis = filter(lambda x: x not in deletable_files, archive_files)
+        for item in non_niftis:
+            zf.extract(item, unzip_dest)
+
+    temp_zip = os.path.join(temp, os.path.basename(archive))
+    datman.utils.make_zip(unzip_dest, temp_zip)
+    return temp_zip
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(folder, name))
+               for folder, _, files in os.walk(path) for name in files)
+
+
+def time_it(func, archive, work_dir):
+    temp = tempfile.mkdtemp(dir=work_dir)
+    try:
+        start = time.time()
+        result = func(archive, temp)
+        elapsed = time.time() - start
+        # Everything the old approach extracts is still on disk at the end,
+        # so the final size of the temp folder is its peak
+        peak = folder_size(temp)
+        with zipfile.ZipFile(result) as stripped:
+            contents = sorted((info.filename, info.CRC)
+                              for info in stripped.infolist())
+    finally:
+        shutil.rmtree(temp)
+    return elapsed, peak, contents
+
+
+def main():
+    arguments = docopt(__doc__)
+    rng = random.Random(int(arguments['--seed']))
+    work_dir = tempfile.mkdtemp(prefix='bench_strip_niftis_',
+                                dir=arguments['--tmp'])
+    archive = os.path.join(work_dir, SESSION + '.zip')
+    try:
+        make_archive(archive, int(arguments['--size']) * 1024**2,
+                     int(arguments['--file-size']) * 1024,
+                     int(arguments['--series']), int(arguments['--niftis']),
+                     rng)
+        archive_mb = os.path.getsize(archive) / 1024**2
+
+        old_time, old_peak, old_contents = time_it(extract_and_rezip,
+                                                   archive, work_dir)
+        new_time, new_peak, new_contents = time_it(upload.strip_niftis,
+                                                   archive, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if old_contents != new_contents:
+        raise RuntimeError("strip_niftis output differs from extract and "
+                           "rezip")
+
+    print('Archive: {:.0f} MB, {} members kept'.format(archive_mb,
+                                                       len(new_contents)))
+    for label, seconds, peak in [('extract+rezip', old_time, old_peak),
+                                 ('strip_niftis ', new_time, new_peak)]:
+        print('{}: {:.2f}s ({:.1f} MB/s), peak temp space {:.0f} MB'.format(
+                label, seconds, archive_mb / seconds, peak / 1024**2))
+    print('Speed up:      {:.1f}x'.format(old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Times matching series descriptions to tags with datman.config.TagMatcher
+against the old approach of calling re.search on each tag's uncompiled
+pattern strings, over a synthetic set of tags and SeriesDescriptions.
+
+Python's re module only caches the last 100 or so patterns it compiled, so
+the old approach gets much slower once a site has more patterns than that.
+
+Usage:
+    bench_tag_matcher.py [options]
+
+Options:
+    --tags N            The number of tags to generate [default: 150]
+    --descriptions N    The number of series descriptions to match
+                        [default: 1000]
+    --repeat N          Time each approach this many times and keep the
+                        fastest [default: 3]
+    --seed N            Seed for the random descriptions [default: 0]
+"""
+from __future__ import print_function
+
+import random
+import re
+import time
+
+from docopt import docopt
+
+import datman.config
+
+WORDS = ['Sag', 'Ax', 'Cor', 'FSPGR', 'BRAVO', 'MPRAGE', 'Resting', 'State',
+         'fMRI', 'DTI', 'FieldMap', 'TE6.5', 'TE8.5', 'FLAIR', 'T2', 'PD',
+         'MultiEcho', 'Task', 'Run', 'ASL', 'SWI', 'PA', 'AP', 'ORIG']
+
+
+def make_series_map(num_tags, rng):
+    series_map = {}
+    for num in range(num_tags):
+        words = rng.sample(WORDS, 2)
+        pattern = {'SeriesDescription': ['{}.{}{}'.format(words[0], words[1],
+                                                          num),
+                                         '{}_{}'.format(words[1], num)]}
+        if num % 10 == 0:
+            pattern['ImageType'] = 'ORIGINAL.PRIMARY.M'
+        series_map['TAG{}'.format(num)] = pattern
+    return series_map
+
+
+def make_descriptions(series_map, num_descriptions, rng):
+    descriptions = []
+    tags = sorted(series_map)
+    for _ in range(num_descriptions):
+        if rng.random() < 0.8:
+            pattern = series_map[rng.choice(tags)]['SeriesDescription'][1]
+            descriptions.append(pattern + ' 2mm')
+        else:
+            descriptions.append(' '.join(rng.sample(WORDS, 3)))
+    return descriptions
+
+
+def match_uncompiled(series_map, description):
+    """The matching done by dm_xnat_extract.guess_tag before TagMatcher"""
+    matches = []
+    for tag, p in series_map.items():
+        description_regex = p['SeriesDescription']
+        if isinstance(description_regex, list):
+            description_regex = '|'.join(description_regex)
+        if re.search(description_regex, description, re.IGNORECASE):
+            matches.append(tag)
+    return matches
+
+
+def match_compiled(matcher, description):
+    return matcher.search('SeriesDescription', description)
+
+
+def time_it(func, arg, descriptions, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        results = [func(arg, description) for description in descriptions]
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    arguments = docopt(__doc__)
+    num_tags = int(arguments['--tags'])
+    num_descriptions = int(arguments['--descriptions'])
+    repeat = int(arguments['--repeat'])
+    rng = random.Random(int(arguments['--seed']))
+
+    series_map = make_series_map(num_tags, rng)
+    descriptions = make_descriptions(series_map, num_descriptions, rng)
+
+    start = time.time()
+    matcher = datman.config.TagMatcher(series_map)
+    compile_time = time.time() - start
+
+    old_time, old_results = time_it(match_uncompiled, series_map,
+                                    descriptions, repeat)
+    new_time, new_results = time_it(match_compiled, matcher, descriptions,
+                                    repeat)
+
+    if [sorted(r) for r in old_results] != [sorted(r) for r in new_results]:
+        raise RuntimeError("TagMatcher results differ from re.search")
+
+    print('{} tags, {} descriptions'.format(num_tags, num_descriptions))
+    print('re.search:    {:.3f}s ({:.1f}us per description)'.format(
+            old_time, old_time / num_descriptions * 1e6))
+    print('TagMatcher:   {:.3f}s ({:.1f}us per description, {:.3f}s to '
+          'compile)'.format(new_time, new_time / num_descriptions * 1e6,
+                            compile_time))
+    print('Speed up:     {:.1f}x'.format(old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Measures the throughput of dm_xnat_extract from end to end (collecting
+sessions, reading their scans and resources, downloading, unpacking,
+validating and exporting each series) against the local stand-in XNAT in
+xnat_server.py, so that changes to the extractor can be compared.
+
+dm_xnat_extract's main() is run unchanged on a generated study, except that
+the external converters are replaced with stubs that sleep for a
+configurable time and write placeholder outputs.
+
+Reports sessions per hour, MB/s downloaded, the peak temp disk space used,
+the time spent in each stage and a summary of the XNAT requests made.
+
+Usage:
+    bench_xnat_extract.py [options]
+
+Options:
+    --sessions N            The number of sessions per site [default: 8]
+    --sites LIST            A comma separated list of sites [default: CMH]
+    --slices N              The number of dicoms in each series [default: 50]
+    --size N                Each dicom holds N x N pixels [default: 64]
+    --latency SECS          Seconds the server waits before each answer
+                            [default: 0.005]
+    --bandwidth MBPS        Limit each download to this many MB/s
+    --error-rate RATE       The fraction of requests answered with a 503
+                            [default: 0]
+    --convert-secs SECS     Seconds each stub converter takes per series
+                            [default: 0.2]
+    --convert-mbps MBPS     Stub converters also take 1 second for each MBPS
+                            MB of dicoms converted
+    --session-workers N     Passed on to dm_xnat_extract [default: 1]
+    --project-workers N     Passed on to dm_xnat_extract
+    --download-workers N    Passed on to dm_xnat_extract [default: 2]
+    --export-workers N      Passed on to dm_xnat_extract [default: 2]
+    --output FILE           Also write the results to FILE (as json)
+    --keep                  Dont delete the generated study folder
+    -d, --debug             Show dm_xnat_extract's log messages
+
+Example:
+    python tests/bench_xnat_extract.py --sessions 20 --session-workers 4
+"""
+from __future__ import division, print_function
+
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from docopt import docopt
+
+from xnat_server import MockXnat, XnatServer, make_archive
+
+extract = importlib.import_module('bin.dm_xnat_extract')
+
+STUDY = 'STUDY'
+
+SITE_CONFIG = """
+XNATSERVER: 'localhost'
+Projects:
+  {study}: study_settings.yml
+SystemSettings:
+  bench:
+    DATMAN_PROJECTSDIR: '{projects}'
+    DATMAN_ASSETSDIR: '{projects}'
+    XNAT_ARCHIVEDIR: ''
+    CONFIG_DIR: '{config}'
+Paths:
+  meta: metadata/
+  dcm: data/dcm/
+  nii: data/nii/
+  mnc: data/mnc/
+  nrrd: data/nrrd/
+  resources: data/RESOURCES/
+ExportSettings:
+  T1: {{formats: ['nii', 'dcm', 'mnc']}}
+  DTI60: {{formats: ['nii', 'dcm', 'nrrd']}}
+  RST: {{formats: ['nii', 'dcm']}}
+  MEFMRI1: {{formats: ['nii', 'dcm']}}
+  MEFMRI2: {{formats: ['nii', 'dcm']}}
+"""
+
+STUDY_CONFIG = """
+PROJECTDIR: {study}
+STUDY_TAG: {study}
+Sites:
+{sites}
+"""
+
+SITE = """
+  {site}:
+    XNAT_Archive: '{study}'
+    ExportInfo:
+      T1: {{Pattern: {{SeriesDescription: 'T1w'}}, Count: 1}}
+      DTI60: {{Pattern: {{SeriesDescription: 'DTI'}}, Count: 1}}
+      RST: {{Pattern: {{SeriesDescription: 'Resting'}}, Count: 1}}
+      MEFMRI1: {{Pattern: {{SeriesDescription: 'MultiEcho', EchoNumber: 1}},
+                Count: 1}}
+      MEFMRI2: {{Pattern: {{SeriesDescription: 'MultiEcho', EchoNumber: 2}},
+                Count: 1}}
+"""
+
+# The files each stub converter writes for a series
+OUTPUTS = {'nii': ['.nii.gz', '.json'],
+           'mnc': ['.mnc'],
+           'nrrd': ['.nrrd'],
+           'dcm': ['.dcm']}
+
+STAGES = ['download_series', 'extract_series', 'find_series_dir',
+          'export_series']
+
+
+def write_config(study_dir, sites):
+    config_dir = os.path.join(study_dir, 'config')
+    os.makedirs(config_dir)
+    site_config = os.path.join(config_dir, 'site_config.yml')
+    with open(site_config, 'w') as config:
+        config.write(SITE_CONFIG.format(study=STUDY, projects=study_dir,
+                                        config=config_dir))
+    with open(os.path.join(config_dir, 'study_settings.yml'), 'w') as config:
+        config.write(STUDY_CONFIG.format(study=STUDY, sites=''.join(
+                SITE.format(site=site, study=STUDY) for site in sites)))
+    meta_dir = os.path.join(study_dir, STUDY, 'metadata')
+    os.makedirs(meta_dir)
+    with open(os.path.join(meta_dir, 'blacklist.csv'), 'w') as blacklist:
+        blacklist.write('series\treason\n')
+    return site_config
+
+
+def make_converter(export_format, seconds, mbps):
+    """Returns a stub with the same arguments as the real exporters"""
+    def convert(seriesdir, outputdir, stem, multiecho=False):
+        cost = seconds
+        if mbps:
+            size = sum(os.path.getsize(os.path.join(seriesdir, name))
+                       for name in os.listdir(seriesdir))
+            cost += size / (mbps * 1024 * 1024)
+        time.sleep(cost)
+        stems = stem if isinstance(stem, list) else [stem]
+        for name in stems:
+            for ext in OUTPUTS[export_format]:
+                with open(os.path.join(outputdir, name + ext), 'w') as output:
+                    output.write('{} exported from {}\n'.format(name,
+                                                                seriesdir))
+    return convert
+
+
+class StageTimer(object):
+    """Wraps dm_xnat_extract's stage functions to total the time in each"""
+
+    def __init__(self):
+        self.seconds = dict((stage, 0.0) for stage in STAGES)
+        self._lock = threading.Lock()
+
+    def install(self):
+        for stage in STAGES:
+            setattr(extract, stage, self._wrap(stage, getattr(extract, stage)))
+
+    def _wrap(self, stage, func):
+        def timed(job):
+            start = time.time()
+            try:
+                return func(job)
+            finally:
+                with self._lock:
+                    self.seconds[stage] += time.time() - start
+        return timed
+
+
+def main():
+    arguments = docopt(__doc__)
+    sites = arguments['--sites'].split(',')
+    sessions = int(arguments['--sessions'])
+    bandwidth = arguments['--bandwidth']
+    convert_mbps = arguments['--convert-mbps']
+
+    archive = make_archive(projects=[STUDY], sites=sites, sessions=sessions,
+                           slices=int(arguments['--slices']),
+                           size=int(arguments['--size']),
+                           full_subject_ids=True)
+    app = MockXnat(archive, latency=float(arguments['--latency']),
+                   bandwidth=float(bandwidth) if bandwidth else None,
+                   error_rate=float(arguments['--error-rate']))
+
+    study_dir = tempfile.mkdtemp(prefix='bench_xnat_extract_')
+    os.environ['DM_CONFIG'] = write_config(study_dir, sites)
+    os.environ['DM_SYSTEM'] = 'bench'
+    os.environ['XNAT_USER'] = 'user'
+    os.environ['XNAT_PASS'] = 'pass'
+
+    for export_format in OUTPUTS:
+        setattr(extract, 'export_{}_command'.format(export_format),
+                make_converter(export_format,
+                               float(arguments['--convert-secs']),
+                               float(convert_mbps) if convert_mbps else None))
+    timer = StageTimer()
+    timer.install()
+
+    server = XnatServer(app).start()
+    sys.argv = ['dm_xnat_extract.py', STUDY, '--server', server.url,
+                '--dont-update-dashboard',
+                '--session-workers', arguments['--session-workers'],
+                '--download-workers', arguments['--download-workers'],
+                '--export-workers', arguments['--export-workers']]
+    if arguments['--project-workers']:
+        sys.argv += ['--project-workers', arguments['--project-workers']]
+    sys.argv.append('--debug' if arguments['--debug'] else '--quiet')
+
+    try:
+        start = time.time()
+        extract.main()
+        elapsed = time.time() - start
+    finally:
+        server.stop()
+        if not arguments['--keep']:
+            shutil.rmtree(study_dir)
+
+    requests = extract.xnat.stats.summary()['categories']
+    downloaded = sum(requests[category]['bytes']
+                     for category in ['dicom_download', 'file_download']
+                     if category in requests)
+    total_sessions = sessions * len(sites)
+    results = {'sessions': total_sessions,
+               'seconds': elapsed,
+               'sessions_per_hour': total_sessions / elapsed * 3600,
+               'downloaded_bytes': downloaded,
+               'bytes_per_second': downloaded / elapsed,
+               'peak_temp_bytes': extract.temp_space.peak,
+               'stage_seconds': timer.seconds,
+               'requests': requests}
+
+    print('{} sessions in {:.1f}s ({:.0f} sessions/hour)'.format(
+            total_sessions, elapsed, results['sessions_per_hour']))
+    print('Downloaded {:.1f} MB ({:.2f} MB/s)'.format(
+            downloaded / 1024**2, results['bytes_per_second'] / 1024**2))
+    print('Peak temp space: {:.1f} MB'.format(
+            results['peak_temp_bytes'] / 1024**2))
+    print('Time in each stage (summed over workers): {}'.format(', '.join(
+            '{} {:.1f}s'.format(stage, timer.seconds[stage])
+            for stage in STAGES)))
+    print(extract.xnat.stats.report())
+    if arguments['--keep']:
+        print('Study folder kept at {}'.format(study_dir))
+
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ import unittest
 
 import nose.tools
 from nose.tools import raises
+from mock import patch
 
 import datman.config as config
 
@@ -17,3 +18,58 @@ def test_initialise_from_environ():
     os.environ['DM_CONFIG'] = os.path.join(FIXTURE_DIR, 'site_config.yml')
     os.environ['DM_SYSTEM'] = 'test'
     cfg = config.config()
+
+
+@raises(RuntimeError)
+def test_failed_site_tag_search_restores_current_study():
+    cfg = config.config(filename=os.path.join(FIXTURE_DIR, 'site_config.yml'),
+                        system='test')
+
+    def broken_set_study(study):
+        cfg.study_name = study
+        raise RuntimeError('unreadable study config')
+
+    try:
+        with patch.object(cfg, 'get_key', return_value={'TEST': ''}), \
+                patch.object(cfg, 'set_study', side_effect=broken_set_study):
+            cfg._get_site_tag_map()
+    finally:
+        assert cfg.study_name is None
+
+
+class TestTagMatcher(unittest.TestCase):
+
+    series_map = {'T1': {'SeriesDescription': ['T1', 'BRAVO']},
+                  'FMAP-MAG': {'SeriesDescription': 'FieldMap',
+                               'ImageType': 'M'},
+                  'FMAP-PHA': {'SeriesDescription': 'FieldMap',
+                               'ImageType': 'P'},
+                  'RST': {'SeriesDescription': 'Rest', 'EchoNumber': 1},
+                  'OBS': 'Observ'}
+
+    def setUp(self):
+        self.matcher = config.TagMatcher(self.series_map)
+
+    def test_description_patterns_ignore_case(self):
+        assert self.matcher.search('SeriesDescription', 'Sag bravo') == ['T1']
+
+    def test_plain_patterns_match_description(self):
+        assert self.matcher.match(SeriesDescription='observe') == [
+                ('OBS', 'SeriesDescription')]
+
+    def test_match_reports_field_that_matched(self):
+        matches = self.matcher.match(SeriesDescription='FieldMap',
+                                     ImageType='ORIGINAL\\P')
+
+        assert sorted(matches) == [('FMAP-MAG', 'SeriesDescription'),
+                                   ('FMAP-PHA', 'ImageType'),
+                                   ('FMAP-PHA', 'SeriesDescription')]
+
+    def test_search_limited_to_given_tags(self):
+        found = self.matcher.search('ImageType', 'M', tags=['FMAP-MAG'])
+
+        assert found == ['FMAP-MAG']
+
+    @raises(KeyError)
+    def test_search_raises_if_tag_has_no_pattern_for_field(self):
+        self.matcher.search('ImageType', 'M', tags=['T1'])
@@ -2,12 +2,15 @@ import os
 import unittest
 import importlib
 import logging
+import shutil
+import tempfile
 import zipfile
 
 from nose.tools import raises
 from mock import patch, MagicMock
 
 import datman
+import datman.pipeline
 import datman.xnat
 import datman.scanid
 
@@ -106,3 +109,119 @@ class GetResources(unittest.TestCase):
         actual_resources = upload.get_resources(archive_zip.return_value)
 
         assert sorted(actual_resources) == sorted(expected_resources)
+
+
+class TestGetQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_xnat_upload_')
+        self.archives = []
+        for num in range(1, 4):
+            archive = os.path.join(self.tmp,
+                                   'STUDY_SITE_000{}_01_01.zip'.format(num))
+            with open(archive, 'w') as archive_file:
+                archive_file.write('data')
+            self.archives.append(archive)
+        self.progress = datman.pipeline.ProgressRecord(
+                os.path.join(self.tmp, 'progress.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_skips_completed_and_puts_pending_first(self):
+        self.progress.add(upload.get_job_name(self.archives[0]), True)
+        self.progress.queue([upload.get_job_name(self.archives[2])])
+
+        queue = upload.get_queue(self.archives, self.progress)
+
+        assert queue == [self.archives[2], self.archives[1]]
+        assert self.progress.pending == [
+                upload.get_job_name(self.archives[2]),
+                upload.get_job_name(self.archives[1])]
+
+    def test_changed_archive_is_queued_again(self):
+        self.progress.add(upload.get_job_name(self.archives[0]), True)
+        with open(self.archives[0], 'a') as archive_file:
+            archive_file.write('more data')
+
+        queue = upload.get_queue(self.archives, self.progress)
+
+        assert queue == self.archives
+
+    def test_pending_entries_for_changed_archives_dropped(self):
+        old_name = upload.get_job_name(self.archives[0])
+        self.progress.queue([old_name])
+        with open(self.archives[0], 'a') as archive_file:
+            archive_file.write('more data')
+        os.remove(self.archives[2])
+
+        queue = upload.get_queue(self.archives[:2], self.progress)
+
+        assert queue == self.archives[:2]
+        assert old_name not in self.progress.pending
+
+
+class TestArchiveScanner(unittest.TestCase):
+
+    archives = ['archive{}.zip'.format(num) for num in range(10)]
+
+    @patch('datman.fingerprint.get_archive_fingerprint')
+    def test_only_reads_a_few_archives_ahead(self, mock_fingerprint):
+        mock_fingerprint.side_effect = lambda archive: {'name': archive}
+        scanner = upload.ArchiveScanner(self.archives, 1, lookahead=2)
+        try:
+            assert sorted(scanner._results) == self.archives[:3]
+
+            assert scanner.get(self.archives[4]) == {'name': 'archive4.zip'}
+            assert sorted(scanner._results) == self.archives[:7]
+        finally:
+            scanner.close()
+
+
+class TestRunArchive(unittest.TestCase):
+
+    archive = 'some_dir/STUDY_SITE_9999_01_01.zip'
+
+    @patch('bin.dm_xnat_upload.process_archive')
+    def test_failure_is_recorded(self, mock_process):
+        mock_process.side_effect = Exception('Server unavailable')
+        progress = MagicMock()
+
+        assert not upload.run_archive(('STUDY', self.archive), progress)
+        progress.add.assert_called_once_with(
+                'STUDY_SITE_9999_01_01.zip', False, 'Server unavailable')
+
+
+class TestStripNiftis(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_xnat_upload_')
+        self.archive = os.path.join(self.tmp, 'STUDY_SITE_9999_01_01.zip')
+        self.temp = os.path.join(self.tmp, 'temp')
+        os.mkdir(self.temp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_archive(self, names):
+        with zipfile.ZipFile(self.archive, 'w') as archive:
+            for name in names:
+                archive.writestr(name, 'contents of ' + name)
+
+    def test_removes_niftis_and_their_files(self):
+        self.make_archive(['exam/', 'exam/1/img1.dcm', 'exam/1/img2.dcm',
+                           'exam/dti.nii.gz', 'exam/dti.bval',
+                           'exam/dti.bvec', 'exam/notes.txt'])
+
+        new_archive = upload.strip_niftis(self.archive, self.temp)
+
+        with zipfile.ZipFile(new_archive) as stripped:
+            assert sorted(stripped.namelist()) == [
+                    'exam/1/img1.dcm', 'exam/1/img2.dcm', 'exam/notes.txt']
+            assert stripped.read('exam/1/img2.dcm') == \
+                    'contents of exam/1/img2.dcm'
+
+    def test_returns_nothing_when_only_niftis_found(self):
+        self.make_archive(['exam/', 'exam/t1.nii', 'exam/t1.json'])
+
+        assert upload.strip_niftis(self.archive, self.temp) == []
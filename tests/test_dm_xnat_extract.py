@@ -0,0 +1,394 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+import importlib
+
+from mock import patch, MagicMock
+
+from xnat_server import make_series
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+extract = importlib.import_module('bin.dm_xnat_extract')
+
+
+class TestReadDicomHeader(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        files = make_series('STUDY_CMH_0001_01', '1.2.3', 4, 'MultiEcho',
+                            'ORIGINAL', slices=2, size=8, echoes=2)
+        self.files = []
+        for name, contents in sorted(files.items()):
+            path = os.path.join(self.temp_dir, name)
+            with open(path, 'wb') as dcm:
+                dcm.write(contents)
+            self.files.append(path)
+        self.not_dicom = os.path.join(self.temp_dir, 'notes.txt')
+        with open(self.not_dicom, 'w') as text:
+            text.write('Not a dicom')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_reads_needed_tags_without_pixel_data(self):
+        header = extract.read_dicom_header(self.files[0])
+
+        assert header.EchoNumbers in [1, 2]
+        assert 'PixelData' not in header
+        assert 'SeriesDescription' not in header
+
+    def test_files_without_dicm_prefix_are_invalid(self):
+        assert extract.read_dicom_header(self.not_dicom) is None
+        assert not extract.is_valid_dicom(self.not_dicom)
+
+    def test_headers_read_in_order_skipping_invalid_files(self):
+        headers = extract.read_dicom_headers(self.files + [self.not_dicom])
+
+        assert [f for f, _ in headers] == self.files
+
+
+class TestGuessTag(unittest.TestCase):
+
+    matcher = extract.datman.config.TagMatcher({
+            'FMAP-MAG': {'SeriesDescription': 'FieldMap', 'ImageType': 'M'},
+            'FMAP-PHA': {'SeriesDescription': 'FieldMap', 'ImageType': 'P'},
+            'MEFMRI': {'SeriesDescription': 'MultiEcho', 'EchoNumber': 1},
+            'MEFMRI2': {'SeriesDescription': 'MultiEcho', 'EchoNumber': 2}})
+
+    def scan_info(self, image_type):
+        return {'data_fields': {'parameters/imageType': image_type}}
+
+    def test_image_type_used_when_description_is_ambiguous(self):
+        tag = extract.guess_tag(self.matcher, self.scan_info('ORIGINAL\\P'),
+                                'FieldMap', False)
+
+        assert tag == ['FMAP-PHA']
+
+    def test_both_tags_returned_for_multiecho_series(self):
+        tag = extract.guess_tag(self.matcher, self.scan_info('ORIGINAL'),
+                                'MultiEcho', True)
+
+        assert sorted(tag) == ['MEFMRI', 'MEFMRI2']
+
+    def test_no_tag_when_ambiguous_without_image_type_pattern(self):
+        tag = extract.guess_tag(self.matcher, self.scan_info('ORIGINAL'),
+                                'MultiEcho', False)
+
+        assert tag is None
+
+
+class TestFindSeriesDir(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.files_dir = os.path.join(self.temp_dir, 'dicoms', 'files')
+        os.makedirs(self.files_dir)
+        files = make_series('STUDY_CMH_0001_01', '1.2.3', 4, 'MultiEcho',
+                            'ORIGINAL', slices=6, size=8, echoes=2)
+        for name, contents in files.items():
+            with open(os.path.join(self.files_dir, name), 'wb') as dcm:
+                dcm.write(contents)
+        self.job = extract.SeriesJob(None, 'STUDY', 'STUDY_CMH_0001_01',
+                                     'STUDY_CMH_0001_01_01', '4')
+        self.job.temp_dir = self.temp_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_single_echo_series_uses_extracted_folder(self):
+        extract.find_series_dir(self.job)
+
+        assert self.job.src_dir == self.files_dir
+        assert self.job.echo_dirs == {}
+
+    def test_multiecho_series_is_split_by_echo_number(self):
+        self.job.multiecho_stems = ['STEM_ECHO1', 'STEM_ECHO2']
+
+        extract.find_series_dir(self.job)
+
+        assert sorted(self.job.echo_dirs) == [1, 2]
+        for echo_dir in self.job.echo_dirs.values():
+            assert os.path.basename(echo_dir) == 'files'
+            assert len(os.listdir(echo_dir)) == 3
+
+    def test_each_echo_exported_from_its_own_folder(self):
+        self.job.multiecho_stems = ['STEM_ECHO1', 'STEM_ECHO2']
+        self.job.add_export('STEM_ECHO1', ['nii'], echo=1)
+        self.job.add_export('STEM_ECHO2', ['nii'], echo=2)
+        self.job.echo_dirs = {1: '/tmp/echoes/1/files',
+                              2: '/tmp/echoes/2/files'}
+        self.job.ident = extract.datman.scanid.parse('STUDY_CMH_0001_01_01')
+
+        with patch.object(extract, 'cfg') as mock_cfg, \
+                patch.object(extract, 'run_exporter') as mock_run, \
+                patch('datman.utils.define_folder', side_effect=lambda x: x):
+            mock_cfg.get_path.return_value = '/data/nii'
+            mock_run.return_value = []
+            extract.export_series(self.job)
+
+        calls = [call[0][1:] for call in mock_run.call_args_list]
+        assert calls == [
+                ('/tmp/echoes/1/files', '/data/nii/STUDY_CMH_0001_01',
+                 'STEM_ECHO1', False),
+                ('/tmp/echoes/2/files', '/data/nii/STUDY_CMH_0001_01',
+                 'STEM_ECHO2', False)]
+
+
+class TestDownloadSeries(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = extract.datman.xnat.SeriesCache(
+                os.path.join(self.temp_dir, 'cache'), 1024**2)
+        source = os.path.join(self.temp_dir, 'source')
+        os.makedirs(source)
+        with open(os.path.join(source, 'dicom.dcm'), 'wb') as dcm:
+            dcm.write(b'x' * 100)
+        self.cache.add('key', source)
+        self.job = extract.SeriesJob(None, 'STUDY', 'STUDY_CMH_0001_01',
+                                     'STUDY_CMH_0001_01_01', '4')
+        self.job.cache_key = 'key'
+        self.budget = extract.datman.pipeline.DiskBudget(1024)
+        patch.object(extract, 'series_cache', self.cache).start()
+        patch.object(extract, 'temp_space', self.budget).start()
+
+    def tearDown(self):
+        patch.stopall()
+        shutil.rmtree(self.job.temp_dir, ignore_errors=True)
+        shutil.rmtree(self.temp_dir)
+
+    def test_cached_series_counts_against_temp_space(self):
+        extract.download_series(self.job)
+
+        assert self.job.cached
+        assert self.job.disk_used == 100
+        assert self.budget.used == 100
+
+
+class TestRunExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_outputs_published_and_staging_removed(self):
+        def exporter(src_dir, output_dir, stem, multiecho):
+            with open(os.path.join(output_dir, stem + '.dcm'), 'w') as out:
+                out.write('data')
+
+        outputs = extract.run_exporter(exporter, '/src', self.temp_dir, 'STEM')
+
+        assert outputs == [os.path.join(self.temp_dir, 'STEM.dcm')]
+        assert os.listdir(self.temp_dir) == ['STEM.dcm']
+
+    def test_existing_outputs_not_replaced(self):
+        existing = os.path.join(self.temp_dir, 'STEM.dcm')
+        with open(existing, 'w') as out:
+            out.write('original')
+
+        def exporter(src_dir, output_dir, stem, multiecho):
+            with open(os.path.join(output_dir, stem + '.dcm'), 'w') as out:
+                out.write('new')
+
+        outputs = extract.run_exporter(exporter, '/src', self.temp_dir, 'STEM')
+
+        assert outputs == []
+        with open(existing) as out:
+            assert out.read() == 'original'
+
+    def test_failed_exporter_leaves_no_partial_output(self):
+        def exporter(src_dir, output_dir, stem, multiecho):
+            with open(os.path.join(output_dir, stem + '.nii.gz'), 'w') as out:
+                out.write('half')
+            raise RuntimeError('Conversion failed')
+
+        with self.assertRaises(RuntimeError):
+            extract.run_exporter(exporter, '/src', self.temp_dir, 'STEM')
+
+        assert os.listdir(self.temp_dir) == []
+
+    @patch.object(extract, 'DRYRUN', True)
+    def test_dry_run_writes_nothing(self):
+        exporter = MagicMock()
+
+        outputs = extract.run_exporter(exporter, '/src', self.temp_dir, 'STEM')
+
+        assert outputs == []
+        assert not exporter.called
+        assert os.listdir(self.temp_dir) == []
+
+    @patch('datman.utils.run')
+    def test_dcm2niix_outputs_renamed_after_stem(self, mock_run):
+        def dcm2niix(cmd, dryrun):
+            output_dir = cmd.split()[6]
+            for ext in ['.nii.gz', '.json']:
+                name = 'files_T1_20180101120000_2' + ext
+                open(os.path.join(output_dir, name), 'w').close()
+            return 0, ''
+        mock_run.side_effect = dcm2niix
+
+        extract.export_nii_command('/src/files', self.temp_dir, 'STEM')
+
+        assert sorted(os.listdir(self.temp_dir)) == ['STEM.json',
+                                                     'STEM.nii.gz']
+
+
+class TestSessionState(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.nii_dir = os.path.join(self.temp_dir, 'nii', 'STUDY_CMH_0001_01')
+        os.makedirs(self.nii_dir)
+        for name in ['STUDY_CMH_0001_01_01_T1_02_Sag-T1.1mm.nii.gz',
+                     'STUDY_CMH_0001_01_01_RST_03_Rest.json']:
+            open(os.path.join(self.nii_dir, name), 'w').close()
+        ident = extract.datman.scanid.parse('STUDY_CMH_0001_01_01')
+        self.state = extract.SessionState(ident)
+        self.cfg = patch.object(extract, 'cfg').start()
+        self.cfg.get_path.side_effect = lambda f: os.path.join(
+                self.temp_dir, f)
+
+    def tearDown(self):
+        patch.stopall()
+        shutil.rmtree(self.temp_dir)
+
+    def test_formats_with_outputs_are_not_remaining(self):
+        stem = 'STUDY_CMH_0001_01_01_T1_02_Sag-T1.1mm'
+
+        assert self.state.remaining_formats(stem, ['nii', 'mnc']) == ['mnc']
+        assert self.state.remaining_formats('STUDY_CMH_0001_01_01_T1_02_Sag',
+                                            ['nii']) == ['nii']
+
+    def test_output_folder_listed_once(self):
+        with patch('os.listdir', return_value=[]) as mock_listdir:
+            self.state.remaining_formats('STUDY_CMH_0001_01_01_T1_02_Sag',
+                                         ['nii'])
+            self.state.remaining_formats('STUDY_CMH_0001_01_01_RST_03_Rest',
+                                         ['nii'])
+
+        assert mock_listdir.call_count == 1
+
+    @patch('datman.utils.read_blacklist')
+    def test_blacklist_read_once_per_session(self, mock_blacklist):
+        mock_blacklist.return_value = {
+                'STUDY_CMH_0001_01_01_RST_03_Rest': 'Bad scan'}
+
+        assert self.state.blacklist_entry(
+                'STUDY_CMH_0001_01_01_RST_03_Rest') == 'Bad scan'
+        assert self.state.blacklist_entry(
+                'STUDY_CMH_0001_01_01_T1_02_Sag') is None
+        assert mock_blacklist.call_count == 1
+
+    @patch('datman.utils.read_blacklist')
+    def test_scans_checked_separately_if_blacklist_unreadable(self,
+                                                              mock_blacklist):
+        mock_blacklist.side_effect = [Exception('No blacklist'), 'Bad scan']
+
+        entry = self.state.blacklist_entry('STUDY_CMH_0001_01_01_RST_03_Rest')
+
+        assert entry == 'Bad scan'
+        assert mock_blacklist.call_args[1]['scan'] == \
+            'STUDY_CMH_0001_01_01_RST_03_Rest'
+
+
+class TestExtractionManifest(unittest.TestCase):
+
+    stem = 'STUDY_CMH_0001_01_01_T1_02_Sag-T1'
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'meta', 'session.json')
+        self.output = os.path.join(self.temp_dir, self.stem + '.nii.gz')
+        with open(self.output, 'w') as output:
+            output.write('nifti')
+        patch.object(extract, 'exporter_versions',
+                     {'nii': 'v1.0', 'dcm': None}).start()
+
+    def tearDown(self):
+        patch.stopall()
+        shutil.rmtree(self.temp_dir)
+
+    def make_manifest(self):
+        manifest = extract.ExtractionManifest(self.path, 'STUDY_CMH_0001_01')
+        manifest.add_export(self.stem, '2', 'abc', 'nii', [self.output], 1.5)
+        manifest.add_export(self.stem, '2', 'abc', 'dcm', [], 0.1)
+        manifest.save()
+        return extract.ExtractionManifest(self.path, 'STUDY_CMH_0001_01')
+
+    def test_unchanged_scan_only_needs_failed_formats(self):
+        manifest = self.make_manifest()
+
+        remaining = manifest.remaining_formats(self.stem, 'abc',
+                                               ['nii', 'dcm'])
+
+        assert remaining == ['dcm']
+
+    def test_deleted_outputs_need_export_again(self):
+        manifest = self.make_manifest()
+        os.remove(self.output)
+
+        remaining = manifest.remaining_formats(self.stem, 'abc',
+                                               ['nii', 'dcm'])
+
+        assert remaining == ['nii', 'dcm']
+
+    def test_changed_scan_needs_every_format(self):
+        manifest = self.make_manifest()
+
+        remaining = manifest.remaining_formats(self.stem, 'def',
+                                               ['nii', 'dcm'])
+
+        assert remaining == ['nii', 'dcm']
+
+    def test_unknown_without_checksum(self):
+        manifest = self.make_manifest()
+
+        assert manifest.remaining_formats(self.stem, None, ['nii']) is None
+        assert manifest.remaining_formats('OTHER', 'abc', ['nii']) is None
+
+    def test_exports_recorded_with_version_and_output_md5(self):
+        manifest = self.make_manifest()
+
+        record = manifest.scans[self.stem]['exports']['nii']
+        assert record['exporter'] == 'dcm2niix'
+        assert record['version'] == 'v1.0'
+        assert record['outputs'] == {
+                self.output: 'f37d951f1471ae80d3942be27ce79733'}
+        assert record['succeeded']
+
+    def test_report_lists_what_run_did(self):
+        manifest = extract.ExtractionManifest(self.path, 'STUDY_CMH_0001_01')
+        manifest.add_export(self.stem, '2', 'abc', 'nii', [self.output], 1.5)
+        manifest.add_skipped('STUDY_CMH_0001_01_01_RST_03_Rest', 'blacklisted')
+
+        report = manifest.report()
+
+        assert report['exported'] == [{'scan': self.stem, 'format': 'nii'}]
+        assert report['skipped'][0]['reason'] == 'blacklisted'
+
+
+class TestPublishOutputs(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.staging = os.path.join(self.temp_dir, '.export')
+        os.makedirs(self.staging)
+        for folder, contents in [(self.staging, 'new'),
+                                 (self.temp_dir, 'old')]:
+            with open(os.path.join(folder, 'STEM.nii.gz'), 'w') as output:
+                output.write(contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_existing_outputs_replaced_when_asked(self):
+        extract.publish_outputs(self.staging, self.temp_dir, replace=True)
+
+        with open(os.path.join(self.temp_dir, 'STEM.nii.gz')) as output:
+            assert output.read() == 'new'
@@ -0,0 +1,84 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+import datman.fingerprint
+from xnat_server import make_series, make_zip
+
+logging.disable(logging.CRITICAL)
+
+STUDY_UID = '1.2.3.4.5'
+
+
+class TestGetArchiveFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_fingerprint_')
+        self.archive = os.path.join(self.tmp, 'STUDY_CMH_0001_01_01.zip')
+        self.files = {}
+        for num, description in [(1, 'T1w'), (2, 'Resting')]:
+            series = make_series('STUDY_CMH_0001_01_01', STUDY_UID, num,
+                                 description, 'ORIGINAL\\PRIMARY', slices=3,
+                                 size=8)
+            for name, contents in series.items():
+                self.files['{}/{}'.format(num, name)] = contents
+        self.files['notes.txt'] = b'Some notes\n'
+        self.files['behav/empty.log'] = b''
+        with open(self.archive, 'wb') as archive:
+            archive.write(make_zip(self.files, prefix='session/'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_reads_one_header_per_series(self):
+        fingerprint = datman.fingerprint.get_archive_fingerprint(self.archive)
+
+        series = fingerprint['series']
+        assert sorted(series) == ['session/1', 'session/2']
+        assert series['session/1']['SeriesDescription'] == 'T1w'
+        assert series['session/2']['SeriesNumber'] == 2
+        assert all(s['StudyInstanceUID'] == STUDY_UID
+                   for s in series.values())
+
+    def test_hashes_resources(self):
+        fingerprint = datman.fingerprint.get_archive_fingerprint(self.archive)
+
+        resources = fingerprint['resources']
+        assert sorted(resources) == ['session/behav/empty.log',
+                                     'session/notes.txt']
+        assert resources['session/notes.txt'] == {
+                'size': 11, 'md5': hashlib.md5(b'Some notes\n').hexdigest()}
+        assert resources['session/behav/empty.log']['size'] == 0
+
+    def test_reads_whole_file_when_prefix_is_too_short(self):
+        with patch.object(datman.fingerprint, 'HEADER_PREFIX', 200):
+            fingerprint = datman.fingerprint.make_fingerprint(self.archive)
+
+        assert sorted(fingerprint['series']) == ['session/1', 'session/2']
+
+    def test_reuses_cache_for_unchanged_archive(self):
+        expected = datman.fingerprint.get_archive_fingerprint(self.archive)
+        assert os.path.exists(
+                datman.fingerprint.get_cache_file(self.archive))
+
+        with patch.object(datman.fingerprint, 'make_fingerprint') as mock_make:
+            fingerprint = datman.fingerprint.get_archive_fingerprint(
+                    self.archive)
+
+        assert not mock_make.called
+        assert fingerprint == expected
+
+    def test_cache_ignored_when_archive_changes(self):
+        datman.fingerprint.get_archive_fingerprint(self.archive)
+        self.files['extra.txt'] = b'More notes\n'
+        with open(self.archive, 'wb') as archive:
+            archive.write(make_zip(self.files, prefix='session/'))
+
+        fingerprint = datman.fingerprint.get_archive_fingerprint(self.archive)
+
+        assert 'session/extra.txt' in fingerprint['resources']
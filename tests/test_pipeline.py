@@ -0,0 +1,203 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import logging
+
+import datman.pipeline as pipeline
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_each_stage_receives_previous_result(self):
+        stages = [pipeline.Stage('double', lambda x: x * 2, workers=2),
+                  pipeline.Stage('add', lambda x: x + 1, workers=2)]
+        runner = pipeline.Pipeline(stages)
+
+        for num in range(5):
+            runner.submit(num)
+        results = runner.wait()
+
+        assert sorted(result.result for result in results) == [1, 3, 5, 7, 9]
+        assert all(result.succeeded for result in results)
+
+    def test_job_stops_at_failed_stage_and_is_cleaned_up(self):
+        called = []
+        cleaned = []
+
+        def fail(job):
+            raise RuntimeError('broken')
+
+        stages = [pipeline.Stage('first', fail),
+                  pipeline.Stage('second', called.append)]
+        runner = pipeline.Pipeline(stages, cleanup=cleaned.append)
+
+        runner.submit('job')
+        results = runner.wait()
+
+        assert results[0].failed_stage == 'first'
+        assert isinstance(results[0].error, RuntimeError)
+        assert called == []
+        assert cleaned == ['job']
+
+    def test_errors_outside_stage_still_finish_job(self):
+        class BrokenBudget(pipeline.DiskBudget):
+            def wait(self):
+                raise RuntimeError('broken')
+
+        stages = [pipeline.Stage('first', lambda job: job)]
+        runner = pipeline.Pipeline(stages, budget=BrokenBudget(1))
+
+        runner.submit('job')
+        results = runner.wait()
+
+        assert results[0].failed_stage == 'first'
+        assert isinstance(results[0].error, RuntimeError)
+
+    def test_stages_overlap_between_jobs(self):
+        running = set()
+        overlapped = []
+        lock = threading.Lock()
+
+        def stage(name):
+            def run(job):
+                with lock:
+                    running.add(name)
+                    if len(running) > 1:
+                        overlapped.append(job)
+                time.sleep(0.05)
+                with lock:
+                    running.discard(name)
+                return job
+            return run
+
+        stages = [pipeline.Stage('download', stage('download')),
+                  pipeline.Stage('export', stage('export'))]
+        runner = pipeline.Pipeline(stages)
+        for num in range(3):
+            runner.submit(num)
+        runner.wait()
+
+        assert overlapped
+
+
+class TestDiskBudget(unittest.TestCase):
+
+    def test_new_jobs_wait_until_space_released(self):
+        budget = pipeline.DiskBudget(100)
+        budget.add(150)
+        waited = threading.Event()
+
+        def start_job():
+            budget.wait()
+            waited.set()
+
+        thread = threading.Thread(target=start_job)
+        thread.start()
+        time.sleep(0.05)
+        assert not waited.is_set()
+
+        budget.release(150)
+        thread.join(2)
+        assert waited.is_set()
+        assert budget.peak == 150
+
+    def test_first_job_never_blocks(self):
+        budget = pipeline.DiskBudget(0)
+
+        budget.wait()
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_group_limit_respected_while_other_groups_run(self):
+        running = {}
+        most_running = {}
+        lock = threading.Lock()
+
+        def run(job):
+            group = job[0]
+            with lock:
+                running[group] = running.get(group, 0) + 1
+                most_running[group] = max(most_running.get(group, 0),
+                                          running[group])
+            time.sleep(0.02)
+            with lock:
+                running[group] -= 1
+            return True
+
+        jobs = [('A', num) for num in range(4)] + [('B', num)
+                                                   for num in range(4)]
+        scheduler = pipeline.Scheduler(pipeline.Stage('run', run, workers=4),
+                                       group=lambda job: job[0],
+                                       group_limit=1)
+        results = scheduler.run(jobs)
+
+        assert len(results) == 8
+        assert most_running == {'A': 1, 'B': 1}
+
+    def test_false_results_and_exceptions_are_failures(self):
+        def run(job):
+            if job == 'broken':
+                raise RuntimeError('broken')
+            return job == 'good'
+
+        scheduler = pipeline.Scheduler(pipeline.Stage('run', run, workers=2))
+        results = dict((result.job, result) for result in
+                       scheduler.run(['good', 'bad', 'broken']))
+
+        assert results['good'].succeeded
+        assert results['bad'].failed_stage == 'run'
+        assert isinstance(results['broken'].error, RuntimeError)
+
+
+class TestProgressRecord(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'progress.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_completed_jobs_remembered_by_next_run(self):
+        record = pipeline.ProgressRecord(self.path)
+        record.add('SESSION1', True)
+        record.add('SESSION2', False, 'Download failed')
+
+        record = pipeline.ProgressRecord(self.path)
+
+        assert record.is_completed('SESSION1')
+        assert not record.is_completed('SESSION2')
+        assert record.failed == {'SESSION2': 'Download failed'}
+
+    def test_failed_job_that_later_succeeds_is_completed(self):
+        record = pipeline.ProgressRecord(self.path)
+        record.add('SESSION1', False)
+        record.add('SESSION1', True)
+
+        assert record.is_completed('SESSION1')
+        assert record.failed == {}
+
+    def test_queued_jobs_stay_pending_until_added(self):
+        record = pipeline.ProgressRecord(self.path)
+        record.queue(['SESSION1', 'SESSION2', 'SESSION3'])
+        record.add('SESSION2', True)
+        record.add('SESSION3', False)
+
+        record = pipeline.ProgressRecord(self.path)
+
+        assert record.pending == ['SESSION1']
+
+    def test_unreadable_record_is_ignored(self):
+        with open(self.path, 'w') as record_file:
+            record_file.write('not json')
+
+        record = pipeline.ProgressRecord(self.path)
+
+        assert record.completed == set()
@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
 
+import io
 import os
+import shutil
+import struct
+import tempfile
+import zipfile
+import zlib
 
 
 import unittest
@@ -62,3 +68,213 @@ class TestCheckDependencyConfigured(unittest.TestCase):
 
     # def test_exception_contains_program_name(self):
     #     assert False
+
+
+class TestFilterZip(unittest.TestCase):
+
+    contents = {'session/1/file1.dcm': b'dicom data ' * 100,
+                'session/1/file2.dcm': b'more dicom data ' * 100,
+                'session/scan.nii.gz': b'nifti data',
+                'session/notes.txt': b''}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_utils_')
+        self.source = os.path.join(self.tmp, 'source.zip')
+        with zipfile.ZipFile(self.source, 'w') as source:
+            for name in sorted(self.contents):
+                compression = (zipfile.ZIP_DEFLATED if name.endswith('.dcm')
+                               else zipfile.ZIP_STORED)
+                source.writestr(name, self.contents[name], compression)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_copies_only_members_kept(self):
+        dest = os.path.join(self.tmp, 'dest.zip')
+
+        copied = utils.filter_zip(self.source, dest,
+                                  lambda name: not name.endswith('.nii.gz'))
+
+        expected = sorted(name for name in self.contents
+                          if not name.endswith('.nii.gz'))
+        assert sorted(copied) == expected
+        with zipfile.ZipFile(dest) as result:
+            assert result.testzip() is None
+            assert sorted(result.namelist()) == expected
+            for name in expected:
+                assert result.read(name) == self.contents[name]
+
+    def test_copied_members_arent_recompressed(self):
+        dest = os.path.join(self.tmp, 'dest.zip')
+
+        utils.filter_zip(self.source, dest, lambda name: True)
+
+        with zipfile.ZipFile(self.source) as source, \
+                zipfile.ZipFile(dest) as result:
+            for info in source.infolist():
+                copy = result.getinfo(info.filename)
+                assert copy.compress_type == info.compress_type
+                assert copy.compress_size == info.compress_size
+                assert copy.CRC == info.CRC
+
+    def test_member_can_be_renamed(self):
+        dest = os.path.join(self.tmp, 'dest.zip')
+
+        with zipfile.ZipFile(self.source) as source, \
+                zipfile.ZipFile(dest, 'w') as result:
+            utils.copy_zip_member(source, result,
+                                  source.getinfo('session/1/file1.dcm'),
+                                  name='renamed/file1.dcm')
+
+        with zipfile.ZipFile(dest) as result:
+            assert result.namelist() == ['renamed/file1.dcm']
+            assert result.read('renamed/file1.dcm') == \
+                    self.contents['session/1/file1.dcm']
+
+
+class TestRewriteZipStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_utils_')
+        self.dest = os.path.join(self.tmp, 'dest.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_members_renamed_and_dropped(self):
+        source = io.BytesIO()
+        with zipfile.ZipFile(source, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('resources/MISC/notes.txt', 'notes' * 100)
+            zip_file.writestr('SNAPSHOTS/img.gif', 'snapshot')
+        source.seek(0)
+
+        copied = utils.rewrite_zip_stream(source, self.dest,
+                lambda name: None if 'SNAPSHOTS' in name
+                             else name.replace('resources/MISC/', ''))
+
+        assert copied == ['notes.txt']
+        with zipfile.ZipFile(self.dest) as result:
+            assert result.testzip() is None
+            assert result.read('notes.txt') == 'notes' * 100
+
+    def test_follows_members_with_data_descriptors(self):
+        contents = {'first.txt': b'first file ' * 500, 'empty.txt': b''}
+        source = io.BytesIO(self.make_streamed_zip(
+                [('first.txt', True), ('empty.txt', False)], contents))
+
+        utils.rewrite_zip_stream(source, self.dest, lambda name: name)
+
+        with zipfile.ZipFile(self.dest) as result:
+            assert result.testzip() is None
+            for name in contents:
+                assert result.read(name) == contents[name]
+
+    def test_nothing_written_until_needed_member_found(self):
+        source = io.BytesIO()
+        with zipfile.ZipFile(source, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('scans/1/img.dcm', 'dicom')
+        source.seek(0)
+
+        copied = utils.rewrite_zip_stream(source, self.dest,
+                lambda name: name, needed=lambda name: 'MISC' in name)
+
+        assert copied is None
+        assert not os.path.exists(self.dest)
+
+    def test_members_before_needed_one_copied_from_source(self):
+        contents = {'first.txt': b'first file ' * 500,
+                    'MISC/notes.txt': b'notes ' * 100}
+        source_path = os.path.join(self.tmp, 'source.zip')
+        with open(source_path, 'wb') as source:
+            source.write(self.make_streamed_zip(
+                    [('first.txt', True), ('MISC/notes.txt', True)],
+                    contents))
+
+        with open(source_path, 'rb') as source:
+            copied = utils.rewrite_zip_stream(source, self.dest,
+                    lambda name: name.replace('MISC/', ''),
+                    needed=lambda name: 'MISC' in name, source=source_path)
+
+        assert copied == ['first.txt', 'notes.txt']
+        with zipfile.ZipFile(self.dest) as result:
+            assert result.testzip() is None
+            assert result.read('first.txt') == contents['first.txt']
+            assert result.read('notes.txt') == contents['MISC/notes.txt']
+
+    def make_streamed_zip(self, members, contents):
+        """
+        Builds a zip the way a streaming writer does, without sizes in the
+        local headers. Only the local headers and data are needed.
+        """
+        output = b''
+        for name, deflate in members:
+            data = contents[name]
+            if deflate:
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              -zlib.MAX_WBITS)
+                compressed = compressor.compress(data) + compressor.flush()
+            else:
+                compressed = data
+            output += struct.pack(zipfile.structFileHeader,
+                                  zipfile.stringFileHeader, 20, 0, 0x08,
+                                  zipfile.ZIP_DEFLATED if deflate
+                                  else zipfile.ZIP_STORED,
+                                  0, 33, 0, 0, 0, len(name), 0)
+            output += name + compressed
+            output += struct.pack('<4sLLL', b'PK\x07\x08',
+                                  zlib.crc32(data) & 0xFFFFFFFF,
+                                  len(compressed), len(data))
+        # The start of a central directory ends the members
+        return output + b'PK\x01\x02'
+
+
+class TestGrowingFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_utils_')
+        self.path = os.path.join(self.tmp, 'download')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_reads_until_finished(self):
+        growing = utils.GrowingFile(self.path, poll_interval=0.01)
+        with open(self.path, 'wb') as download:
+            download.write(b'first')
+            download.flush()
+            assert growing.read(100) == b'first'
+            download.write(b'second')
+        growing.finish()
+
+        assert growing.read(100) == b'second'
+        assert growing.read(100) == b''
+        growing.close()
+
+    @raises(IOError)
+    def test_truncated_file_raises_error(self):
+        with open(self.path, 'wb') as download:
+            download.write(b'first attempt')
+        growing = utils.GrowingFile(self.path, poll_interval=0.01)
+        growing.read(100)
+        with open(self.path, 'wb') as download:
+            download.write(b'retry')
+
+        growing.read(100)
+
+
+class TestWriteAtomic(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_utils_')
+        self.path = os.path.join(self.tmp, 'new_folder', 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_replaces_file_and_leaves_no_temp_files(self):
+        utils.write_atomic(self.path, u'old')
+        utils.write_atomic(self.path, b'new')
+
+        with open(self.path, 'rb') as written:
+            assert written.read() == b'new'
+        assert os.listdir(os.path.dirname(self.path)) == ['state.json']
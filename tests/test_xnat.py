@@ -1,11 +1,21 @@
 import os
+import copy
+import time
+import io
 import unittest
 import logging
+import hashlib
+import json
+import tempfile
+import shutil
+import threading
 
 from mock import Mock, patch
 from nose.tools import raises
+import requests
 
 import datman.xnat
+import datman.exceptions
 # Used only to act as a spec for Mock
 from datman.config import config as Config
 
@@ -175,3 +185,631 @@ class TestGetAuth(unittest.TestCase):
         env = {'XNAT_USER': 'someuser'}
         with patch.dict('os.environ', env) as mock_env:
             datman.xnat.get_auth()
+
+class TestWorkerPool(unittest.TestCase):
+
+    @patch('datman.xnat.xnat.get_xnat_session')
+    def setUp(self, mock_session):
+        self.xnat = datman.xnat.xnat('https://fakeserver.ca', 'user', 'pass',
+                max_workers=4)
+
+    def tearDown(self):
+        self.xnat.close()
+
+    def test_submit_returns_result_of_query(self):
+        result = self.xnat.submit(lambda x, y: x + y, 1, y=2)
+
+        assert result.get() == 3
+
+    def test_map_queries_preserves_argument_order(self):
+        results = self.xnat.map_queries(lambda x: x * 2,
+                [(num,) for num in range(20)])
+
+        assert results == [num * 2 for num in range(20)]
+
+    @raises(datman.exceptions.XnatException)
+    def test_map_queries_reraises_exceptions_from_workers(self):
+        def query(x):
+            if x == 3:
+                raise datman.exceptions.XnatException("Failed")
+            return x
+
+        self.xnat.map_queries(query, [(num,) for num in range(5)])
+
+    def test_refresh_session_only_reauthenticates_once_for_stale_session(self):
+        stale = Mock()
+        self.xnat.session = stale
+
+        def new_session():
+            self.xnat.session = Mock()
+
+        with patch.object(self.xnat, 'get_xnat_session',
+                side_effect=new_session) as mock_get:
+            self.xnat._refresh_session(stale)
+            self.xnat._refresh_session(stale)
+
+        assert mock_get.call_count == 1
+
+class TestRetryPolicy(unittest.TestCase):
+
+    url = 'https://fakeserver.ca/data/archive/projects/STUDY/experiments'
+
+    @patch('datman.xnat.xnat.get_xnat_session')
+    def setUp(self, mock_session):
+        self.policy = datman.xnat.RetryPolicy(failure_threshold=3,
+                default_budget=2)
+        self.policy.sleep = Mock()
+        self.xnat = datman.xnat.xnat('https://fakeserver.ca', 'user', 'pass',
+                retry_policy=self.policy)
+        self.xnat.session = Mock()
+
+    def _response(self, status):
+        response = Mock()
+        response.status_code = status
+        response.content = b''
+        return response
+
+    def test_backs_off_exponentially_between_retries(self):
+        self.xnat.session.get.side_effect = [self._response(503),
+                self._response(503), self._response(200)]
+
+        with patch('random.uniform', side_effect=lambda low, high: high):
+            response = self.xnat._request('get', self.url, 3)
+
+        assert response.status_code == 200
+        delays = [call[0][0] for call in self.policy.sleep.call_args_list]
+        assert delays == [2, 4]
+
+    def test_discarded_responses_are_closed(self):
+        responses = [self._response(503), self._response(401),
+                     self._response(200)]
+        self.xnat.session.get.side_effect = responses
+
+        with patch.object(self.xnat, '_refresh_session'):
+            self.xnat._request('get', self.url, 3, stream=True)
+
+        assert responses[0].close.called
+        assert responses[1].close.called
+        assert not responses[2].close.called
+
+    def test_returns_error_response_when_retries_used_up(self):
+        self.xnat.session.get.return_value = self._response(504)
+
+        response = self.xnat._request('get', self.url, 1)
+
+        assert response.status_code == 504
+        assert self.xnat.session.get.call_count == 2
+
+    def test_stops_retrying_when_category_budget_exhausted(self):
+        self.xnat.session.get.return_value = self._response(502)
+
+        self.xnat._request('get', self.url, 10)
+
+        # Two retries allowed by the budget, plus the first attempt
+        assert self.xnat.session.get.call_count == 3
+        counts = self.policy.summary()['categories']['experiments']
+        assert counts['budget_exhausted'] == 1
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        self.xnat.session.get.side_effect = \
+                requests.exceptions.ConnectionError()
+
+        with patch('time.time', return_value=1000):
+            try:
+                self.xnat._request('get', self.url, 2)
+            except requests.exceptions.ConnectionError:
+                pass
+
+        assert self.policy.circuit_opened == 1
+        assert self.policy._open_until == 1000 + self.policy.cooldown
+
+    def test_requests_wait_while_circuit_open(self):
+        self.xnat.session.get.return_value = self._response(200)
+        self.policy._open_until = time.time() + 30
+        self.policy.sleep.side_effect = lambda seconds: setattr(self.policy,
+                '_open_until', 0)
+
+        self.xnat._request('get', self.url)
+
+        assert self.policy.sleep.call_count == 1
+
+    def test_expired_session_renewed_only_once(self):
+        self.xnat.session.get.return_value = self._response(401)
+
+        with patch.object(self.xnat, '_refresh_session') as mock_refresh:
+            response = self.xnat._request('get', self.url)
+
+        assert mock_refresh.call_count == 1
+        assert response.status_code == 401
+
+    def test_login_retried_through_policy(self):
+        login = Mock()
+        login.post.side_effect = [self._response(503), self._response(200)]
+
+        with patch('requests.Session', return_value=login):
+            self.xnat.get_xnat_session()
+
+        assert login.post.call_count == 2
+        assert self.xnat.session is login
+        counts = self.policy.summary()['categories']['session']
+        assert counts['retries'] == 1
+
+class TestRequestStats(unittest.TestCase):
+
+    url = 'https://fakeserver.ca/data/archive/projects/STUDY/subjects/'
+
+    def setUp(self):
+        self.stats = datman.xnat.RequestStats()
+
+    def test_latency_histogram_and_percentiles(self):
+        for seconds in [0.005, 0.02, 0.02, 0.3, 7]:
+            self.stats.record('scans', 200, seconds)
+
+        summary = self.stats.summary()['categories']['scans']
+
+        counts = dict(summary['histogram'])
+        assert counts['<=0.01s'] == 1
+        assert counts['<=0.025s'] == 2
+        assert counts['<=0.5s'] == 1
+        assert counts['<=10s'] == 1
+        assert summary['p50_seconds'] == 0.025
+        assert summary['p99_seconds'] == 10
+        assert summary['max_seconds'] == 7
+
+    def test_summary_file_is_json(self):
+        self.stats.record('experiments', 404, 0.1, num_bytes=10)
+        _, output = tempfile.mkstemp()
+        try:
+            self.stats.write(output, server='someserver')
+            with open(output) as summary_file:
+                summary = json.load(summary_file)
+        finally:
+            os.remove(output)
+
+        assert summary['server'] == 'someserver'
+        assert summary['categories']['experiments']['status'] == {'404': 1}
+
+    @patch('datman.xnat.xnat.get_xnat_session')
+    def test_requests_are_recorded_with_their_retries(self, mock_session):
+        connection = datman.xnat.xnat('https://fakeserver.ca', 'user', 'pass',
+                retry_policy=datman.xnat.RetryPolicy(base_delay=0))
+        connection.session = Mock()
+        responses = []
+        for status in [503, 200]:
+            response = Mock()
+            response.status_code = status
+            response.content = b'12345'
+            responses.append(response)
+        connection.session.get.side_effect = responses
+
+        connection._request('get', self.url)
+
+        stats = connection.stats.summary()['categories']['subjects']
+        assert stats['requests'] == 1
+        assert stats['retries'] == 1
+        assert stats['status'] == {'200': 1}
+        assert stats['bytes'] == 5
+
+class TestGetResourceFiles(unittest.TestCase):
+
+    @patch('datman.xnat.xnat.get_xnat_session')
+    def setUp(self, mock_session):
+        self.xnat = datman.xnat.xnat('https://fakeserver.ca', 'user', 'pass')
+
+    def test_lists_every_folder_in_one_query(self):
+        result = {'ResultSet': {'Result': [
+                {'Name': 'notes.txt', 'Size': '10', 'cat_ID': '12',
+                 'URI': '/data/experiments/E1/resources/12/files/notes.txt',
+                 'digest': 'abc'},
+                {'Name': 'task.log', 'Size': '', 'cat_ID': '13',
+                 'URI': '/data/experiments/E1/resources/13/files/behav/task.log'}
+                ]}}
+
+        with patch.object(self.xnat, '_make_xnat_query',
+                return_value=result) as mock_query:
+            files = self.xnat.get_resource_files('STUDY', 'SESSION',
+                    'SESSION_01', ['12', '13'])
+
+        assert mock_query.call_count == 1
+        assert '/resources/12,13/files' in mock_query.call_args[0][0]
+        assert [item['URI'] for item in files] == ['notes.txt',
+                                                   'behav/task.log']
+        assert files[0]['size'] == 10 and files[0]['digest'] == 'abc'
+        assert files[1]['size'] is None and files[1]['digest'] is None
+
+    def test_falls_back_to_reading_each_catalog(self):
+        catalogs = {'12': [{'URI': 'notes.txt', 'name': 'notes.txt'}],
+                    '13': [{'URI': 'task.log', 'name': 'task.log'}]}
+
+        with patch.object(self.xnat, '_make_xnat_query',
+                side_effect=requests.exceptions.HTTPError()), \
+                patch.object(self.xnat, 'get_resource_list',
+                side_effect=lambda study, session, exp, r_id: catalogs[r_id]):
+            files = self.xnat.get_resource_files('STUDY', 'SESSION',
+                    'SESSION_01', ['12', '13'])
+
+        assert [item['URI'] for item in files] == ['notes.txt', 'task.log']
+        assert [item['resource_id'] for item in files] == ['12', '13']
+
+    @raises(datman.exceptions.XnatException)
+    def test_unreadable_catalog_raises_error(self):
+        with patch.object(self.xnat, '_make_xnat_xml_query',
+                side_effect=requests.exceptions.HTTPError()):
+            self.xnat.get_resource_list('STUDY', 'SESSION', 'SESSION_01',
+                    '12')
+
+class TestGetXnatStream(unittest.TestCase):
+
+    content = b'0123456789' * 10
+
+    @patch('datman.xnat.xnat.get_xnat_session')
+    def setUp(self, mock_session):
+        self.xnat = datman.xnat.xnat('https://fakeserver.ca', 'user', 'pass',
+                chunk_size=10,
+                retry_policy=datman.xnat.RetryPolicy(base_delay=0))
+        self.xnat.session = Mock()
+        _, self.output = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.remove(self.output)
+
+    def _response(self, status, data, fail_after=None, total=None):
+        response = Mock()
+        response.status_code = status
+        if status == 206:
+            response.headers = {'Content-Range': 'bytes {}-{}/{}'.format(
+                    total - len(data), total - 1, total)}
+        else:
+            response.headers = {'Content-Length': str(len(data))}
+
+        def iter_content(size):
+            for num, start in enumerate(range(0, len(data), size)):
+                if fail_after is not None and num == fail_after:
+                    raise requests.exceptions.ChunkedEncodingError()
+                yield data[start:start + size]
+
+        response.iter_content.side_effect = iter_content
+        return response
+
+    def _read_output(self):
+        with open(self.output, 'rb') as result:
+            return result.read()
+
+    def test_resumes_interrupted_download_with_range_request(self):
+        self.xnat.session.get.side_effect = [
+                self._response(200, self.content, fail_after=3),
+                self._response(206, self.content[30:],
+                        total=len(self.content))]
+
+        self.xnat._get_xnat_stream('someurl', self.output)
+
+        resume_call = self.xnat.session.get.call_args_list[1]
+        assert resume_call[1]['headers'] == {'Range': 'bytes=30-'}
+        assert self._read_output() == self.content
+
+    def test_restarts_download_when_server_ignores_range(self):
+        self.xnat.session.get.side_effect = [
+                self._response(200, self.content, fail_after=3),
+                self._response(200, self.content)]
+
+        self.xnat._get_xnat_stream('someurl', self.output)
+
+        assert self._read_output() == self.content
+
+    def test_accepts_download_matching_catalog_digest(self):
+        self.xnat.session.get.return_value = self._response(200,
+                self.content)
+
+        self.xnat._get_xnat_stream('someurl', self.output,
+                size=len(self.content),
+                digest=hashlib.md5(self.content).hexdigest())
+
+        assert self._read_output() == self.content
+
+    @raises(datman.exceptions.XnatException)
+    def test_raises_exception_when_digest_doesnt_match_catalog(self):
+        self.xnat.session.get.return_value = self._response(200,
+                self.content)
+
+        self.xnat._get_xnat_stream('someurl', self.output,
+                digest=hashlib.md5(b'something else').hexdigest())
+
+    @raises(requests.exceptions.ChunkedEncodingError)
+    def test_gives_up_when_out_of_retries(self):
+        self.xnat.session.get.side_effect = lambda *args, **kwargs: \
+                self._response(200, self.content, fail_after=0)
+
+        self.xnat._get_xnat_stream('someurl', self.output, retries=2)
+
+class TestMetadataCache(unittest.TestCase):
+
+    server = 'https://fakeserver.ca'
+    session_url = server + '/data/archive/projects/STUDY/subjects/' \
+            'STUDY_CMH_0001_01?format=json'
+    listing_url = server + '/data/archive/projects/STUDY/subjects/'
+    other_url = server + '/data/archive/projects/STUDY/subjects/' \
+            'STUDY_CMH_0002_01?format=json'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = datman.xnat.MetadataCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_stored_entry_is_returned_with_validators(self):
+        self.cache.put(self.session_url, b'{"items": []}',
+                {'ETag': '"abc"', 'Last-Modified': 'yesterday'})
+
+        entry = self.cache.get(self.session_url)
+
+        assert entry.content == b'{"items": []}'
+        assert entry.validators() == {'If-None-Match': '"abc"',
+                                      'If-Modified-Since': 'yesterday'}
+
+    def test_invalidating_session_drops_session_and_project_listing(self):
+        for url in [self.session_url, self.listing_url, self.other_url]:
+            self.cache.put(url, b'{}')
+
+        self.cache.invalidate('STUDY', 'STUDY_CMH_0001_01')
+
+        assert self.cache.get(self.session_url) is None
+        assert self.cache.get(self.listing_url) is None
+        assert self.cache.get(self.other_url) is not None
+
+    @patch('datman.xnat.xnat.get_xnat_session')
+    def test_query_uses_cached_content_when_server_reports_not_modified(
+            self, mock_session):
+        xnat = datman.xnat.xnat(self.server, 'user', 'pass',
+                cache_dir=self.cache_dir)
+        xnat.cache.put(self.session_url, b'{"items": [1]}', {'ETag': '"abc"'})
+        xnat.session = Mock()
+        xnat.session.get.return_value.status_code = 304
+        xnat.session.get.return_value.content = b''
+
+        result = xnat._make_xnat_query(self.session_url)
+
+        assert result == {'items': [1]}
+        request_headers = xnat.session.get.call_args[1]['headers']
+        assert request_headers == {'If-None-Match': '"abc"'}
+
+class TestSeriesCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.source = os.path.join(self.temp_dir, 'series')
+        os.makedirs(os.path.join(self.source, 'files'))
+        with open(os.path.join(self.source, 'files', '1.dcm'), 'wb') as dcm:
+            dcm.write(b'x' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_cached_series_is_restored(self):
+        cache = datman.xnat.SeriesCache(self.cache_dir, 1000)
+        cache.add('key1', self.source)
+        dest = os.path.join(self.temp_dir, 'restored')
+
+        assert cache.get('key1', dest)
+        assert os.path.exists(os.path.join(dest, 'files', '1.dcm'))
+
+    def test_missing_series_not_restored(self):
+        cache = datman.xnat.SeriesCache(self.cache_dir, 1000)
+
+        assert not cache.get('key1', os.path.join(self.temp_dir, 'dest'))
+        assert not cache.get(None, os.path.join(self.temp_dir, 'dest'))
+
+    def test_least_recently_used_series_evicted_over_size_limit(self):
+        cache = datman.xnat.SeriesCache(self.cache_dir, 350)
+        for num, key in enumerate(['old', 'used', 'new']):
+            cache.add(key, self.source)
+            os.utime(os.path.join(self.cache_dir, key), (num, num))
+        cache.get('used', os.path.join(self.temp_dir, 'dest'))
+
+        cache.add('newest', self.source)
+
+        assert sorted(os.listdir(self.cache_dir)) == ['new', 'newest', 'used']
+
+    def test_size_of_existing_cache_is_read_at_start(self):
+        datman.xnat.SeriesCache(self.cache_dir, 1000).add('key1', self.source)
+
+        cache = datman.xnat.SeriesCache(self.cache_dir, 1000)
+
+        assert cache._sizes == {'key1': 100}
+
+    def test_series_key_needs_every_checksum(self):
+        files = [{'URI': '1.dcm', 'size': 10, 'digest': 'abc'},
+                 {'URI': '2.dcm', 'size': 10, 'digest': None}]
+
+        assert datman.xnat.get_series_key('1.2.3', files) is None
+        files[1]['digest'] = 'def'
+        key = datman.xnat.get_series_key('1.2.3', files)
+        assert key == datman.xnat.get_series_key('1.2.3', files[::-1])
+        files[1]['digest'] = 'changed'
+        assert key != datman.xnat.get_series_key('1.2.3', files)
+
+class TestSessionIndex(unittest.TestCase):
+
+    sessions = {'STUDY1': ['STUDY_CMH_0001_01', 'STUDY_CMH_0002_01'],
+                'STUDY2': ['STUDY_CMH_0002_01', 'STUDY_CMH_0003_01']}
+
+    def setUp(self):
+        # Tests may add sessions, so each gets its own copy
+        self.sessions = copy.deepcopy(TestSessionIndex.sessions)
+        self.xnat = Mock()
+        self.xnat.get_projects.return_value = [{'ID': 'STUDY1'},
+                                               {'ID': 'STUDY2'}]
+        self.xnat.get_sessions.side_effect = lambda project: [
+                {'label': label} for label in self.sessions[project]]
+        self.xnat.map_queries.side_effect = lambda func, args: [
+                func(*item) for item in args]
+        self.index_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.index_dir, 'index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_finds_session_in_first_matching_project(self):
+        index = datman.xnat.SessionIndex(self.xnat)
+
+        assert index.find('STUDY_CMH_0002_01', ['STUDY2', 'STUDY1']) == \
+                'STUDY2'
+        assert index.find('STUDY_CMH_0001_01') == 'STUDY1'
+
+    def test_projects_only_listed_once_while_index_is_current(self):
+        index = datman.xnat.SessionIndex(self.xnat)
+
+        for session in ['STUDY_CMH_0001_01', 'STUDY_CMH_0003_01',
+                        'STUDY_CMH_9999_01', 'STUDY_CMH_9999_01']:
+            index.find(session)
+
+        assert self.xnat.get_sessions.call_count == 2
+
+    def test_missing_session_triggers_refresh_of_stale_projects(self):
+        index = datman.xnat.SessionIndex(self.xnat, refresh_interval=0)
+        index.find('STUDY_CMH_0001_01', ['STUDY1'])
+        self.sessions['STUDY1'].append('STUDY_CMH_0004_01')
+
+        assert index.find('STUDY_CMH_0004_01', ['STUDY1']) == 'STUDY1'
+
+    def test_index_is_reused_from_disk(self):
+        datman.xnat.SessionIndex(self.xnat, self.index_path).find(
+                'STUDY_CMH_0001_01')
+        self.xnat.get_sessions.reset_mock()
+
+        index = datman.xnat.SessionIndex(self.xnat, self.index_path)
+
+        assert index.find('STUDY_CMH_0003_01') == 'STUDY2'
+        assert self.xnat.get_sessions.call_count == 0
+
+class TestGetScansInfo(unittest.TestCase):
+
+    @patch('datman.xnat.xnat.get_xnat_session')
+    def setUp(self, mock_session):
+        self.xnat = datman.xnat.xnat('https://fakeserver.ca', 'user', 'pass')
+
+    def tearDown(self):
+        self.xnat.close()
+
+    def _scan(self, scan_id, complete=True):
+        scan = {'data_fields': {'ID': scan_id}}
+        if complete:
+            scan['children'] = [{'field': 'file', 'items': []}]
+        return scan
+
+    def test_scans_from_experiment_json_are_keyed_by_id(self):
+        experiment = {'children': [
+                {'field': 'resources/resource', 'items': []},
+                {'field': 'scans/scan', 'items': [self._scan('1'),
+                                                  self._scan('2')]}]}
+
+        with patch.object(self.xnat, 'get_experiment',
+                return_value=experiment):
+            with patch.object(self.xnat, 'get_scan_info') as mock_info:
+                result = self.xnat.get_scans_info('STUDY', 'SESSION', 'EXP')
+
+        assert sorted(result.keys()) == ['1', '2']
+        assert result['2'] == self._scan('2')
+        assert mock_info.call_count == 0
+
+    def test_incomplete_scan_records_are_queried_individually(self):
+        scans = [self._scan('1'), self._scan('2', complete=False)]
+
+        with patch.object(self.xnat, 'get_scan_info',
+                side_effect=lambda *args: self._scan(args[-1])) as mock_info:
+            result = self.xnat.get_scans_info('STUDY', 'SESSION', 'EXP',
+                    scans=scans)
+
+        assert result['2'] == self._scan('2')
+        mock_info.assert_called_once_with('STUDY', 'SESSION', 'EXP', '2')
+
+    @raises(datman.exceptions.XnatException)
+    def test_failed_scan_lookup_raises_error(self):
+        with patch.object(self.xnat, '_make_xnat_query',
+                side_effect=requests.exceptions.HTTPError()):
+            self.xnat.get_scan_info('STUDY', 'SESSION', 'EXP', '2')
+
+    def test_scans_that_cant_be_looked_up_are_left_out(self):
+        scans = [self._scan('1'), self._scan('2', complete=False)]
+
+        with patch.object(self.xnat, '_make_xnat_query',
+                side_effect=requests.exceptions.HTTPError()):
+            result = self.xnat.get_scans_info('STUDY', 'SESSION', 'EXP',
+                    scans=scans)
+
+        assert sorted(result.keys()) == ['1']
+
+class TestUploads(unittest.TestCase):
+
+    content = b'x' * 1000
+
+    @patch('datman.xnat.xnat.get_xnat_session')
+    def setUp(self, mock_session):
+        self.xnat = datman.xnat.xnat('https://fakeserver.ca', 'user', 'pass',
+                retry_policy=datman.xnat.RetryPolicy(base_delay=0))
+        self.xnat.session = Mock()
+
+    def _stream(self):
+        return datman.xnat.UploadStream(lambda: io.BytesIO(self.content),
+                len(self.content), 'somefile')
+
+    def test_upload_stream_reads_data_in_blocks(self):
+        stream = self._stream()
+
+        blocks = [stream.read(300) for _ in range(4)]
+
+        assert [len(block) for block in blocks] == [300, 300, 300, 100]
+        assert len(stream) == len(self.content)
+
+    def test_failed_post_is_retried_from_start_of_data(self):
+        sent = []
+
+        def post(url, headers=None, data=None, timeout=None):
+            sent.append(data.read(-1))
+            if len(sent) == 1:
+                raise requests.exceptions.ConnectionError()
+            response = Mock()
+            response.status_code = 200
+            response.content = b''
+            return response
+
+        self.xnat.session.post.side_effect = post
+
+        self.xnat._make_xnat_post('someurl', self._stream())
+
+        assert sent == [self.content, self.content]
+
+    def test_upload_batch_only_checks_resource_folder_once(self):
+        with patch.object(self.xnat, 'get_experiment') as mock_experiment, \
+                patch.object(self.xnat, 'get_resource_ids',
+                        return_value='123') as mock_ids, \
+                patch.object(self.xnat, '_make_xnat_post'):
+            with self.xnat.upload_batch():
+                for name in ['file1.txt', 'file2.txt']:
+                    self.xnat.put_resource('STUDY', 'SESSION', 'SESSION',
+                            name, 'data', 'MISC')
+
+        assert mock_experiment.call_count == 1
+        assert mock_ids.call_count == 1
+
+    @raises(datman.exceptions.XnatException)
+    def test_failed_resource_upload_raises_error(self):
+        with patch.object(self.xnat, '_get_upload_folder',
+                return_value='123'), \
+                patch.object(self.xnat, '_make_xnat_post',
+                        side_effect=requests.exceptions.ConnectionError()):
+            self.xnat.put_resource('STUDY', 'SESSION', 'SESSION',
+                    'file1.txt', 'data', 'MISC')
+
+    def test_upload_batch_is_kept_per_thread(self):
+        other_thread = []
+        with self.xnat.upload_batch():
+            thread = threading.Thread(target=lambda: other_thread.append(
+                    getattr(self.xnat._uploads, 'folders', None)))
+            thread.start()
+            thread.join()
+            assert self.xnat._uploads.folders == {}
+
+        assert other_thread == [None]
+        assert self.xnat._uploads.folders is None
@@ -0,0 +1,190 @@
+import os
+import unittest
+import importlib
+import logging
+import shutil
+import tempfile
+import time
+import zipfile
+
+from mock import patch, MagicMock
+
+logging.disable(logging.CRITICAL)
+
+fetch = importlib.import_module('bin.xnat_fetch_sessions')
+
+
+class TestUpdateNeeded(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_fetch_sessions_')
+        self.zip_file = os.path.join(self.tmp, 'STUDY_CMH_0001_01.zip')
+        with zipfile.ZipFile(self.zip_file, 'w') as zip_handle:
+            zip_handle.writestr('notes.txt', 'notes')
+        self.resources = [{'URI': 'MISC/notes.txt', 'size': 5,
+                           'digest': 'abc123'}]
+        self.session = MagicMock()
+        self.session.name = 'STUDY_CMH_0001_01'
+        self.session.experiment_UID = '1.2.3'
+        self.session.scan_UIDs = ['1.2.3.1', '1.2.3.2']
+        self.session.get_resource_files.side_effect = \
+                lambda xnat: self.resources
+        self.xnat = MagicMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @patch('datman.fingerprint.get_archive_fingerprint')
+    def test_current_state_is_checked_without_reading_zip(self,
+                                                          mock_fingerprint):
+        fetch.write_state(self.zip_file, self.session, self.xnat)
+
+        assert not fetch.update_needed(self.zip_file, self.session, self.xnat)
+        assert not mock_fingerprint.called
+
+    def test_new_scan_needs_update(self):
+        fetch.write_state(self.zip_file, self.session, self.xnat)
+        self.session.scan_UIDs = self.session.scan_UIDs + ['1.2.3.3']
+
+        assert fetch.update_needed(self.zip_file, self.session, self.xnat)
+
+    def test_changed_resource_needs_update(self):
+        fetch.write_state(self.zip_file, self.session, self.xnat)
+        self.resources = [dict(self.resources[0], digest='def456')]
+
+        assert fetch.update_needed(self.zip_file, self.session, self.xnat)
+
+    def test_dry_run_writes_nothing(self):
+        self.session.get_resources.return_value = ['MISC/notes.txt']
+        series = dict(('scans/{}'.format(num),
+                       {'StudyInstanceUID': '1.2.3', 'SeriesInstanceUID': uid})
+                      for num, uid in enumerate(self.session.scan_UIDs))
+        fingerprint = {'series': series,
+                       'resources': {'notes.txt': {'size': 5}}}
+
+        with patch.object(fetch, 'DRYRUN', True), \
+                patch('datman.fingerprint.write_cache') as mock_cache, \
+                patch('datman.fingerprint.make_fingerprint',
+                      return_value=fingerprint):
+            assert not fetch.update_needed(self.zip_file, self.session,
+                                           self.xnat)
+
+        assert not mock_cache.called
+        assert os.listdir(self.tmp) == ['STUDY_CMH_0001_01.zip']
+
+    def test_state_ignored_once_zip_changes(self):
+        fetch.write_state(self.zip_file, self.session, self.xnat)
+        with zipfile.ZipFile(self.zip_file, 'a') as zip_handle:
+            zip_handle.writestr('more_notes.txt', 'more notes')
+
+        assert fetch.read_state(self.zip_file) is None
+
+
+class TestDownloadSession(unittest.TestCase):
+
+    contents = {'scans/1/resources/DICOM/files/img.dcm': 'dicom',
+                'scans/1/resources/SNAPSHOTS/files/img.gif': 'snapshot',
+                'resources/MISC/files/notes.txt': 'notes' * 1000}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_fetch_sessions_')
+        self.temp = os.path.join(self.tmp, 'temp')
+        self.dest = os.path.join(self.tmp, 'zips')
+        os.mkdir(self.temp)
+        os.mkdir(self.dest)
+        self.zip_path = os.path.join(self.dest, 'STUDY_CMH_0001_01.zip')
+        self.download = self.make_zip(self.contents)
+        self.session = MagicMock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_zip(self, contents):
+        source = os.path.join(self.tmp, 'source.zip')
+        with zipfile.ZipFile(source, 'w', zipfile.ZIP_DEFLATED) as zip_handle:
+            for name in sorted(contents):
+                zip_handle.writestr(name, contents[name])
+        with open(source, 'rb') as source_file:
+            return source_file.read()
+
+    def slow_download(self, xnat, dest_folder, zip_name=None):
+        output = os.path.join(dest_folder, zip_name)
+        with open(output, 'wb') as output_file:
+            for start in range(0, len(self.download), 100):
+                output_file.write(self.download[start:start + 100])
+                output_file.flush()
+                time.sleep(0.001)
+        return output
+
+    def test_zip_restructured_while_downloading(self):
+        self.session.download.side_effect = self.slow_download
+
+        with patch('bin.xnat_fetch_sessions.restructure_zip') as mock_restructure:
+            fetch.download_session(self.session, MagicMock(), self.temp,
+                                   'STUDY_CMH_0001_01.zip', self.zip_path)
+
+        # The finished download didnt need restructuring again
+        assert not mock_restructure.called
+        assert os.listdir(self.dest) == ['STUDY_CMH_0001_01.zip']
+        with zipfile.ZipFile(self.zip_path) as zip_handle:
+            assert sorted(zip_handle.namelist()) == [
+                    'files/notes.txt', 'scans/1/resources/DICOM/files/img.dcm']
+            assert zip_handle.read('files/notes.txt') == 'notes' * 1000
+
+    def test_zip_without_misc_folder_published_untouched(self):
+        self.download = self.make_zip(dict(
+                (name, data) for name, data in self.contents.items()
+                if not name.startswith('resources/')))
+        self.session.download.side_effect = self.slow_download
+
+        with patch('datman.utils._write_zip_member') as mock_write:
+            fetch.download_session(self.session, MagicMock(), self.temp,
+                                   'STUDY_CMH_0001_01.zip', self.zip_path)
+
+        # Nothing was rewritten, the download was published as is
+        assert not mock_write.called
+        with open(self.zip_path, 'rb') as zip_file:
+            assert zip_file.read() == self.download
+
+    def test_members_before_misc_folder_restructured_while_downloading(self):
+        contents = dict(self.contents)
+        contents['z_resources/MISC/files/notes.txt'] = \
+                contents.pop('resources/MISC/files/notes.txt')
+        self.download = self.make_zip(contents)
+        self.session.download.side_effect = self.slow_download
+
+        with patch.object(fetch, 'BAD_PREFIX', 'z_resources/MISC/'), \
+                patch('bin.xnat_fetch_sessions.restructure_zip') as \
+                mock_restructure:
+            fetch.download_session(self.session, MagicMock(), self.temp,
+                                   'STUDY_CMH_0001_01.zip', self.zip_path)
+
+        assert not mock_restructure.called
+        with zipfile.ZipFile(self.zip_path) as zip_handle:
+            assert sorted(zip_handle.namelist()) == [
+                    'files/notes.txt', 'scans/1/resources/DICOM/files/img.dcm']
+
+    def test_nothing_published_when_download_fails(self):
+        def failed_download(xnat, dest_folder, zip_name=None):
+            self.download = self.download[:len(self.download) // 2]
+            self.slow_download(xnat, dest_folder, zip_name)
+            raise IOError('Connection lost')
+        self.session.download.side_effect = failed_download
+
+        with self.assertRaises(IOError):
+            fetch.download_session(self.session, MagicMock(), self.temp,
+                                   'STUDY_CMH_0001_01.zip', self.zip_path)
+
+        assert os.listdir(self.dest) == []
+
+
+class TestRestructuredName(unittest.TestCase):
+
+    def test_resources_moved_out_of_misc_folder(self):
+        assert fetch.restructured_name('resources/MISC/files/notes.txt') == \
+                'files/notes.txt'
+
+    def test_snapshots_and_folders_dropped(self):
+        assert fetch.restructured_name(
+                'scans/1/resources/SNAPSHOTS/files/img.gif') is None
+        assert fetch.restructured_name('scans/1/') is None
@@ -0,0 +1,119 @@
+import os
+import unittest
+import logging
+import tempfile
+import zipfile
+
+import datman.xnat
+import datman.exceptions
+from xnat_server import MockXnat, XnatServer, make_archive, make_zip, \
+        make_series
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+STUDY = 'STUDY'
+SESSION = 'STUDY_CMH_0001_01'
+EXPERIMENT = 'STUDY_CMH_0001_01_01'
+
+
+class TestMockXnatServer(unittest.TestCase):
+
+    def setUp(self):
+        self.app = MockXnat(make_archive(sessions=2, slices=3, size=8),
+                            seed=0)
+        self.server = XnatServer(self.app).start()
+        self.xnat = datman.xnat.xnat(self.server.url, 'user', 'pass',
+                retry_policy=datman.xnat.RetryPolicy(base_delay=0))
+        _, self.output = tempfile.mkstemp()
+
+    def tearDown(self):
+        self.xnat.close()
+        self.xnat.session.close()
+        self.server.stop()
+        os.remove(self.output)
+
+    def test_session_json_is_understood_by_client(self):
+        session = self.xnat.get_session(STUDY, SESSION)
+
+        assert session.experiment_label == EXPERIMENT
+        assert len(session.scans) == 5
+        assert 'MISC' in session.resource_IDs
+
+    def test_downloads_dicom_zip_for_scan(self):
+        self.xnat.get_dicom(STUDY, SESSION, EXPERIMENT, '1', self.output)
+
+        with zipfile.ZipFile(self.output) as dicoms:
+            assert len(dicoms.namelist()) == 3
+
+    def test_resource_download_matches_catalog(self):
+        session = self.xnat.get_session(STUDY, SESSION)
+        resource_id = session.resource_IDs['MISC']
+        entries = self.xnat.get_resource_list(STUDY, SESSION, EXPERIMENT,
+                resource_id)
+
+        for entry in entries:
+            self.xnat.get_resource(STUDY, SESSION, EXPERIMENT, resource_id,
+                    entry['URI'], self.output, zipped=False,
+                    size=entry['size'], digest=entry['digest'])
+
+    def test_dropped_downloads_are_resumed(self):
+        self.app.drop_rate = {'dicom_download': 0.5}
+
+        for scan in ['1', '2', '3']:
+            self.xnat.get_dicom(STUDY, SESSION, EXPERIMENT, scan,
+                    self.output)
+            with zipfile.ZipFile(self.output) as dicoms:
+                assert dicoms.testzip() is None
+
+        assert any(record['status'] == 206 for record in self.app.log)
+
+    def test_server_errors_are_retried(self):
+        self.app.error_rate = {'projects': 1}
+
+        with self.assertRaises(datman.exceptions.XnatException):
+            self.xnat.get_projects()
+
+        self.app.error_rate = 0
+        assert len(self.xnat.get_projects()) == 1
+
+    def test_expired_login_is_renewed(self):
+        self.app.expire_sessions()
+
+        assert self.xnat.get_project(STUDY)
+
+    def test_uploaded_dicoms_create_scans(self):
+        files = make_series('STUDY_CMH_0009_01', '1.2.3', 7, 'T2w', 'ORIGINAL',
+                            slices=2, size=8)
+        with open(self.output, 'wb') as upload:
+            upload.write(make_zip(files))
+
+        self.xnat.make_session(STUDY, 'STUDY_CMH_0009_01')
+        self.xnat.put_dicoms(STUDY, 'STUDY_CMH_0009_01',
+                'STUDY_CMH_0009_01_01', self.output)
+
+        scans = self.xnat.get_scan_list(STUDY, 'STUDY_CMH_0009_01',
+                'STUDY_CMH_0009_01_01')
+        assert [scan['series_description'] for scan in scans] == ['T2w']
+
+    def test_uploaded_resources_are_listed(self):
+        self.xnat.put_resource(STUDY, SESSION, EXPERIMENT, 'new.txt',
+                b'some data', 'EXTRA')
+
+        resource_id = self.xnat.get_resource_ids(STUDY, SESSION, EXPERIMENT,
+                'EXTRA', create=False)
+        entries = self.xnat.get_resource_list(STUDY, SESSION, EXPERIMENT,
+                resource_id)
+        assert [entry['name'] for entry in entries] == ['new.txt']
+
+    def test_session_resource_files_need_one_request(self):
+        session = self.xnat.get_session(STUDY, SESSION)
+        requests_made = len(self.app.log)
+
+        files = session.get_resource_files(self.xnat)
+        session.get_resources(self.xnat)
+
+        assert len(self.app.log) == requests_made + 1
+        assert sorted(item['URI'] for item in files) == ['behav/task.log',
+                                                         'notes.txt']
+        assert all(item['digest'] and item['size'] for item in files)
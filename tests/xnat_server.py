@@ -0,0 +1,875 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the parts of the XNAT REST API that datman.xnat uses,
+so that the xnat scripts can be benchmarked and load tested without a real
+server.
+
+The server holds a synthetic archive in memory (see make_archive) and
+supports logging in (/data/JSESSION), browsing projects, subjects,
+experiments, scans and resource catalogs, downloading DICOM and resource
+files (with Range requests) and uploading DICOM zips and resource files.
+Latency, limited bandwidth, 503 errors and dropped downloads can be added to
+see how the client copes. Every request made is recorded and can be saved
+to replay later against this (or a real) server.
+
+Usage:
+    xnat_server.py [options]
+
+Options:
+    --port PORT             The port to listen on [default: 8080]
+    --projects LIST         A comma separated list of projects to generate
+                            [default: STUDY]
+    --sites LIST            A comma separated list of sites to generate
+                            sessions for [default: CMH]
+    --sessions N            The number of sessions per site [default: 4]
+    --slices N              The number of dicoms in each series [default: 10]
+    --latency SECS          Seconds to wait before answering each request
+                            [default: 0]
+    --jitter SECS           Up to this many seconds are randomly added to the
+                            latency [default: 0]
+    --bandwidth MBPS        Limit each download to this many MB/s
+    --error-rate RATE       The fraction of requests answered with a 503
+                            [default: 0]
+    --drop-rate RATE        The fraction of file downloads cut off part way
+                            through [default: 0]
+    --record FILE           Save a log of every request made to FILE when
+                            the server is stopped
+    -d, --debug             Log every request
+
+Example:
+    python tests/xnat_server.py --sessions 20 --latency 0.05 --error-rate 0.05
+
+    Then point XNATSERVER at http://localhost:8080 (any user name and
+    password are accepted).
+"""
+from __future__ import division
+
+import base64
+import hashlib
+import io
+import json
+import logging
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+import zipfile
+from xml.sax.saxutils import quoteattr
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+
+import datman.xnat
+
+logger = logging.getLogger(__name__)
+
+# The series every generated session holds: description, image type and
+# whether it's a multi-echo series
+SERIES = [('T1w_MPRAGE', 'ORIGINAL\\PRIMARY\\M\\ND', False),
+          ('DTI_60dir', 'ORIGINAL\\PRIMARY\\DIFFUSION\\NONE', False),
+          ('Resting_State', 'ORIGINAL\\PRIMARY\\M\\ND\\MOSAIC', False),
+          ('MultiEcho_FMRI', 'ORIGINAL\\PRIMARY\\M\\ND', True),
+          ('T1w_MPRAGE_MPR', 'DERIVED\\SECONDARY\\MPR', False)]
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Archive(object):
+    """
+    The data held by the mock server. projects maps each project name to its
+    subjects, subjects map to experiments and experiments hold scans and
+    resource folders, each with a dictionary of file names to contents.
+    """
+
+    def __init__(self):
+        self.projects = {}
+        self.lock = threading.RLock()
+        self._next_id = 1
+
+    def new_id(self):
+        with self.lock:
+            new_id = self._next_id
+            self._next_id += 1
+            return new_id
+
+    def add_project(self, project):
+        with self.lock:
+            return self.projects.setdefault(project, {'subjects': {}})
+
+    def add_subject(self, project, subject):
+        with self.lock:
+            subjects = self.add_project(project)['subjects']
+            return subjects.setdefault(subject, {'experiments': {}})
+
+    def add_experiment(self, project, subject, experiment):
+        with self.lock:
+            experiments = self.add_subject(project, subject)['experiments']
+            if experiment not in experiments:
+                experiments[experiment] = {
+                        'ID': 'XNAT_E{:05d}'.format(self.new_id()),
+                        'UID': _make_uid(),
+                        'scans': [],
+                        'resources': []}
+            return experiments[experiment]
+
+    def add_scan(self, experiment, series, description, image_type, files,
+                 multiecho=False):
+        """files maps each dicom's name to its contents"""
+        with self.lock:
+            scan = {'ID': str(series),
+                    'UID': _make_uid(),
+                    'description': description,
+                    'image_type': image_type,
+                    'multiecho': multiecho,
+                    'resource_id': self.new_id(),
+                    'files': files}
+            experiment['scans'] = [s for s in experiment['scans']
+                                   if s['ID'] != scan['ID']] + [scan]
+            return scan
+
+    def add_resource(self, experiment, label):
+        with self.lock:
+            for resource in experiment['resources']:
+                if resource['label'] == label:
+                    return resource
+            resource = {'label': label, 'ID': self.new_id(), 'files': {}}
+            experiment['resources'].append(resource)
+            return resource
+
+    def find_experiment(self, experiment_id):
+        with self.lock:
+            for project in self.projects.values():
+                for subject in project['subjects'].values():
+                    for experiment in subject['experiments'].values():
+                        if experiment['ID'] == experiment_id:
+                            return experiment
+
+    def num_files(self):
+        total = 0
+        with self.lock:
+            for project in self.projects.values():
+                for subject in project['subjects'].values():
+                    for experiment in subject['experiments'].values():
+                        for item in experiment['scans'] + \
+                                experiment['resources']:
+                            total += len(item['files'])
+        return total
+
+
+def make_archive(projects=('STUDY',), sites=('CMH',), sessions=4, slices=10,
+                 series=SERIES, size=64, seed=0, full_subject_ids=False):
+    """
+    Generate an archive of datman style sessions (e.g. STUDY_CMH_0001_01)
+    each holding one experiment with a scan for every entry in 'series',
+    'slices' dicoms of size x size pixels per scan, and a MISC resource
+    folder holding a couple of small files. If full_subject_ids is set the
+    subjects are labelled the same as their experiment (with the session
+    number), as dm_xnat_extract expects.
+    """
+    rng = random.Random(seed)
+    archive = Archive()
+    for project in projects:
+        archive.add_project(project)
+        for site in sites:
+            for num in range(1, sessions + 1):
+                subject = '{}_{}_{:04d}_01'.format(project, site, num)
+                experiment_label = subject + '_01'
+                if full_subject_ids:
+                    subject = experiment_label
+                experiment = archive.add_experiment(project, subject,
+                                                    experiment_label)
+                for series_num, (description, image_type, multiecho) in \
+                        enumerate(series, 1):
+                    files = make_series(subject, experiment['UID'],
+                                        series_num, description, image_type,
+                                        slices, size, rng,
+                                        echoes=2 if multiecho else 1)
+                    archive.add_scan(experiment, series_num, description,
+                                     image_type, files, multiecho)
+                resource = archive.add_resource(experiment, 'MISC')
+                resource['files']['notes.txt'] = \
+                        'Scan notes for {}\n'.format(subject).encode('utf-8')
+                resource['files']['behav/task.log'] = bytes(bytearray(
+                        rng.getrandbits(8) for _ in range(4096)))
+    return archive
+
+
+def make_series(patient, study_uid, series, description, image_type, slices,
+                size=64, rng=None, echoes=1):
+    """
+    Returns a dictionary of file names to synthetic dicom contents. If
+    'echoes' is more than one the slices are shared out between the echoes.
+    """
+    rng = rng or random.Random()
+    series_uid = _make_uid()
+    files = {}
+    for instance in range(1, slices + 1):
+        name = '{}.MR.{}.{}.dcm'.format(patient, series, instance)
+        files[name] = make_dicom(patient, study_uid, series_uid, series,
+                                 instance, description, image_type, size, rng,
+                                 echo=(instance - 1) % echoes + 1)
+    return files
+
+
+def make_dicom(patient, study_uid, series_uid, series, instance, description,
+               image_type, size=64, rng=None, echo=1):
+    """Returns the bytes of a small but valid MR dicom file"""
+    rng = rng or random.Random()
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    meta.MediaStorageSOPInstanceUID = _make_uid()
+    meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    meta.ImplementationClassUID = '1.2.3.4'
+
+    ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'MR'
+    ds.PatientName = patient
+    ds.PatientID = patient
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series
+    ds.InstanceNumber = instance
+    ds.EchoNumbers = echo
+    ds.SeriesDescription = description
+    ds.ImageType = image_type.split('\\')
+    ds.StudyDate = '20180101'
+    ds.Rows = size
+    ds.Columns = size
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = bytes(bytearray(rng.getrandbits(8)
+                                   for _ in range(size * size * 2)))
+
+    output = io.BytesIO()
+    ds.save_as(output, write_like_original=False)
+    return output.getvalue()
+
+
+def read_dicom_headers(contents):
+    """Returns the header of the dicom held in 'contents'"""
+    return pydicom.dcmread(io.BytesIO(contents), stop_before_pixels=True)
+
+
+def make_zip(files, prefix=''):
+    """Returns the bytes of a zip file holding 'files'"""
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as zip_file:
+        for name in sorted(files):
+            zip_file.writestr(prefix + name, files[name])
+    return output.getvalue()
+
+
+def _make_uid():
+    return '2.25.{}'.format(uuid.uuid4().int)
+
+
+class Response(object):
+
+    def __init__(self, status=200, body=b'', content_type='text/plain',
+                 headers=None, download=False):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.status = status
+        self.body = body
+        self.headers = {'Content-Type': content_type}
+        self.headers.update(headers or {})
+        # Downloads can be resumed with Range requests and may be dropped by
+        # error injection
+        self.download = download
+
+
+class NotFound(Exception):
+    pass
+
+
+class MockXnat(object):
+    """
+    Answers requests the way xnat would, using the contents of 'archive'.
+
+    latency and jitter add a delay (in seconds) to every request. bandwidth
+    limits each response to that many bytes per second. error_rate is the
+    fraction of requests answered with a 503, and drop_rate the fraction of
+    file downloads cut off part way through. Either rate can be a dictionary
+    mapping endpoint categories (see datman.xnat._endpoint_category) to a
+    rate, to only affect some kinds of request.
+    """
+
+    def __init__(self, archive=None, latency=0, jitter=0, bandwidth=None,
+                 error_rate=0, drop_rate=0, seed=None):
+        self.archive = archive if archive is not None else Archive()
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.sessions = set()
+        self.log = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def expire_sessions(self):
+        """Forget every login, as if they had all timed out"""
+        with self._lock:
+            self.sessions.clear()
+
+    def record(self, method, url, status, num_bytes, seconds):
+        with self._lock:
+            self.log.append({'method': method,
+                             'url': url,
+                             'category': datman.xnat._endpoint_category(
+                                     method.lower(), url),
+                             'status': status,
+                             'bytes': num_bytes,
+                             'seconds': seconds})
+
+    def save_log(self, path):
+        """Write the request log to 'path', one json record per line"""
+        with self._lock:
+            records = list(self.log)
+        with open(path, 'w') as log_file:
+            for record in records:
+                log_file.write(json.dumps(record) + '\n')
+
+    def delay(self):
+        wait = self.latency
+        if self.jitter:
+            with self._lock:
+                wait += self._random.uniform(0, self.jitter)
+        if wait:
+            time.sleep(wait)
+
+    def should_fail(self, rate, method, url):
+        if isinstance(rate, dict):
+            rate = rate.get(datman.xnat._endpoint_category(method.lower(),
+                                                           url), 0)
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def handle(self, method, url, headers, body):
+        """Returns a Response for the request"""
+        parsed = urlparse(url)
+        query = dict((key, values[0]) for key, values
+                     in parse_qs(parsed.query).items())
+        parts = [unquote(part) for part in parsed.path.strip('/').split('/')
+                 if part]
+        # /data/archive/projects, /data/projects and /REST/projects are the
+        # same resource
+        if parts[:2] == ['data', 'archive']:
+            parts = parts[2:]
+        elif parts[:1] in (['data'], ['REST']):
+            parts = parts[1:]
+
+        if parts == ['JSESSION']:
+            return self.handle_login(method, headers)
+        if not self.is_authorized(headers):
+            return Response(401, 'Not logged in')
+
+        try:
+            if parts == ['services', 'import'] and method == 'POST':
+                return self.import_dicoms(query, body)
+            if parts[:1] == ['experiments'] and len(parts) == 5:
+                return self.download_session(parts[1], parts[3])
+            if parts[:1] == ['projects']:
+                return self.handle_project(method, parts[1:], query, body)
+        except NotFound as e:
+            return Response(404, str(e))
+        except KeyError as e:
+            return Response(404, 'Not found: {}'.format(e))
+        return Response(404, 'Unknown path {}'.format(parsed.path))
+
+    def is_authorized(self, headers):
+        cookies = headers.get('Cookie', '')
+        match = re.search('JSESSIONID=([^;]+)', cookies)
+        with self._lock:
+            return bool(match and match.group(1) in self.sessions)
+
+    def handle_login(self, method, headers):
+        if method == 'DELETE':
+            return Response(200)
+        auth = headers.get('Authorization', '')
+        if not auth.startswith('Basic ') or \
+                b':' not in base64.b64decode(auth[6:].encode('ascii')):
+            return Response(401, 'Login required')
+        session_id = uuid.uuid4().hex.upper()
+        with self._lock:
+            self.sessions.add(session_id)
+        return Response(200, session_id)
+
+    def handle_project(self, method, parts, query, body):
+        archive = self.archive
+        if not parts:
+            return _result_set([{'ID': name, 'name': name}
+                                for name in sorted(archive.projects)])
+        project = parts[0]
+        if project not in archive.projects:
+            raise NotFound('Project {}'.format(project))
+        if len(parts) == 1:
+            return _items({'data_fields': {'ID': project, 'name': project},
+                           'children': []})
+
+        subjects = archive.projects[project]['subjects']
+        if len(parts) == 2:
+            return _result_set([{'ID': label, 'label': label,
+                                 'project': project}
+                                for label in sorted(subjects)])
+        subject = parts[2]
+        if len(parts) == 3:
+            if method == 'PUT':
+                archive.add_subject(project, subject)
+                return Response(201)
+            return _items(self.subject_json(project, subject,
+                                            subjects[subject]))
+
+        experiments = subjects[subject]['experiments']
+        if len(parts) == 4:
+            return _result_set([{'ID': exp['ID'], 'label': label,
+                                 'project': project}
+                                for label, exp in sorted(experiments.items())])
+        if len(parts) == 5:
+            if method == 'PUT':
+                archive.add_experiment(project, subject, parts[4])
+                return Response(201)
+            return _items(self.experiment_json(project, parts[4],
+                                               experiments[parts[4]]))
+
+        experiment = experiments[parts[4]]
+        if parts[5] == 'scans':
+            return self.handle_scans(parts[6:], experiment, parts[4])
+        if parts[5] == 'resources':
+            return self.handle_resources(method, parts[6:], query, body,
+                                         experiment, parts[4])
+        raise NotFound('/'.join(parts))
+
+    def handle_scans(self, parts, experiment, label):
+        scans = dict((scan['ID'], scan) for scan in experiment['scans'])
+        if not parts:
+            return _result_set([{'ID': scan['ID'],
+                                 'type': scan['description'],
+                                 'series_description': scan['description']}
+                                for scan in experiment['scans']])
+        scan = scans[parts[0]]
+        if len(parts) == 1:
+            return _items(self.scan_json(scan))
+        if parts[1:] == ['resources', 'DICOM', 'files']:
+            prefix = '{}/scans/{}-{}/resources/DICOM/files/'.format(
+                    label, scan['ID'], scan['description'])
+            return _zip_response(scan['files'], prefix)
+        raise NotFound('/'.join(parts))
+
+    def handle_resources(self, method, parts, query, body, experiment, label):
+        archive = self.archive
+        if not parts:
+            return _result_set([{'label': res['label'],
+                                 'xnat_abstractresource_id': res['ID'],
+                                 'file_count': len(res['files'])}
+                                for res in experiment['resources']])
+        if method == 'PUT' and len(parts) == 1:
+            archive.add_resource(experiment, parts[0])
+            return Response(200)
+
+        if parts[1:] == ['files'] and query.get('format') == 'json':
+            return self.list_files(parts[0].split(','), experiment)
+
+        resource = None
+        for item in experiment['resources']:
+            if parts[0] in (str(item['ID']), item['label']):
+                resource = item
+        if resource is None:
+            raise NotFound('Resource {}'.format(parts[0]))
+
+        if len(parts) == 1:
+            return _catalog(resource)
+        if len(parts) == 2 and parts[1] == 'files':
+            return _zip_response(resource['files'], '{}/resources/{}/files/'
+                                 .format(label, resource['label']))
+        name = '/'.join(parts[2:])
+        if method == 'POST':
+            with archive.lock:
+                resource['files'][name] = body
+            return Response(200)
+        if method == 'DELETE':
+            with archive.lock:
+                del resource['files'][name]
+            return Response(200)
+        if query.get('format') == 'zip':
+            return _zip_response({name: resource['files'][name]})
+        return Response(200, resource['files'][name],
+                        'application/octet-stream', download=True)
+
+    def list_files(self, wanted, experiment):
+        """List the files in one or more resource folders"""
+        folders = [(str(res['ID']), res['label'], res['files'])
+                   for res in experiment['resources']]
+        folders.extend((str(scan['resource_id']), 'DICOM', scan['files'])
+                       for scan in experiment['scans'])
+        results = []
+        for resource_id in wanted:
+            matches = [folder for folder in folders
+                       if resource_id in folder[:2]]
+            if not matches:
+                raise NotFound('Resource {}'.format(resource_id))
+            folder_id, folder_label, files = matches[0]
+            for name in sorted(files):
+                results.append({
+                        'Name': name.split('/')[-1],
+                        'Size': str(len(files[name])),
+                        'URI': '/data/experiments/{}/resources/{}/files/{}'
+                               .format(experiment['ID'], folder_id, name),
+                        'collection': folder_label,
+                        'cat_ID': folder_id,
+                        'digest': hashlib.md5(files[name]).hexdigest()})
+        return _result_set(results)
+
+    def import_dicoms(self, query, body):
+        """Sort an uploaded zip of dicoms into scans of a new experiment"""
+        archive = self.archive
+        series = {}
+        with zipfile.ZipFile(io.BytesIO(body)) as zip_file:
+            for item in zip_file.infolist():
+                if item.filename.endswith('/'):
+                    continue
+                contents = zip_file.read(item)
+                try:
+                    header = read_dicom_headers(contents)
+                except Exception:
+                    continue
+                num = int(header.SeriesNumber)
+                files, _ = series.setdefault(num, ({}, header))
+                files[item.filename.split('/')[-1]] = contents
+        if not series:
+            return Response(400, 'No dicoms found in upload')
+
+        with archive.lock:
+            subjects = archive.projects[query['project']]['subjects']
+            experiments = subjects.get(query['subject'], {}).get(
+                    'experiments', {})
+            if query['session'] not in experiments and len(experiments):
+                return Response(409, 'Upload matches multiple imaging '
+                                'sessions.')
+            experiment = archive.add_experiment(query['project'],
+                                                query['subject'],
+                                                query['session'])
+            if query.get('overwrite') == 'delete':
+                experiment['scans'] = []
+            for num in sorted(series):
+                files, header = series[num]
+                archive.add_scan(experiment, num,
+                                 str(header.get('SeriesDescription', '')),
+                                 '\\'.join(header.get('ImageType', [])),
+                                 files)
+        return Response(200, '/data/archive/projects/{}/subjects/{}/'
+                        'experiments/{}'.format(query['project'],
+                                                query['subject'],
+                                                query['session']))
+
+    def download_session(self, experiment_id, resource_ids):
+        experiment = self.archive.find_experiment(experiment_id)
+        if experiment is None:
+            raise NotFound('Experiment {}'.format(experiment_id))
+        wanted = resource_ids.split(',')
+        files = {}
+        for scan in experiment['scans']:
+            if str(scan['resource_id']) in wanted:
+                for name, contents in scan['files'].items():
+                    files['scans/{}-{}/resources/DICOM/files/{}'.format(
+                            scan['ID'], scan['description'], name)] = contents
+        for resource in experiment['resources']:
+            if str(resource['ID']) in wanted:
+                for name, contents in resource['files'].items():
+                    files['resources/{}/files/{}'.format(
+                            resource['label'], name)] = contents
+        return _zip_response(files)
+
+    def subject_json(self, project, label, subject):
+        children = []
+        if subject['experiments']:
+            children.append({'field': 'experiments/experiment',
+                             'items': [self.experiment_json(project, name, exp)
+                                       for name, exp in
+                                       sorted(subject['experiments'].items())]
+                             })
+        return {'data_fields': {'ID': label, 'label': label,
+                                'project': project},
+                'children': children}
+
+    def experiment_json(self, project, label, experiment):
+        children = []
+        if experiment['scans']:
+            children.append({'field': 'scans/scan',
+                             'items': [self.scan_json(scan) for scan
+                                       in experiment['scans']]})
+        if experiment['resources']:
+            children.append({'field': 'resources/resource',
+                             'items': [{'data_fields': {
+                                 'label': res['label'],
+                                 'xnat_abstractresource_id': res['ID'],
+                                 'file_count': len(res['files'])}}
+                                 for res in experiment['resources']]})
+        return {'data_fields': {'ID': experiment['ID'],
+                                'label': label,
+                                'UID': experiment['UID'],
+                                'project': project},
+                'children': children}
+
+    def scan_json(self, scan):
+        file_fields = {'label': 'DICOM',
+                       'format': 'DICOM',
+                       'content': 'RAW',
+                       'xnat_abstractresource_id': scan['resource_id'],
+                       'file_count': len(scan['files'])}
+        if scan['multiecho']:
+            file_fields['name'] = 'MultiEcho'
+        return {'data_fields': {'ID': scan['ID'],
+                                'UID': scan['UID'],
+                                'type': scan['description'],
+                                'series_description': scan['description'],
+                                'parameters/imageType': scan['image_type'],
+                                'quality': 'usable'},
+                'children': [{'field': 'file',
+                              'items': [{'data_fields': file_fields}]}]}
+
+
+def _result_set(results):
+    body = {'ResultSet': {'Result': results,
+                          'totalRecords': str(len(results))}}
+    return Response(200, json.dumps(body), 'application/json')
+
+
+def _items(item):
+    return Response(200, json.dumps({'items': [item]}), 'application/json')
+
+
+def _catalog(resource):
+    entries = []
+    for name in sorted(resource['files']):
+        contents = resource['files'][name]
+        entries.append('<cat:entry URI={uri} ID={uri} name={name} '
+                       'digest="{digest}" size="{size}"/>'.format(
+                            uri=quoteattr(name),
+                            name=quoteattr(name.split('/')[-1]),
+                            digest=hashlib.md5(contents).hexdigest(),
+                            size=len(contents)))
+    body = ('<cat:Catalog xmlns:cat="http://nrg.wustl.edu/catalog" ID={}>'
+            '<cat:entries>{}</cat:entries></cat:Catalog>'.format(
+                    quoteattr(str(resource['ID'])), ''.join(entries)))
+    return Response(200, body, 'text/xml')
+
+
+def _zip_response(files, prefix=''):
+    return Response(200, make_zip(files, prefix), 'application/zip',
+                    download=True)
+
+
+class XnatRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and body are written separately, without this the body can
+        # be held back waiting for the client to acknowledge the headers
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_PUT(self):
+        self.answer('PUT')
+
+    def do_POST(self):
+        self.answer('POST')
+
+    def do_DELETE(self):
+        self.answer('DELETE')
+
+    def answer(self, method):
+        app = self.server.app
+        start = time.time()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        url = 'http://{}:{}{}'.format(self.server.server_address[0],
+                                      self.server.server_address[1],
+                                      self.path)
+
+        app.delay()
+        if app.should_fail(app.error_rate, method, url):
+            response = Response(503, 'Service temporarily unavailable')
+        else:
+            response = app.handle(method, self.path, self.headers, body)
+        status, sent = self.send(method, url, response)
+        app.record(method, url, status, sent, time.time() - start)
+
+    def send(self, method, url, response):
+        app = self.server.app
+        body = response.body
+        headers = dict(response.headers)
+        status = response.status
+
+        if status == 200 and method == 'GET':
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+
+        requested = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if status == 200 and response.download and requested:
+            start = int(requested.group(1))
+            if start >= len(body):
+                status, body = 416, b''
+            else:
+                headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                        start, len(body) - 1, len(body))
+                status, body = 206, body[start:]
+
+        drop = response.download and status in [200, 206] and \
+                len(body) > 1 and app.should_fail(app.drop_rate, method, url)
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        end = len(body) // 2 if drop else len(body)
+        sent = 0
+        while sent < end:
+            chunk = body[sent:min(end, sent + CHUNK_SIZE)]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if app.bandwidth:
+                time.sleep(len(chunk) / app.bandwidth)
+        if drop:
+            self.wfile.flush()
+            self.close_connection = True
+        return status, sent
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class XnatServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a MockXnat from a background thread. Use as a context manager,
+    or call start() and stop().
+
+        with XnatServer(MockXnat(make_archive())) as server:
+            connection = datman.xnat.xnat(server.url, 'user', 'pass')
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, app, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), XnatRequestHandler)
+        self.app = app
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def replay(log, connection, workers=None):
+    """
+    Repeat the GET requests in a request log (a list of the records saved
+    by MockXnat.save_log) against the server 'connection' (a
+    datman.xnat.xnat instance) is logged in to, running up to 'workers' at
+    a time. Returns a list of (category, status, seconds) for each request.
+    """
+    server = urlparse(connection.server)
+
+    def repeat(record):
+        url = urlparse(record['url'])._replace(scheme=server.scheme,
+                                               netloc=server.netloc).geturl()
+        start = time.time()
+        response = connection._request('get', url, timeout=120)
+        response.content
+        return (record['category'], response.status_code,
+                time.time() - start)
+
+    records = [(record,) for record in log if record['method'] == 'GET' and
+               record['category'] != 'session']
+    if workers:
+        connection.max_workers = workers
+    return connection.map_queries(repeat, records)
+
+
+def read_log(path):
+    with open(path) as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+def main():
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    logging.basicConfig(level=logging.DEBUG if arguments['--debug']
+                        else logging.INFO)
+
+    archive = make_archive(projects=arguments['--projects'].split(','),
+                           sites=arguments['--sites'].split(','),
+                           sessions=int(arguments['--sessions']),
+                           slices=int(arguments['--slices']))
+    bandwidth = arguments['--bandwidth']
+    app = MockXnat(archive,
+                   latency=float(arguments['--latency']),
+                   jitter=float(arguments['--jitter']),
+                   bandwidth=float(bandwidth) * 1024 * 1024 if bandwidth
+                             else None,
+                   error_rate=float(arguments['--error-rate']),
+                   drop_rate=float(arguments['--drop-rate']))
+
+    server = XnatServer(app, int(arguments['--port']))
+    logger.info('Serving {} files at {}'.format(archive.num_files(),
+                                                server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if arguments['--record']:
+            app.save_log(arguments['--record'])
+            logger.info('Saved {} requests to {}'.format(
+                    len(app.log), arguments['--record']))
+
+
+if __name__ == '__main__':
+    main()